@@ -0,0 +1,354 @@
+import asyncio
+import os
+import sys
+import time
+
+from berkeley_averaging import create_engine
+from berkeley_clock import to_seconds
+from berkeley_coordinator import BerkeleyCoordinator, estimate_offset, log, phase_log
+from berkeley_history import history_from_env
+from berkeley_logging import setup_logging
+from berkeley_metrics import start_metrics_server
+from berkeley_protocol import LEGACY_JSON, MessageDecoder, encode_message
+from berkeley_registry import ClientState
+from berkeley_udp import transport_from_env
+
+class AsyncClientConnection(ClientState):
+    __slots__ = ('reader', 'writer', 'address', 'pending', 'pending_seq', 'decoder',
+                 'version') + ClientState.STATE_SLOTS
+
+    def __init__(self, reader, writer, address):
+        self.init_state()
+        self.reader = reader
+        self.writer = writer
+        self.address = address
+        self.pending = None  # Future da sonda de tempo em andamento
+        self.pending_seq = 0
+        self.decoder = MessageDecoder()
+        self.version = LEGACY_JSON
+
+    def send_message(self, message):
+        self.writer.write(encode_message(message, self.version))
+
+    async def recv_messages(self):
+        data = await self.reader.read(65536)
+        if not data:
+            return None
+        messages = self.decoder.feed(data)
+        if self.decoder.version is not None:
+            self.version = self.decoder.version
+        return messages
+
+# Coordenador com um único event loop asyncio que possui todos os sockets dos
+# clientes, em vez de uma thread por conexão e outra por solicitação
+class AsyncBerkeleyCoordinator(BerkeleyCoordinator):
+    def __init__(self, host='localhost', port=5000, round_timeout=5.0, backlog=4096, probes_per_client=4,
+                 averaging=None, udp=None, adjustment_timeout=1.0, history=None, quorum=1, startup_timeout=5.0,
+                 reuse_port=False):
+        super().__init__(host, port, probes_per_client, round_timeout, averaging, udp=udp,
+                         adjustment_timeout=adjustment_timeout, history=history, quorum=quorum,
+                         startup_timeout=startup_timeout, reuse_port=reuse_port)
+        self.round_timeout = round_timeout
+        self.backlog = backlog
+
+    def start(self):
+        try:
+            asyncio.run(self.run())
+        except KeyboardInterrupt:
+            log.info("[COORDENADOR] Encerrado pelo usuário")
+            self.server_socket.close()
+
+    async def run(self):
+        self.round_requested = asyncio.Event()
+        server = await asyncio.start_server(self.handle_client_async,
+                                            sock=self.server_socket,
+                                            backlog=self.backlog)
+        self.print_header()
+        log.info("[COORDENADOR] Modo asyncio (event loop único)")
+
+        self.announce_ready()
+        await self.wait_for_quorum_async()
+
+        async with server:
+            while True:
+                num_clients = len(self.registry)
+
+                if num_clients > 0:
+                    log.info("[COORDENADOR] %d clientes conectados. Iniciando sincronização...", num_clients)
+                    self.round_requested.clear()
+                    spread, error = await self.synchronize_clocks_async()
+                    interval = self.scheduler.record_round(spread, error)
+                    self.metrics.set_gauge("next_round_interval_seconds", interval)
+                    log.info("[COORDENADOR] Próxima sincronização em %.1f segundos...", interval)
+                    await self.wait_for_next_round_async(interval)
+                else:
+                    log.info("[COORDENADOR] Aguardando clientes para iniciar sincronização...")
+                    await self.wait_for_next_round_async(5)
+
+    async def wait_for_quorum_async(self):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.startup_timeout
+        while len(self.registry) < self.quorum:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                log.info("[COORDENADOR] Quórum não atingido em %.1fs; seguindo com %d cliente(s)",
+                         self.startup_timeout, len(self.registry))
+                break
+            try:
+                await asyncio.wait_for(self.round_requested.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+            self.round_requested.clear()
+
+    async def wait_for_next_round_async(self, interval):
+        try:
+            await asyncio.wait_for(self.round_requested.wait(), interval)
+        except asyncio.TimeoutError:
+            return
+        self.round_requested.clear()
+        await asyncio.sleep(self.scheduler.early_round_delay())
+
+    async def handle_client_async(self, reader, writer):
+        address = writer.get_extra_info('peername')
+        # Sem folga no buffer de escrita: drain() só retorna quando tudo foi
+        # entregue ao kernel, o que dá a deliver_adjustments um prazo real
+        writer.transport.set_write_buffer_limits(0)
+        connection = AsyncClientConnection(reader, writer, address)
+        num_clients = self.registry.add(connection)
+        self.metrics.set_gauge("clients_connected", num_clients)
+        log.info("[COORDENADOR] Nova conexão de %s:%s", address[0], address[1])
+        log.info("[COORDENADOR] Total de clientes conectados: %d", num_clients)
+        self.request_early_round()
+
+        try:
+            while True:
+                messages = await connection.recv_messages()
+                if messages is None:
+                    break
+
+                receive_time = self.get_current_time()
+                connection.last_seen = time.monotonic()
+                for message in messages:
+                    message_type = message.get("type")
+                    if message_type in ("time_response", "aggregate_response"):
+                        pending = connection.pending
+                        if (pending is not None and not pending.done()
+                                and message.get("seq", connection.pending_seq) == connection.pending_seq):
+                            pending.set_result((message, receive_time))
+                    elif message_type == "hello":
+                        connection.role = message.get("role", "client")
+                        connection.confidence = message.get("confidence")
+                        self.identify_client(connection, message.get("client_id"))
+                        if connection.role == "subcoordinator":
+                            log.info("[COORDENADOR] %s conectado como subcoordenador", message.get('client_id'))
+                        if connection.confidence is not None:
+                            log.info("[COORDENADOR] %s retomou estado salvo (confiança %.2f)",
+                                     message.get('client_id'), connection.confidence)
+                    elif message_type == "udp_register":
+                        connection.udp_address = (address[0], message["port"])
+        except Exception as e:
+            log.error("[ERRO] Falha na comunicação com cliente %s: %s", address, e)
+            self.metrics.inc("errors_total", kind="connection")
+        finally:
+            num_clients = self.registry.remove(connection)
+            self.metrics.set_gauge("clients_connected", num_clients)
+            if connection.pending is not None and not connection.pending.done():
+                connection.pending.cancel()
+            writer.close()
+            log.info("[COORDENADOR] Cliente %s desconectado. Restantes: %d", address, num_clients)
+
+    async def synchronize_clocks_async(self):
+        with self.metrics.time_phase("round"):
+            coordinator_time = self.begin_round()
+            with self.metrics.time_phase("collect"):
+                client_responses = await self.collect_client_times_async(coordinator_time)
+            # process_responses roda numa thread do executor: o seu
+            # dispatch_adjustments espera a entrega, que acontece neste event loop
+            self.loop = asyncio.get_running_loop()
+            return await self.loop.run_in_executor(None, self.process_responses, coordinator_time,
+                                                   client_responses)
+
+    async def collect_client_times_async(self, coordinator_time):
+        phase_log.info("\nFASE 2: SOLICITAÇÃO DE TEMPOS DOS CLIENTES")
+        phase_log.info("-" * 80)
+
+        loop = asyncio.get_running_loop()
+        connections = self.registry.snapshot()
+        samples = {connection: [] for connection in connections}
+        client_ids = {}
+        deadline = time.monotonic() + self.round_timeout
+
+        phase_log.info("[COORDENADOR] Enviando %d sondas para %d clientes...", self.probes_per_client, len(connections))
+
+        # Clientes com UDP registrado são sondados pelo transporte UDP numa thread
+        # do executor, em paralelo com as ondas TCP
+        udp_clients = self.udp_clients(connections)
+        udp_future = None
+        if udp_clients:
+            udp_future = loop.run_in_executor(None, self.collect_udp_samples, udp_clients, deadline)
+
+        # Cada onda envia uma sonda a todos os clientes de uma vez; as respostas
+        # são coletadas pelo handler de cada conexão. Quem não responde a tempo
+        # fica fora das ondas seguintes
+        active = [connection for connection in connections if connection not in udp_clients]
+        for wave in range(self.probes_per_client):
+            remaining = deadline - time.monotonic()
+            if not active or remaining <= 0:
+                break
+
+            pending = {}
+            for connection in active:
+                future = loop.create_future()
+                connection.probe_seq += 1
+                connection.pending_seq = connection.probe_seq
+                connection.pending = future
+                send_time = self.get_current_time()
+                try:
+                    connection.send_message({"type": "time_request", "seq": connection.probe_seq})
+                except Exception as e:
+                    log.error("[ERRO] Falha ao solicitar tempo de cliente: %s", e)
+                    self.metrics.inc("errors_total", kind="probe")
+                    future.cancel()
+                    continue
+                pending[future] = (connection, send_time)
+
+            if not pending:
+                break
+            done, not_done = await asyncio.wait(pending, timeout=remaining / (self.probes_per_client - wave))
+            for future in not_done:
+                future.cancel()
+
+            active = []
+            for future in done:
+                connection, send_time = pending[future]
+                connection.pending = None
+                if future.cancelled():
+                    continue
+                response, receive_time = future.result()
+                samples[connection].append((send_time, response.get("time"), receive_time))
+                client_ids[connection] = response.get("client_id", "Desconhecido")
+                active.append(connection)
+            for future in not_done:
+                pending[future][0].pending = None
+
+        if udp_future is not None:
+            for connection, (client_samples, client_id) in (await udp_future).items():
+                samples[connection] = client_samples
+                client_ids[connection] = client_id
+
+        await self.collect_group_aggregates([connection for connection, client_samples in samples.items()
+                                             if client_samples and connection.role == "subcoordinator"])
+
+        client_responses = []
+        for connection, client_samples in samples.items():
+            if not client_samples:
+                continue
+            offset, rtt, uncertainty = estimate_offset(client_samples)
+            connection.record_offset(to_seconds(offset), rtt, uncertainty)
+            client_id = client_ids[connection]
+            if client_id != "Desconhecido":
+                self.identify_client(connection, client_id)
+            client_time = coordinator_time + offset
+            client_responses.append((connection, client_time, client_id))
+            self.print_client_time(client_id, client_time, coordinator_time, rtt)
+
+        missing = len(connections) - len(client_responses)
+        if missing:
+            log.warning("[COORDENADOR] %d clientes não responderam em %.1fs", missing, self.round_timeout)
+            self.metrics.inc("errors_total", missing, kind="probe_timeout")
+        self.record_collection(len(connections), len(client_responses))
+
+        return client_responses
+
+    async def collect_group_aggregates(self, subcoordinators):
+        loop = asyncio.get_running_loop()
+        pending = {}
+        for connection in subcoordinators:
+            connection.group = None
+            future = loop.create_future()
+            connection.probe_seq += 1
+            connection.pending_seq = connection.probe_seq
+            connection.pending = future
+            connection.send_message({"type": "aggregate_request", "seq": connection.probe_seq})
+            pending[future] = connection
+
+        if not pending:
+            return
+        done, not_done = await asyncio.wait(pending, timeout=self.aggregate_timeout)
+        for future in not_done:
+            future.cancel()
+            log.warning("[ERRO] Prazo esgotado ao obter agregado de %s", pending[future].address)
+            self.metrics.inc("errors_total", kind="aggregate_timeout")
+        for future, connection in pending.items():
+            connection.pending = None
+            if future in done and not future.cancelled():
+                response, _ = future.result()
+                connection.group = (response["sum"], response["count"],
+                                    response["min_offset"], response["max_offset"])
+
+    def dispatch_adjustments(self, adjustments):
+        # Chamado por process_responses na thread do executor: o envio fica com
+        # o event loop, e a thread espera o conjunto dos não entregues
+        return asyncio.run_coroutine_threadsafe(self.deliver_adjustments(adjustments), self.loop).result()
+
+    async def deliver_adjustments(self, adjustments):
+        # writer.write só enfileira no transporte; todos os ajustes são escritos
+        # e depois drenados juntos, com o prazo adjustment_timeout por cliente
+        undelivered = set()
+        drains = {}
+        for client, client_id, client_adjustment, reference in adjustments:
+            try:
+                client.send_message({"type": "time_adjustment", "adjustment": client_adjustment,
+                                     "reference": reference})
+            except Exception as e:
+                log.error("[ERRO] Falha ao enviar ajuste para %s: %s", client_id, e)
+                self.metrics.inc("errors_total", kind="adjustment_send")
+                undelivered.add(client)
+                continue
+            drains[asyncio.ensure_future(client.writer.drain())] = (client, client_id)
+
+        if drains:
+            done, not_done = await asyncio.wait(drains, timeout=self.adjustment_timeout)
+            for task in not_done:
+                task.cancel()
+                client, client_id = drains[task]
+                log.warning("[ERRO] Prazo esgotado ao enviar ajuste para %s", client_id)
+                self.metrics.inc("errors_total", kind="adjustment_timeout")
+                # O quadro atrasado não pode ser retirado do buffer do transporte
+                # nem chegar fora do prazo: a conexão é derrubada e o cliente
+                # reconecta
+                client.writer.transport.abort()
+                undelivered.add(client)
+            for task in done:
+                if task.exception() is not None:
+                    client, client_id = drains[task]
+                    log.error("[ERRO] Falha ao enviar ajuste para %s: %s", client_id, task.exception())
+                    self.metrics.inc("errors_total", kind="adjustment_send")
+                    undelivered.add(client)
+
+        for client, _, _, _ in adjustments:
+            if client not in undelivered:
+                client.mark_adjusted()
+        return undelivered
+
+def raise_file_limit():
+    # Cada cliente ocupa um descritor; eleva o limite flexível até o rígido
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    averaging = create_engine(sys.argv[2]) if len(sys.argv) > 2 else None
+
+    raise_file_limit()
+    setup_logging()
+    coordinator = AsyncBerkeleyCoordinator(port=port, averaging=averaging, udp=transport_from_env(),
+                                           history=history_from_env(),
+                                           quorum=int(os.environ.get("BERKELEY_QUORUM", 1)))
+    start_metrics_server(coordinator.metrics)
+    coordinator.start()
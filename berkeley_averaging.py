@@ -0,0 +1,88 @@
+import numpy as np
+
+from berkeley_clock import divide, to_nanos
+
+# Motores de média sobre arrays de offsets (tempo do relógio - tempo de referência
+# do coordenador), a mesma aritmética usada em synchronize_clocks. Os offsets são
+# nanossegundos inteiros (int64) e as somas são exatas; os RTTs, usados só como
+# peso ou limite, ficam em segundos. Parâmetros de janela são dados em segundos.
+# Cada motor devolve (offset médio em ns inteiros, máscara booleana das amostras usadas).
+
+def _mean(offsets):
+    return divide(int(offsets.sum()), offsets.size)
+
+class MeanAveraging:
+    name = "mean"
+
+    def average(self, offsets, rtts=None):
+        offsets = np.asarray(offsets, dtype=np.int64)
+        return _mean(offsets), np.ones(offsets.shape, dtype=bool)
+
+# Média tolerante a falhas do algoritmo de Berkeley: descarta amostras fora de
+# uma janela em torno da mediana antes de calcular a média
+class FaultTolerantAveraging:
+    name = "berkeley"
+
+    def __init__(self, window=1.0):
+        self.window = window
+
+    def average(self, offsets, rtts=None):
+        offsets = np.asarray(offsets, dtype=np.int64)
+        median = round(float(np.median(offsets)))
+        used = np.abs(offsets - median) <= to_nanos(self.window)
+        if not used.any():
+            return median, used
+        return _mean(offsets[used]), used
+
+# Média aparada: ignora a fração trim das amostras em cada extremidade
+class TrimmedMeanAveraging:
+    name = "trimmed"
+
+    def __init__(self, trim=0.1):
+        if not 0 <= trim < 0.5:
+            raise ValueError("trim deve estar em [0, 0.5)")
+        self.trim = trim
+
+    def average(self, offsets, rtts=None):
+        offsets = np.asarray(offsets, dtype=np.int64)
+        n = offsets.size
+        k = int(n * self.trim)
+        if k == 0:
+            return _mean(offsets), np.ones(n, dtype=bool)
+
+        # argpartition é O(n): só os limites do corte precisam estar no lugar.
+        # A máscara vem dos próprios índices mantidos, de modo que valores
+        # empatados no corte contam exatamente como na média
+        kept = np.argpartition(offsets, (k, n - k - 1))[k:n - k]
+        used = np.zeros(n, dtype=bool)
+        used[kept] = True
+        return _mean(offsets[kept]), used
+
+# Média ponderada pelo inverso do RTT: amostras medidas com menor atraso de rede
+# têm menor incerteza e pesam mais. RTTs abaixo de rtt_floor são limitados a ele
+class InverseRTTWeightedAveraging:
+    name = "weighted"
+
+    def __init__(self, rtt_floor=1e-3):
+        self.rtt_floor = rtt_floor
+
+    def average(self, offsets, rtts=None):
+        offsets = np.asarray(offsets, dtype=np.int64)
+        if rtts is None:
+            return _mean(offsets), np.ones(offsets.shape, dtype=bool)
+        weights = 1.0 / np.maximum(np.asarray(rtts, dtype=np.float64), self.rtt_floor)
+        # Com os pesos normalizados o produto fica na escala dos offsets: erro
+        # abaixo de 1 ns enquanto eles ficarem abaixo de 2**53 ns (~104 dias)
+        return round(float(np.dot(weights / weights.sum(), offsets))), np.ones(offsets.shape, dtype=bool)
+
+ENGINES = {
+    engine.name: engine
+    for engine in (MeanAveraging, FaultTolerantAveraging, TrimmedMeanAveraging,
+                   InverseRTTWeightedAveraging)
+}
+
+def create_engine(name, **options):
+    engine = ENGINES.get(name)
+    if engine is None:
+        raise ValueError(f"Método de média desconhecido: {name} (opções: {', '.join(ENGINES)})")
+    return engine(**options)
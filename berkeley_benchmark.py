@@ -0,0 +1,493 @@
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import sys
+import threading
+import time
+
+import numpy as np
+
+from berkeley_async_coordinator import AsyncBerkeleyCoordinator, raise_file_limit
+from berkeley_averaging import create_engine
+from berkeley_clock import NANOS, MonotonicClock, to_nanos, to_seconds
+from berkeley_coordinator import BerkeleyCoordinator
+from berkeley_logging import setup_logging
+from berkeley_metrics import resident_memory
+from berkeley_protocol import PROTOCOL_VERSION, MessageDecoder, ProtocolError, decode_datagram, encode_message
+from berkeley_sharded import ShardedCoordinator
+from berkeley_udp import UdpProbeTransport
+
+log = logging.getLogger("berkeley.benchmark")
+
+# Benchmark do protocolo: milhares de clientes simulados em poucos processos
+# (um event loop asyncio por processo) contra um coordenador real, com latência,
+# jitter, atrasos esporádicos, offset e deriva configuráveis. As rodadas são
+# disparadas diretamente pelo benchmark, e o resultado (configuração, ambiente e
+# métricas) é salvo em JSON para comparação com execuções anteriores.
+
+# Métricas comparadas entre execuções: caminho no resultado e se maior é melhor
+COMPARED_METRICS = (
+    ("round_latency_seconds.p50", False),
+    ("round_latency_seconds.p99", False),
+    ("post_sync_spread_seconds.p50", False),
+    ("post_sync_spread_seconds.max", False),
+    ("cpu_seconds_per_client_round", False),
+    ("memory_bytes_per_client", False),
+    ("samples_per_second", True),
+)
+
+# Atraso de uma mensagem num sentido: latência + jitter uniforme + atraso
+# esporádico (com probabilidade spike_probability)
+class NetworkModel:
+    def __init__(self, latency=0.0, jitter=0.0, spike_probability=0.0, spike_delay=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.spike_probability = spike_probability
+        self.spike_delay = spike_delay
+        self.random = random.Random(seed)
+
+    def delay(self):
+        delay = self.latency
+        if self.jitter:
+            delay += self.random.uniform(0.0, self.jitter)
+        if self.spike_probability and self.random.random() < self.spike_probability:
+            delay += self.spike_delay
+        return delay
+
+    def max_delay(self):
+        return self.latency + self.jitter + (self.spike_delay if self.spike_probability else 0.0)
+
+# Cliente simulado: erro do relógio = offset + deriva * tempo decorrido + correções.
+# Os clientes de um processo compartilham o relógio base, ancorado na mesma época
+# do coordenador, de modo que o erro medido é só o simulado
+class SimulatedClient:
+    __slots__ = ('client_id', 'clock', 'offset', 'drift', 'correction', 'started', 'network',
+                 'reader', 'writer', 'task', 'datagrams')
+
+    def __init__(self, client_id, clock, offset, drift, network):
+        self.client_id = client_id
+        self.clock = clock
+        self.offset = offset
+        self.drift = drift
+        self.correction = 0.0
+        self.started = time.monotonic()
+        self.network = network
+        self.reader = None
+        self.writer = None
+        self.task = None
+        self.datagrams = None
+
+    def clock_error(self, now=None):
+        now = time.monotonic() if now is None else now
+        return self.offset + self.drift * (now - self.started) + self.correction
+
+    def get_current_time(self):
+        monotonic = time.monotonic_ns()
+        return self.clock.at(monotonic) + to_nanos(self.clock_error(monotonic / NANOS))
+
+    async def connect(self, host, port, udp=False):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.writer.write(encode_message({"type": "hello", "client_id": self.client_id, "role": "client"},
+                                         PROTOCOL_VERSION))
+        if udp:
+            loop = asyncio.get_running_loop()
+            self.datagrams, _ = await loop.create_datagram_endpoint(
+                lambda: SimulatedProbeProtocol(self), local_addr=(self.writer.get_extra_info('sockname')[0], 0))
+            self.writer.write(encode_message({"type": "udp_register",
+                                              "port": self.datagrams.get_extra_info('sockname')[1]},
+                                             PROTOCOL_VERSION))
+        self.task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        decoder = MessageDecoder()
+        try:
+            while True:
+                data = await self.reader.read(65536)
+                if not data:
+                    break
+                for message in decoder.feed(data):
+                    await self.handle_message(message)
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self.writer.close()
+            if self.datagrams is not None:
+                self.datagrams.close()
+
+    async def handle_message(self, message):
+        message_type = message.get("type")
+        delay = self.network.delay()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        if message_type == "time_request":
+            response = {"type": "time_response", "time": self.get_current_time(),
+                        "client_id": self.client_id, "seq": message.get("seq", 0)}
+            delay = self.network.delay()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.writer.write(encode_message(response, PROTOCOL_VERSION))
+        elif message_type == "time_adjustment":
+            self.correction += to_seconds(message.get("adjustment", 0))
+
+# Sondas UDP do cliente simulado: o atraso de ida e o de volta são agendados no
+# event loop, sem bloquear as demais sondas
+class SimulatedProbeProtocol(asyncio.DatagramProtocol):
+    def __init__(self, client):
+        self.client = client
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        try:
+            message = decode_datagram(data)
+        except ProtocolError:
+            return
+        if message.get("type") == "time_request":
+            loop = asyncio.get_running_loop()
+            loop.call_later(self.client.network.delay(), self.reply, message.get("seq", 0), address)
+
+    def reply(self, seq, address):
+        response = encode_message({"type": "time_response", "time": self.client.get_current_time(),
+                                   "client_id": self.client.client_id, "seq": seq}, PROTOCOL_VERSION)
+        asyncio.get_running_loop().call_later(self.client.network.delay(), self.send, response, address)
+
+    def send(self, response, address):
+        if not self.transport.is_closing():
+            self.transport.sendto(response, address)
+
+async def run_simulated_clients(host, port, worker_index, count, options, clock_base, control):
+    loop = asyncio.get_running_loop()
+    clock = MonotonicClock(base=clock_base)
+    rng = np.random.default_rng(options["seed"] + worker_index)
+    offsets = rng.uniform(-options["offset"], options["offset"], count)
+    drifts = rng.uniform(-options["drift"], options["drift"], count)
+
+    clients = []
+    for i in range(count):
+        network = NetworkModel(options["latency"], options["jitter"], options["spike_probability"],
+                               options["spike_delay"], seed=f"{options['seed']}-{worker_index}-{i}")
+        clients.append(SimulatedClient(f"Sim-{worker_index}-{i}", clock, float(offsets[i]), float(drifts[i]),
+                                       network))
+
+    # Conexões em lotes para não estourar o backlog do coordenador
+    connect_limit = asyncio.Semaphore(256)
+
+    async def connect(client):
+        async with connect_limit:
+            await client.connect(host, port, options["transport"] == "udp")
+
+    results = await asyncio.gather(*(connect(client) for client in clients), return_exceptions=True)
+    connected = [client for client, result in zip(clients, results) if result is None]
+    control.send(("ready", len(connected)))
+
+    while True:
+        command = await loop.run_in_executor(None, control.recv)
+        if command == "snapshot":
+            now = time.monotonic()
+            control.send(np.fromiter((client.clock_error(now) for client in connected
+                                      if not client.task.done()), dtype=np.float64))
+        elif command == "stop":
+            break
+
+    for client in connected:
+        client.task.cancel()
+    await asyncio.gather(*(client.task for client in connected), return_exceptions=True)
+
+def worker_main(host, port, worker_index, count, options, clock_base, control):
+    raise_file_limit()
+    asyncio.run(run_simulated_clients(host, port, worker_index, count, options, clock_base, control))
+    control.close()
+
+# Executa o coordenador escolhido (threads, asyncio ou processos com
+# SO_REUSEPORT) em segundo plano e expõe uma chamada síncrona para disparar cada
+# rodada
+class CoordinatorRunner:
+    def __init__(self, kind, probes_per_client, probe_timeout, averaging, backlog=4096, udp=None, shards=None):
+        if kind == "sharded":
+            self.coordinator = ShardedCoordinator(port=0, workers=shards, probes_per_client=probes_per_client,
+                                                  probe_timeout=probe_timeout, averaging=averaging,
+                                                  backlog=backlog, log_levels={"coordinator": "WARNING"})
+        elif kind == "async":
+            self.coordinator = AsyncBerkeleyCoordinator(port=0, round_timeout=probe_timeout, backlog=backlog,
+                                                        probes_per_client=probes_per_client,
+                                                        averaging=averaging, udp=udp)
+        else:
+            self.coordinator = BerkeleyCoordinator(port=0, probes_per_client=probes_per_client,
+                                                   probe_timeout=probe_timeout, averaging=averaging, udp=udp)
+        self.kind = kind
+        self.backlog = backlog
+        self.loop = None
+
+    @property
+    def port(self):
+        return self.coordinator.server_socket.getsockname()[1]
+
+    def start(self):
+        coordinator = self.coordinator
+        if self.kind == "sharded":
+            coordinator.launch()
+        elif self.kind == "async":
+            self.loop = asyncio.new_event_loop()
+            threading.Thread(target=self.loop.run_forever, daemon=True).start()
+            asyncio.run_coroutine_threadsafe(
+                asyncio.start_server(coordinator.handle_client_async, sock=coordinator.server_socket,
+                                     backlog=self.backlog), self.loop).result()
+        else:
+            coordinator.server_socket.listen(self.backlog)
+            threading.Thread(target=coordinator.accept_connections, daemon=True).start()
+
+    def connected(self):
+        if self.kind == "sharded":
+            return self.coordinator.connected()
+        return len(self.coordinator.registry)
+
+    def run_round(self):
+        if self.kind == "async":
+            return asyncio.run_coroutine_threadsafe(self.coordinator.synchronize_clocks_async(),
+                                                    self.loop).result()
+        return self.coordinator.synchronize_clocks()
+
+    def clock_error(self):
+        return float(self.coordinator.clock_offset)
+
+    # CPU e memória incluem os processos dos workers no modo sharded
+    def cpu_seconds(self):
+        if self.kind == "sharded":
+            self.coordinator.refresh_status()
+            return self.coordinator.cpu_seconds()
+        return time.process_time()
+
+    def memory_bytes(self):
+        if self.kind == "sharded":
+            self.coordinator.refresh_status()
+            return self.coordinator.memory_bytes()
+        return resident_memory()
+
+    def stop(self):
+        if self.kind == "sharded":
+            self.coordinator.stop()
+
+def percentiles(values):
+    values = np.asarray(values, dtype=np.float64)
+    if not values.size:
+        return {}
+    p50, p90, p99 = np.percentile(values, (50, 90, 99))
+    return {"p50": float(p50), "p90": float(p90), "p99": float(p99),
+            "mean": float(values.mean()), "max": float(values.max())}
+
+def snapshot_errors(workers, runner):
+    for _, control in workers:
+        control.send("snapshot")
+    errors = [control.recv() for _, control in workers]
+    errors.append(np.array([runner.clock_error()]))
+    return np.concatenate(errors)
+
+def run_benchmark(options):
+    random.seed(options["seed"])
+    averaging = create_engine(options["averaging"])
+    udp = UdpProbeTransport() if options["transport"] == "udp" else None
+    runner = CoordinatorRunner(options["coordinator"], options["probes"], options["probe_timeout"], averaging,
+                               udp=udp, shards=options["shards"])
+    runner.start()
+    baseline_memory = runner.memory_bytes()
+
+    context = multiprocessing.get_context("spawn")
+    workers = []
+    per_worker = np.array_split(np.arange(options["clients"]), options["workers"])
+    for worker_index, indices in enumerate(per_worker):
+        if not indices.size:
+            continue
+        control, child_control = context.Pipe()
+        process = context.Process(target=worker_main, daemon=True,
+                                  args=("localhost", runner.port, worker_index, int(indices.size),
+                                        options, runner.coordinator.clock.base, child_control))
+        process.start()
+        workers.append((process, control))
+
+    try:
+        connected = sum(control.recv()[1] for _, control in workers)
+        deadline = time.monotonic() + 30
+        while runner.connected() < connected and time.monotonic() < deadline:
+            time.sleep(0.05)
+        clients = runner.connected()
+        connected_memory = runner.memory_bytes()
+        log.info("[BENCHMARK] %d clientes simulados conectados (%s, sondas %s, %d processos)",
+                 clients, options["coordinator"], options["transport"], len(workers))
+
+        network = NetworkModel(options["latency"], options["jitter"], options["spike_probability"],
+                               options["spike_delay"])
+        settle = 2 * network.max_delay() + options["settle"]
+
+        latencies, responded, spread_before, spread_after, estimated = [], [], [], [], []
+        cpu_start = runner.cpu_seconds()
+        for round_index in range(options["rounds"]):
+            errors = snapshot_errors(workers, runner)
+            spread_before.append(float(errors.max() - errors.min()))
+
+            start = time.perf_counter()
+            spread, _ = runner.run_round()
+            latencies.append(time.perf_counter() - start)
+            estimated.append(spread)
+            responded.append(runner.coordinator.metrics.gauges.get(("clients_responded", ()), 0))
+
+            time.sleep(settle)
+            errors = snapshot_errors(workers, runner)
+            spread_after.append(float(errors.max() - errors.min()))
+            log.info("[BENCHMARK] Rodada %d: %.3fs, %d respostas, afastamento %.6fs -> %.6fs",
+                     round_index + 1, latencies[-1], responded[-1], spread_before[-1], spread_after[-1])
+
+            if options["interval"] > 0 and round_index + 1 < options["rounds"]:
+                time.sleep(options["interval"])
+        cpu_seconds = runner.cpu_seconds() - cpu_start
+    finally:
+        for process, control in workers:
+            try:
+                control.send("stop")
+            except OSError:
+                pass
+        for process, _ in workers:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        runner.stop()
+
+    total_latency = float(np.sum(latencies))
+    samples = float(np.sum(responded)) * options["probes"]
+    phases = {}
+    for entry in runner.coordinator.metrics.snapshot()["histograms"]:
+        if entry["name"] == "phase_duration_seconds" and entry["value"]["count"]:
+            phases[entry["labels"]["phase"]] = entry["value"]["sum"] / entry["value"]["count"]
+
+    memory_per_client = None
+    if baseline_memory is not None and connected_memory is not None and clients:
+        memory_per_client = (connected_memory - baseline_memory) / clients
+
+    return {
+        "config": options,
+        "environment": {
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "numpy": np.__version__,
+        },
+        "results": {
+            "clients_connected": clients,
+            "clients_responded": percentiles(responded),
+            "round_latency_seconds": percentiles(latencies),
+            "phase_mean_seconds": phases,
+            "spread_before_seconds": percentiles(spread_before),
+            "post_sync_spread_seconds": percentiles(spread_after),
+            "estimated_spread_seconds": percentiles(estimated),
+            "samples_per_second": samples / total_latency if total_latency else 0.0,
+            "cpu_seconds_per_round": cpu_seconds / max(1, options["rounds"]),
+            "cpu_seconds_per_client_round": cpu_seconds / max(1, options["rounds"] * clients),
+            "memory_bytes_per_client": memory_per_client,
+        },
+    }
+
+def lookup(results, path):
+    value = results
+    for key in path.split("."):
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    return value
+
+# Compara com uma execução anterior; regressões acima da tolerância (relativa)
+# são listadas e fazem o benchmark terminar com código 1
+def compare_results(current, baseline, tolerance):
+    regressions = []
+    changed = {key for key in current["config"] if current["config"][key] != baseline["config"].get(key)}
+    if changed:
+        log.warning("[BENCHMARK] Configuração diferente da execução base: %s", ", ".join(sorted(changed)))
+
+    log.info("[BENCHMARK] %-32s %14s %14s %9s", "Métrica", "Base", "Atual", "Variação")
+    for path, higher_is_better in COMPARED_METRICS:
+        new = lookup(current["results"], path)
+        old = lookup(baseline["results"], path)
+        if new is None or old is None:
+            continue
+        change = (new - old) / abs(old) if old else 0.0
+        worse = -change if higher_is_better else change
+        flag = " REGRESSÃO" if worse > tolerance else ""
+        log.info("[BENCHMARK] %-32s %14.6g %14.6g %+8.1f%%%s", path, old, new, change * 100, flag)
+        if flag:
+            regressions.append(path)
+    return regressions
+
+def print_summary(report):
+    results = report["results"]
+    log.info("[BENCHMARK] Clientes conectados: %d", results["clients_connected"])
+    for name in ("round_latency_seconds", "post_sync_spread_seconds", "spread_before_seconds",
+                 "estimated_spread_seconds"):
+        stats = results[name]
+        if stats:
+            log.info("[BENCHMARK] %-26s p50 %.6f  p90 %.6f  p99 %.6f  máx %.6f", name,
+                     stats["p50"], stats["p90"], stats["p99"], stats["max"])
+    for phase, duration in sorted(results["phase_mean_seconds"].items()):
+        log.info("[BENCHMARK] Fase %-10s média %.6fs", phase, duration)
+    log.info("[BENCHMARK] Amostras por segundo: %.0f", results["samples_per_second"])
+    log.info("[BENCHMARK] CPU do coordenador: %.6fs por rodada, %.2fµs por cliente por rodada",
+             results["cpu_seconds_per_round"], results["cpu_seconds_per_client_round"] * 1e6)
+    if results["memory_bytes_per_client"] is not None:
+        log.info("[BENCHMARK] Memória do coordenador: %.0f bytes por cliente", results["memory_bytes_per_client"])
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark do algoritmo de Berkeley com clientes simulados")
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=4, help="processos de clientes simulados")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--interval", type=float, default=1.0, help="pausa entre rodadas (s)")
+    parser.add_argument("--coordinator", choices=("threads", "async", "sharded"), default="threads")
+    parser.add_argument("--shards", type=int, help="processos do coordenador sharded (padrão: núcleos)")
+    parser.add_argument("--transport", choices=("tcp", "udp"), default="tcp", help="transporte das sondas")
+    parser.add_argument("--averaging", default="mean")
+    parser.add_argument("--probes", type=int, default=4, help="sondas por cliente")
+    parser.add_argument("--probe-timeout", type=float, default=5.0)
+    parser.add_argument("--latency", type=float, default=0.0, help="atraso fixo por sentido (s)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="jitter uniforme por sentido (s)")
+    parser.add_argument("--spike-probability", type=float, default=0.0)
+    parser.add_argument("--spike-delay", type=float, default=0.0, help="atraso esporádico (s)")
+    parser.add_argument("--offset", type=float, default=10.0, help="offset inicial máximo (s)")
+    parser.add_argument("--drift", type=float, default=1e-4, help="deriva máxima (s/s)")
+    parser.add_argument("--settle", type=float, default=0.1, help="espera extra após os ajustes (s)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="salva o resultado em JSON")
+    parser.add_argument("--compare", help="resultado JSON de uma execução anterior")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="regressão relativa tolerada")
+    args = parser.parse_args(argv)
+    if args.coordinator == "sharded" and args.transport == "udp":
+        parser.error("o coordenador sharded sonda apenas por TCP")
+    return args
+
+if __name__ == "__main__":
+    args = parse_args()
+    options = {key: value for key, value in vars(args).items()
+               if key not in ("output", "compare", "tolerance")}
+
+    raise_file_limit()
+    setup_logging(levels={"coordinator": "WARNING", "sharded": "WARNING", "benchmark": "INFO"})
+    report = run_benchmark(options)
+    print_summary(report)
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+        log.info("[BENCHMARK] Resultado salvo em %s", args.output)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare_results(report, json.load(baseline_file), args.tolerance)
+        if regressions:
+            log.warning("[BENCHMARK] Regressões: %s", ", ".join(regressions))
+            sys.exit(1)
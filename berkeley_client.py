@@ -1,129 +1,455 @@
+import os
+import select
 import socket
-import json
+import threading
 import time
 import random
-from datetime import datetime
 import sys
+import logging
+from collections import deque
+
+from berkeley_clock import NANOS, MonotonicClock, format_time, to_nanos, to_seconds
+from berkeley_logging import setup_logging
+from berkeley_metrics import OFFSET_BUCKETS, Metrics, start_metrics_server
+from berkeley_protocol import (LEGACY_JSON, PROTOCOL_VERSION, VERSION_BINARY_NS, ProtocolError, SocketStream,
+                               decode_datagram, encode_message)
+from berkeley_shm import ClockPublisher
+from berkeley_state import ClockStateFile
+from berkeley_udp import DATAGRAM_SIZE, open_multicast_socket, parse_multicast
+
+# Intervalo mínimo (s) entre o fim de um ajuste e a leitura seguinte para que o
+# resíduo entre na estimativa de deriva: abaixo disso o ruído da medição domina
+MIN_DRIFT_INTERVAL = 1.0
+
+log = logging.getLogger("berkeley.client")
+phase_log = logging.getLogger("berkeley.client.phases")
 
 class BerkeleyClient:
-    def __init__(self, host='localhost', port=5000, client_id=None):
+    def __init__(self, host='localhost', port=5000, client_id=None, protocol_version=PROTOCOL_VERSION,
+                 slew_window=None, max_slew_rate=0.5, drift_compensation=True, drift_history=8,
+                 max_drift_rate=5e-4, metrics=None, udp=False, multicast=None, shm_path=None,
+                 reconnect=True, reconnect_delay=0.05, max_reconnect_delay=2.0, state_path=None,
+                 state_half_life=3600.0):
         self.host = host
         self.port = port
-        self.client_id = client_id or f"Cliente-{random.randint(1000, 9999)}"
+        self.client_id = client_id
         self.clock_offset = random.randint(-10, 10)
+        self.protocol_version = protocol_version
+        
+        # Disciplina do relógio: a correção total é
+        #   clock_offset + drift_rate * (t - drift_reference) + parcela já aplicada do slew
+        # Com slew_window=None os ajustes são aplicados como degrau (comportamento original).
+        # A correção é pequena e fica em segundos; a leitura soma-a, em ns, ao
+        # relógio monotônico ancorado na época (ver berkeley_clock)
+        self.clock = MonotonicClock()
+        self.slew_window = slew_window
+        self.max_slew_rate = max_slew_rate
+        self.slew_amount = 0.0
+        self.slew_start = 0.0
+        self.slew_duration = 0.0
+        self.drift_compensation = drift_compensation
+        self.max_drift_rate = max_drift_rate
+        self.drift_rate = 0.0
+        self.drift_reference = time.monotonic()
+        self.drift_anchor = None  # Instante em que o último ajuste terminou de ser aplicado
+        self.adjustment_history = deque(maxlen=drift_history)  # (instante, taxa de deriva medida)
+        self.metrics = metrics or Metrics()
+        self.clock_lock = threading.Lock()  # A thread UDP lê o relógio em paralelo
+        
+        # Sondas por UDP: o socket unicast é registrado no coordenador; com
+        # multicast=(grupo, porta) as sondas do grupo também são atendidas
+        self.udp = udp
+        self.multicast = multicast
+        self.udp_socket = None
+        
+        # Parâmetros do relógio publicados em memória compartilhada para outros
+        # processos do host (ver berkeley_shm)
+        self.publisher = ClockPublisher(shm_path) if shm_path else None
+        self.last_sync = 0.0
+        
+        # Sem coordenador disponível (ainda não iniciado ou reiniciando), tenta de
+        # novo com espera exponencial e jitter em vez de encerrar
+        self.reconnect = reconnect
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        
+        # Estado salvo a cada ajuste e restaurado no início (ver berkeley_state)
+        self.state_file = ClockStateFile(state_path, state_half_life) if state_path else None
+        self.state_confidence = None  # Confiança no estado restaurado até o primeiro ajuste; None = sem estado pendente
+        if self.state_file is not None:
+            self.restore_state()
+        self.client_id = self.client_id or f"Cliente-{random.randint(1000, 9999)}"
+        
         self.socket = None
+        self.stream = None
         self.connected = False
+        self.connections = 0  # Conexões estabelecidas, incluindo reconexões
         self.running = True
     
     def get_current_time(self):
-        return time.time() + self.clock_offset
+        with self.clock_lock:
+            return self.read_clock(time.monotonic_ns())
+    
+    def read_clock(self, monotonic):
+        return self.clock.at(monotonic) + to_nanos(self.current_correction(monotonic / NANOS))
+    
+    def current_correction(self, now=None):
+        now = time.monotonic() if now is None else now
+        correction = self.clock_offset + self.drift_rate * (now - self.drift_reference)
+        if self.slew_amount:
+            progress = min(1.0, (now - self.slew_start) / self.slew_duration)
+            correction += self.slew_amount * progress
+        return correction
+    
+    def apply_adjustment(self, adjustment, now=None, reference=None):
+        # adjustment e reference em ns. reference: leitura deste relógio contra a
+        # qual o coordenador calculou o ajuste. A diferença para o tempo atual é
+        # o atraso de entrega, devolvido em segundos
+        with self.clock_lock:
+            monotonic = time.monotonic_ns() if now is None else to_nanos(now)
+            delay = 0.0
+            if reference is not None:
+                delay = to_seconds(max(0, self.read_clock(monotonic) - reference))
+            self._apply_adjustment(to_seconds(adjustment), monotonic / NANOS, delay)
+            self.last_sync = to_seconds(self.read_clock(monotonic))
+            self.state_confidence = None  # O estado restaurado foi substituído pelo ajuste
+            self.publish_clock()
+            return delay
     
-    def connect(self):
+    def publish_clock(self):
+        if self.publisher is not None:
+            self.publisher.publish(self.clock_offset, self.drift_rate, self.drift_reference,
+                                   self.slew_amount, self.slew_start, self.slew_duration,
+                                   self.last_sync, synchronized=bool(self.last_sync),
+                                   base=to_seconds(self.clock.base))
+    
+    def restore_state(self):
+        state = self.state_file.load()
+        if state is None:
+            return
+        if self.client_id and state["client_id"] != self.client_id:
+            log.warning("[%s] Estado em %s pertence a %s; ignorado", self.client_id,
+                        self.state_file.path, state["client_id"])
+            return
+        
+        self.client_id = state["client_id"]
+        self.clock_offset = state["correction"]
+        self.drift_rate = state["drift_rate"]
+        self.drift_reference = time.monotonic()
+        self.adjustment_history.extend(state["history"])
+        self.last_sync = state["last_sync"]
+        self.state_confidence = state["confidence"]
+        self.metrics.set_gauge("state_confidence", self.state_confidence)
+        log.info("[%s] Estado restaurado: offset %+.6fs, deriva %+.3f ppm, última sincronização há %.0fs "
+                 "(confiança %.2f)", self.client_id, self.clock_offset, self.drift_rate * 1e6,
+                 state["age"], self.state_confidence)
+    
+    def checkpoint(self):
+        if self.state_file is None:
+            return
+        with self.clock_lock:
+            now = time.monotonic()
+            # Correção alvo: o slew em andamento entra inteiro, pois o processo
+            # reiniciado não o continua (a correção restaurada vale como degrau)
+            target = self.clock_offset + self.drift_rate * (now - self.drift_reference) + self.slew_amount
+            snapshot = (target, self.drift_rate, self.last_sync,
+                        list(self.adjustment_history), now)
+        try:
+            self.state_file.save(self.client_id, *snapshot)
+        except OSError as e:
+            log.warning("[%s] Falha ao salvar estado em %s: %s", self.client_id, self.state_file.path, e)
+            self.metrics.inc("errors_total", kind="state")
+    
+    def _apply_adjustment(self, adjustment, now, delay=0.0):
+        correction = self.current_correction(now)
+        
+        # O ajuste vale para o instante da leitura, não para o da entrega
+        measured = max(now - delay, self.drift_reference)
+        
+        previous_rate = self.drift_rate
+        if self.drift_compensation:
+            self.record_drift_sample(adjustment, measured)
+            self.drift_rate = self.estimate_drift_rate()
+        # A deriva acumulada entre a leitura e a entrega, com a nova estimativa
+        adjustment += (self.drift_rate - previous_rate) * (now - measured)
+        
+        # A nova reta de deriva parte da correção atual, sem saltos
+        self.drift_reference = now
+        if self.slew_window:
+            # O slew nunca pode fazer o relógio andar para trás: a taxa de
+            # correção é limitada por max_slew_rate (< 1)
+            self.clock_offset = correction
+            self.slew_amount = adjustment
+            self.slew_start = now
+            self.slew_duration = max(self.slew_window, abs(adjustment) / self.max_slew_rate)
+            self.drift_anchor = now + self.slew_duration
+        else:
+            self.clock_offset = correction + adjustment
+            self.slew_amount = 0.0
+            self.drift_anchor = now
+    
+    def record_drift_sample(self, adjustment, measured):
+        # Resíduo do próprio cliente: um relógio que, aplicado o ajuste anterior
+        # por inteiro, precisa de +a depois de T segundos atrasa a/T por segundo
+        # além da taxa já compensada. Regredir a correção total sobre o tempo
+        # confundiria um salto da média do grupo com deriva
+        if self.drift_anchor is None or measured < self.drift_anchor:
+            return  # Primeiro ajuste, ou leitura feita com o slew em andamento
+        elapsed = measured - self.drift_anchor
+        if elapsed < MIN_DRIFT_INTERVAL:
+            return
+        residual = adjustment / elapsed
+        if abs(residual) > self.max_drift_rate:
+            # Nenhuma deriva plausível explica o ajuste: a média do grupo mudou
+            # (cliente novo, relógio restaurado) e as amostras anteriores medem
+            # outra referência
+            self.adjustment_history.clear()
+            return
+        self.adjustment_history.append((measured, self.drift_rate + residual))
+    
+    def estimate_drift_rate(self):
+        # Mediana das taxas medidas: um salto moderado da média que ainda caiba
+        # em max_drift_rate afeta uma amostra, não a estimativa
+        if len(self.adjustment_history) < 3:
+            return self.drift_rate
+        
+        rates = sorted(rate for _, rate in self.adjustment_history)
+        middle = len(rates) // 2
+        rate = rates[middle] if len(rates) % 2 else (rates[middle - 1] + rates[middle]) / 2
+        return max(-self.max_drift_rate, min(self.max_drift_rate, rate))
+    
+    def connect(self, quiet=False):
         try:
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.socket.connect((self.host, self.port))
+            self.stream = SocketStream(self.socket, self.protocol_version, adaptive=False)
+            if self.protocol_version != LEGACY_JSON:
+                # Anuncia a versão do protocolo antes da primeira solicitação
+                # Com estado restaurado ainda não confirmado por um ajuste, anuncia a
+                # confiança: o coordenador decide se o relógio entra na média
+                self.stream.send_message({"type": "hello", "client_id": self.client_id,
+                                          "confidence": self.state_confidence})
+            if self.udp:
+                self.open_udp()
+            with self.clock_lock:
+                self.publish_clock()
+            if not self.connections:
+                self.print_header()
+                log.info("[%s] Relógio inicial: %s", self.client_id, self.format_time(self.get_current_time()))
+                log.info("[%s] Offset inicial: %+.2fs (%s)", self.client_id, self.clock_offset,
+                         "estado restaurado" if self.state_confidence is not None else "deslocamento aleatório")
+                phase_log.info("=" * 80)
+            else:
+                log.info("[%s] Reconectado ao coordenador", self.client_id)
             self.connected = True
-            self.print_header()
-            print(f"[{self.client_id}] Relógio inicial: {self.format_time(self.get_current_time())}")
-            print(f"[{self.client_id}] Offset inicial: {self.clock_offset:+.2f}s (deslocamento aleatório)")
-            print("=" * 80)
+            self.connections += 1
             return True
         except Exception as e:
-            print(f"[ERRO] Erro ao conectar ao coordenador: {e}")
+            if self.socket:
+                self.socket.close()
+            if quiet:
+                log.debug("[%s] Coordenador indisponível: %s", self.client_id, e)
+            else:
+                log.error("[ERRO] Erro ao conectar ao coordenador: %s", e)
             return False
     
+    def connect_with_backoff(self):
+        if not self.reconnect:
+            return self.connect()
+        
+        delay = self.reconnect_delay
+        attempt = 0
+        while self.running:
+            if self.connect(quiet=True):
+                return True
+            if attempt == 0:
+                log.warning("[%s] Coordenador indisponível em %s:%d; tentando novamente com espera exponencial...",
+                            self.client_id, self.host, self.port)
+            attempt += 1
+            self.metrics.inc("reconnect_attempts_total")
+            time.sleep(delay * random.uniform(0.5, 1.0))
+            delay = min(self.max_reconnect_delay, delay * 2)
+        return False
+    
+    def open_udp(self):
+        self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_socket.bind((self.socket.getsockname()[0], 0))
+        sockets = [self.udp_socket]
+        if self.multicast:
+            sockets.append(open_multicast_socket(*self.multicast))
+        
+        udp_thread = threading.Thread(target=self.serve_udp, args=(sockets,))
+        udp_thread.daemon = True
+        udp_thread.start()
+        self.stream.send_message({"type": "udp_register", "port": self.udp_socket.getsockname()[1]})
+        log.info("[%s] Sondas UDP na porta %d%s", self.client_id, self.udp_socket.getsockname()[1],
+                 " (multicast %s:%d)" % self.multicast if self.multicast else "")
+    
+    def serve_udp(self, sockets):
+        # Responde sempre pelo socket unicast registrado, mesmo às sondas multicast
+        try:
+            while self.running:
+                readable, _, _ = select.select(sockets, [], [], 1.0)
+                for sock in readable:
+                    data, address = sock.recvfrom(DATAGRAM_SIZE)
+                    try:
+                        message = decode_datagram(data)
+                    except ProtocolError:
+                        continue
+                    if message.get("type") != "time_request":
+                        continue
+                    response = {"type": "time_response", "time": self.get_current_time(),
+                                "client_id": self.client_id, "seq": message.get("seq", 0)}
+                    self.udp_socket.sendto(encode_message(response, VERSION_BINARY_NS), address)
+                    self.metrics.inc("time_requests_total")
+        except (OSError, ValueError):
+            pass  # Socket fechado ao encerrar
+        finally:
+            for sock in sockets:
+                sock.close()
+    
     def print_header(self):
-        print("\n" + "=" * 80)
-        print(f"| ALGORITMO DE BERKELEY - CLIENTE: {self.client_id} |".center(80))
-        print("=" * 80)
+        phase_log.info("\n" + "=" * 80)
+        phase_log.info(f"| ALGORITMO DE BERKELEY - CLIENTE: {self.client_id} |".center(80))
+        phase_log.info("=" * 80)
     
     def start(self):
-        if not self.connect():
-            return
-        
+        # O relógio continua disciplinado entre conexões; com reconnect=True uma
+        # conexão perdida é restabelecida com a mesma espera exponencial
+        while self.running:
+            if not self.connect_with_backoff():
+                return
+            self.serve()
+            if not self.reconnect:
+                return
+    
+    def serve(self):
         try:
             while self.running:
                 try:
-                    data = self.socket.recv(1024)
-                    if not data:
-                        print(f"[{self.client_id}] Conexão com o coordenador perdida")
+                    message = self.stream.recv_message()
+                    if message is None:
+                        log.warning("[%s] Conexão com o coordenador perdida", self.client_id)
                         break
                     
-                    self.handle_message(data)
+                    self.handle_message(message)
                 except socket.timeout:
                     continue
                 except Exception as e:
-                    print(f"[{self.client_id}] Erro ao receber mensagem: {e}")
+                    if not self.running:
+                        break
+                    log.error("[%s] Erro ao receber mensagem: %s", self.client_id, e)
+                    self.metrics.inc("errors_total", kind="receive")
                     break
         finally:
+            self.connected = False
             if self.socket:
                 self.socket.close()
-            print(f"[{self.client_id}] Desconectado")
+            if self.udp_socket:
+                self.udp_socket.close()
+            log.info("[%s] Desconectado", self.client_id)
     
-    def handle_message(self, data):
-        message = json.loads(data.decode('utf-8'))
+    def handle_message(self, message):
         message_type = message.get("type")
         
         if message_type == "time_request":
             current_time = self.get_current_time()
-            print("\n" + "=" * 80)
-            print(f"| {self.client_id} - SOLICITAÇÃO DE TEMPO RECEBIDA |".center(80))
-            print("=" * 80)
-            
-            print(f"[{self.client_id}] Recebida solicitação de tempo do coordenador")
-            print(f"[{self.client_id}] Tempo atual: {self.format_time(current_time)}")
-            print(f"[{self.client_id}] Offset atual: {self.clock_offset:+.2f}s")
             
-            response = json.dumps({
+            response = {
                 "type": "time_response",
                 "time": current_time,
                 "client_id": self.client_id
-            })
-            self.socket.send(response.encode('utf-8'))
-            print(f"[{self.client_id}] Enviando resposta ao coordenador: {self.format_time(current_time)}")
+            }
+            # Ecoa o número da sonda para o coordenador casar a resposta
+            if "seq" in message:
+                response["seq"] = message["seq"]
+            self.stream.send_message(response)
+            self.metrics.inc("time_requests_total")
+            
+            # A resposta sai antes de qualquer saída, para não atrasar a sonda
+            if phase_log.isEnabledFor(logging.INFO):
+                phase_log.info("\n" + "=" * 80)
+                phase_log.info(f"| {self.client_id} - SOLICITAÇÃO DE TEMPO RECEBIDA |".center(80))
+                phase_log.info("=" * 80)
+                phase_log.info("[%s] Recebida solicitação de tempo do coordenador", self.client_id)
+                phase_log.info("[%s] Tempo atual: %s", self.client_id, self.format_time(current_time))
+                phase_log.info("[%s] Offset atual: %+.2fs", self.client_id, self.current_correction())
+                phase_log.info("[%s] Enviando resposta ao coordenador: %s", self.client_id,
+                               self.format_time(current_time))
             
         elif message_type == "time_adjustment":
-            adjustment = message.get("adjustment")
+            nanos = message.get("adjustment")
+            adjustment = to_seconds(nanos)
             old_time = self.get_current_time()
+            old_correction = self.current_correction()
             
-            print("\n" + "=" * 80)
-            print(f"| {self.client_id} - AJUSTE DE RELÓGIO RECEBIDO |".center(80))
-            print("=" * 80)
-            
-            print("\nPROCESSO DE AJUSTE DO RELÓGIO:")
-            print("-" * 80)
-            print(f"[{self.client_id}] Tempo antes do ajuste: {self.format_time(old_time)}")
-            print(f"[{self.client_id}] Offset antes do ajuste: {self.clock_offset:+.2f}s")
-            print(f"[{self.client_id}] Ajuste recebido do coordenador: {adjustment:+.2f}s")
-            
-            self.clock_offset += adjustment
+            delay = self.apply_adjustment(nanos, reference=message.get("reference"))
             new_time = self.get_current_time()
+            self.checkpoint()
             
-            print(f"[{self.client_id}] Novo offset do relógio: {self.clock_offset:+.2f}s")
-            print(f"[{self.client_id}] Tempo após ajuste: {self.format_time(new_time)}")
+            self.metrics.inc("adjustments_total")
+            self.metrics.observe("adjustment_abs_seconds", abs(adjustment), OFFSET_BUCKETS)
+            self.metrics.set_gauge("last_adjustment_seconds", adjustment)
+            self.metrics.observe("adjustment_delay_seconds", delay)
+            self.metrics.set_gauge("drift_rate", self.drift_rate)
+            self.metrics.set_gauge("last_sync_timestamp_seconds", time.time())
+            log.info("[%s] Ajuste de %+.6fs recebido do coordenador (atraso %.3fms, deriva estimada %+.3f ppm)",
+                     self.client_id, adjustment, delay * 1000, self.drift_rate * 1e6,
+                     extra={"fields": {"event": "adjustment", "client_id": self.client_id,
+                                       "adjustment": adjustment, "delay": delay, "drift_rate": self.drift_rate,
+                                       "slew": bool(self.slew_window)}})
             
-            print("\nRESUMO DO AJUSTE:")
-            print("-" * 80)
-            print(f"Tempo antes: {self.format_time(old_time)}")
-            print(f"Ajuste aplicado: {adjustment:+.2f} segundos")
-            print(f"Tempo após: {self.format_time(new_time)}")
-            print("=" * 80)
+            if phase_log.isEnabledFor(logging.INFO):
+                phase_log.info("\n" + "=" * 80)
+                phase_log.info(f"| {self.client_id} - AJUSTE DE RELÓGIO RECEBIDO |".center(80))
+                phase_log.info("=" * 80)
+                
+                phase_log.info("\nPROCESSO DE AJUSTE DO RELÓGIO:")
+                phase_log.info("-" * 80)
+                phase_log.info("[%s] Tempo antes do ajuste: %s", self.client_id, self.format_time(old_time))
+                phase_log.info("[%s] Offset antes do ajuste: %+.2fs", self.client_id, old_correction)
+                phase_log.info("[%s] Ajuste recebido do coordenador: %+.2fs", self.client_id, adjustment)
+                if self.slew_window:
+                    phase_log.info("[%s] Ajuste aplicado gradualmente em %.2fs (slew)",
+                                   self.client_id, self.slew_duration)
+                    phase_log.info("[%s] Offset alvo do relógio: %+.2fs", self.client_id,
+                                   self.clock_offset + adjustment)
+                else:
+                    phase_log.info("[%s] Novo offset do relógio: %+.2fs", self.client_id, self.clock_offset)
+                phase_log.info("[%s] Deriva estimada: %+.3f ppm", self.client_id, self.drift_rate * 1e6)
+                phase_log.info("[%s] Tempo após ajuste: %s", self.client_id, self.format_time(new_time))
+                
+                phase_log.info("\nRESUMO DO AJUSTE:")
+                phase_log.info("-" * 80)
+                phase_log.info("Tempo antes: %s", self.format_time(old_time))
+                phase_log.info("Ajuste aplicado: %+.2f segundos", adjustment)
+                phase_log.info("Tempo após: %s", self.format_time(new_time))
+                phase_log.info("=" * 80)
     
     def stop(self):
         self.running = False
+        self.checkpoint()
         if self.socket:
             self.socket.close()
     
     @staticmethod
     def format_time(timestamp):
-        return datetime.fromtimestamp(timestamp).strftime('%H:%M:%S.%f')[:-3]
+        return format_time(timestamp)
 
 if __name__ == "__main__":
     client_id = sys.argv[1] if len(sys.argv) > 1 else None
+    slew_window = float(sys.argv[2]) if len(sys.argv) > 2 else None
     
-    client = BerkeleyClient(client_id=client_id)
+    setup_logging()
+    client = BerkeleyClient(client_id=client_id, slew_window=slew_window,
+                            udp=os.environ.get("BERKELEY_TRANSPORT", "tcp") == "udp",
+                            multicast=parse_multicast(os.environ.get("BERKELEY_MULTICAST")),
+                            shm_path=os.environ.get("BERKELEY_SHM_PATH"),
+                            state_path=os.environ.get("BERKELEY_STATE_PATH"))
+    # Variável própria: vários clientes no mesmo host não disputam a porta do coordenador
+    start_metrics_server(client.metrics, variable="BERKELEY_CLIENT_METRICS_PORT")
     try:
         client.start()
     except KeyboardInterrupt:
-        print("Cliente encerrado pelo usuário")
+        log.info("Cliente encerrado pelo usuário")
         client.stop()
\ No newline at end of file
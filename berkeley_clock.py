@@ -0,0 +1,46 @@
+import time
+from datetime import datetime
+
+# Modelo de tempo em nanossegundos inteiros. Cada relógio lê o monotônico do
+# host (time.monotonic_ns) e soma uma âncora de época lida uma única vez, de
+# modo que ajustes ou saltos do relógio de parede depois do início não afetam
+# a leitura. Os instantes trafegam no protocolo e entram na média como inteiros:
+# diferenças entre instantes de época (~1.7e18 ns) são exatas, ao contrário de
+# floats em segundos, que nessa magnitude já perdem a casa dos décimos de
+# microssegundo. Segundos em float ficam apenas para exibição e métricas.
+
+NANOS = 1_000_000_000
+
+def to_nanos(seconds):
+    return round(seconds * NANOS)
+
+def to_seconds(nanos):
+    return nanos / NANOS
+
+def divide(total, count):
+    # Divisão inteira arredondada ao mais próximo, sem passar por float
+    return (2 * total + count) // (2 * count)
+
+def format_time(nanos):
+    # Apenas para exibição: HH:MM:SS.mmm no fuso local
+    seconds, remainder = divmod(nanos, NANOS)
+    return f"{datetime.fromtimestamp(seconds).strftime('%H:%M:%S')}.{remainder // 1_000_000:03d}"
+
+class MonotonicClock:
+    __slots__ = ('base', 'offset')
+
+    def __init__(self, offset=0, base=None):
+        # base: tempo de parede - monotônico no início (ns); offset: deslocamento
+        # do relógio simulado (ns)
+        self.base = time.time_ns() - time.monotonic_ns() if base is None else base
+        self.offset = offset
+
+    def now(self):
+        return time.monotonic_ns() + self.base + self.offset
+
+    def at(self, monotonic):
+        # Leitura do relógio no instante monotônico dado (ns)
+        return monotonic + self.base + self.offset
+
+    def adjust(self, delta):
+        self.offset += delta
@@ -1,292 +1,704 @@
+import os
+import selectors
 import socket
 import threading
 import time
 import random
-import json
-from datetime import datetime
+import queue
+import logging
+import sys
+
+import numpy as np
+
+from berkeley_averaging import MeanAveraging, create_engine
+from berkeley_clock import NANOS, MonotonicClock, divide, format_time, to_seconds
+from berkeley_history import history_from_env
+from berkeley_logging import setup_logging
+from berkeley_metrics import OFFSET_BUCKETS, Metrics, start_metrics_server
+from berkeley_protocol import SocketStream, encode_message
+from berkeley_registry import ClientRegistry, ClientState
+from berkeley_scheduler import AdaptiveScheduler
+from berkeley_udp import transport_from_env
+
+log = logging.getLogger("berkeley.coordinator")
+phase_log = logging.getLogger("berkeley.coordinator.phases")
+
+# Envio sem bloquear: o socket continua bloqueante para a thread de leitura.
+# Sem MSG_DONTWAIT (Windows), send() bloqueia; setblocking(False) não serve,
+# pois o modo vale para o socket inteiro e quebraria o recv da outra thread.
+# Nesse caso send_frames só envia depois que o seletor indica espaço no buffer,
+# e um quadro maior que o espaço livre ainda pode bloquear até ser aceito
+SEND_FLAGS = getattr(socket, "MSG_DONTWAIT", 0)
+
+class ClientConnection(SocketStream, ClientState):
+    __slots__ = ('address', 'responses') + ClientState.STATE_SLOTS
+    
+    def __init__(self, sock, address):
+        super().__init__(sock)
+        self.init_state()
+        self.address = address
+        self.responses = queue.Queue()
+
+# Estimativa de Cristian: dentre as sondas (envio, tempo do cliente, recebimento),
+# usa a de menor RTT e assume que o cliente leu o relógio no meio do trajeto.
+# O erro da estimativa é limitado a ±RTT/2. Instantes e offset em ns inteiros;
+# RTT e incerteza em segundos
+def estimate_offset(samples):
+    send_time, client_time, receive_time = min(samples, key=lambda sample: sample[2] - sample[0])
+    rtt = receive_time - send_time
+    offset = client_time - send_time - rtt // 2
+    return offset, rtt / NANOS, rtt / (2 * NANOS)
+
+# Soma e contagem dos offsets dos grupos de subcoordenadores, convertidos para a
+# referência deste coordenador: cada membro está a (offset do subcoordenador +
+# offset do membro em relação ao subcoordenador)
+def combine_groups(client_responses, reference_time):
+    total, count = 0, 0
+    min_offset, max_offset = None, None
+    for client, client_time, _ in client_responses:
+        if client.group is None:
+            continue
+        group_sum, group_count, group_min, group_max = client.group
+        if not group_count:
+            continue
+        offset = client_time - reference_time
+        total += group_count * offset + group_sum
+        count += group_count
+        min_offset = offset + group_min if min_offset is None else min(min_offset, offset + group_min)
+        max_offset = offset + group_max if max_offset is None else max(max_offset, offset + group_max)
+    return total, count, min_offset, max_offset
+
+# Envia quadros já codificados a várias conexões ao mesmo tempo: cada socket
+# recebe o que couber no seu buffer sem bloquear, e o restante é escrito quando
+# o selector o indica como gravável. Um cliente lento não atrasa os demais.
+# Devolve {conexão: True se parte do quadro já foi enviada} para quem não
+# terminou no prazo e [(conexão, erro)] para as falhas
+def send_frames(frames, deadline):
+    pending = {}
+    failed = []
+    for connection, frame in frames:
+        if not SEND_FLAGS:
+            pending[connection] = (memoryview(frame), False)
+            continue
+        try:
+            sent = connection.socket.send(frame, SEND_FLAGS)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError as e:
+            failed.append((connection, e))
+            continue
+        if sent < len(frame):
+            pending[connection] = (memoryview(frame)[sent:], sent > 0)
+    
+    if pending:
+        with selectors.DefaultSelector() as selector:
+            for connection in list(pending):
+                try:
+                    selector.register(connection.socket, selectors.EVENT_WRITE, connection)
+                except (ValueError, OSError) as e:
+                    # Socket fechado pela thread da conexão nesse meio-tempo
+                    failed.append((connection, e))
+                    del pending[connection]
+            while pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                for key, _ in selector.select(remaining):
+                    connection = key.data
+                    data, _ = pending[connection]
+                    try:
+                        sent = connection.socket.send(data, SEND_FLAGS)
+                    except (BlockingIOError, InterruptedError):
+                        continue
+                    except OSError as e:
+                        failed.append((connection, e))
+                        sent = len(data)
+                    if sent < len(data):
+                        pending[connection] = (data[sent:], True)
+                    else:
+                        del pending[connection]
+                        selector.unregister(connection.socket)
+    
+    return {connection: partial for connection, (_, partial) in pending.items()}, failed
+
+# Avisa que o coordenador já aceita conexões: pelo pipe herdado em
+# BERKELEY_READY_FD (ex.: run_system.py) e, sob systemd (Type=notify), pelo
+# NOTIFY_SOCKET
+def notify_ready(port):
+    ready_fd = os.environ.pop("BERKELEY_READY_FD", None)
+    if ready_fd:
+        try:
+            os.write(int(ready_fd), f"READY {port}\n".encode('ascii'))
+            os.close(int(ready_fd))
+        except (OSError, ValueError) as e:
+            log.warning("[COORDENADOR] Falha ao sinalizar prontidão em BERKELEY_READY_FD: %s", e)
+    
+    notify_socket = os.environ.get("NOTIFY_SOCKET")
+    if notify_socket and hasattr(socket, "AF_UNIX"):
+        address = "\0" + notify_socket[1:] if notify_socket.startswith("@") else notify_socket
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+                sock.sendto(f"READY=1\nSTATUS=Escutando na porta {port}".encode('utf-8'), address)
+        except OSError as e:
+            log.warning("[COORDENADOR] Falha ao notificar o systemd: %s", e)
 
 class BerkeleyCoordinator:
-    def __init__(self, host='localhost', port=5000):
+    def __init__(self, host='localhost', port=5000, probes_per_client=4, probe_timeout=5.0, averaging=None,
+                 aggregate_timeout=10.0, scheduler=None, metrics=None, udp=None, adjustment_timeout=1.0,
+                 history=None, quorum=1, startup_timeout=5.0, reuse_port=False, trust_confidence=0.9):
         self.host = host
         self.port = port
-        self.clients = [] 
-        self.clock_offset = random.randint(-10, 10) 
+        self.metrics = metrics or Metrics()
+        self.scheduler = scheduler or AdaptiveScheduler()
+        self.round_requested = threading.Event()
+        self.averaging = averaging or MeanAveraging()
+        self.probes_per_client = probes_per_client
+        self.probe_timeout = probe_timeout
+        self.aggregate_timeout = aggregate_timeout
+        self.adjustment_timeout = adjustment_timeout  # Prazo de envio do ajuste a cada cliente
+        self.udp = udp  # UdpProbeTransport opcional para as sondas de tempo
+        self.history = history  # RoundHistoryWriter opcional (berkeley_history)
+        # Clientes retomados de estado salvo com confiança abaixo disso ficam fora
+        # da média até receberem o primeiro ajuste (ver ClientState.trusted)
+        self.trust_confidence = trust_confidence
+        # A primeira rodada começa assim que 'quorum' clientes se conectam, ou ao
+        # fim de startup_timeout com quem estiver conectado
+        self.quorum = quorum
+        self.startup_timeout = startup_timeout
+        self.registry = ClientRegistry()
+        self.clock = MonotonicClock(random.randint(-10, 10) * NANOS)
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            # Vários processos escutando na mesma porta (ver berkeley_sharded)
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.server_socket.bind((self.host, self.port))
-        self.lock = threading.Lock()
         
     def get_current_time(self):
-        return time.time() + self.clock_offset
+        return self.clock.now()
+    
+    @property
+    def clock_offset(self):
+        # Deslocamento do relógio em segundos, para exibição
+        return to_seconds(self.clock.offset)
     
     def start(self):
-        self.server_socket.listen(5)
+        self.server_socket.listen(128)
         self.print_header()
-        print(f"[COORDENADOR] Relógio inicial: {self.format_time(self.get_current_time())}")
-        print(f"[COORDENADOR] Offset inicial: {self.clock_offset:+.2f}s (deslocamento aleatório)")
-        print("=" * 80)
         
         accept_thread = threading.Thread(target=self.accept_connections)
         accept_thread.daemon = True
         accept_thread.start()
         
-        print("[COORDENADOR] Aguardando conexões de clientes por 5 segundos...")
-        time.sleep(5)
+        self.announce_ready()
+        self.wait_for_quorum()
         
         try:
             while True:
-                with self.lock:
-                    num_clients = len(self.clients)
+                num_clients = len(self.registry)
                 
                 if num_clients > 0:
-                    print(f"\n[COORDENADOR] {num_clients} clientes conectados. Iniciando sincronização...")
-                    self.synchronize_clocks()
-                    print(f"[COORDENADOR] Próxima sincronização em 20 segundos...")
-                    time.sleep(20) 
+                    log.info("[COORDENADOR] %d clientes conectados. Iniciando sincronização...", num_clients)
+                    self.round_requested.clear()
+                    spread, error = self.synchronize_clocks()
+                    interval = self.scheduler.record_round(spread, error)
+                    self.metrics.set_gauge("next_round_interval_seconds", interval)
+                    log.info("[COORDENADOR] Próxima sincronização em %.1f segundos...", interval)
+                    self.wait_for_next_round(interval)
                 else:
-                    print("[COORDENADOR] Aguardando clientes para iniciar sincronização...")
-                    time.sleep(5)
+                    log.info("[COORDENADOR] Aguardando clientes para iniciar sincronização...")
+                    self.wait_for_next_round(5)
         except KeyboardInterrupt:
-            print("[COORDENADOR] Encerrado pelo usuário")
+            log.info("[COORDENADOR] Encerrado pelo usuário")
             self.server_socket.close()
     
+    def announce_ready(self):
+        port = self.server_socket.getsockname()[1]
+        notify_ready(port)
+        log.info("[COORDENADOR] Pronto: escutando em %s:%d. Aguardando %d cliente(s) (no máximo %.1fs)...",
+                 self.host, port, self.quorum, self.startup_timeout)
+    
+    def wait_for_quorum(self):
+        # Cada nova conexão sinaliza round_requested
+        deadline = time.monotonic() + self.startup_timeout
+        while len(self.registry) < self.quorum:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                log.info("[COORDENADOR] Quórum não atingido em %.1fs; seguindo com %d cliente(s)",
+                         self.startup_timeout, len(self.registry))
+                break
+            self.round_requested.wait(remaining)
+            self.round_requested.clear()
+    
+    def wait_for_next_round(self, interval):
+        # Um novo cliente antecipa a rodada, respeitando o intervalo mínimo
+        if self.round_requested.wait(interval):
+            self.round_requested.clear()
+            time.sleep(self.scheduler.early_round_delay())
+    
+    def request_early_round(self):
+        self.round_requested.set()
+    
     def print_header(self):
-        print("\n" + "=" * 80)
-        print("| ALGORITMO DE BERKELEY - COORDENADOR |".center(80))
-        print("=" * 80)
+        phase_log.info("\n" + "=" * 80)
+        phase_log.info("| ALGORITMO DE BERKELEY - COORDENADOR |".center(80))
+        phase_log.info("=" * 80)
+        log.info("[COORDENADOR] Relógio inicial: %s", self.format_time(self.get_current_time()))
+        log.info("[COORDENADOR] Offset inicial: %+.2fs (deslocamento aleatório)", self.clock_offset)
+        phase_log.info("=" * 80)
     
     def accept_connections(self):
         while True:
             try:
                 client_socket, address = self.server_socket.accept()
-                print(f"[COORDENADOR] Nova conexão de {address[0]}:{address[1]}")
+                log.info("[COORDENADOR] Nova conexão de %s:%s", address[0], address[1])
                 
-                with self.lock:
-                    self.clients.append(client_socket)
-                    num_clients = len(self.clients)
+                connection = ClientConnection(client_socket, address)
+                num_clients = self.registry.add(connection)
+                self.metrics.set_gauge("clients_connected", num_clients)
                 
-                print(f"[COORDENADOR] Total de clientes conectados: {num_clients}")
+                log.info("[COORDENADOR] Total de clientes conectados: %d", num_clients)
+                self.request_early_round()
                 
                 client_thread = threading.Thread(target=self.handle_client,
-                                               args=(client_socket, address))
+                                               args=(connection, address))
                 client_thread.daemon = True
                 client_thread.start()
             except Exception as e:
-                print(f"[ERRO] Falha ao aceitar conexão: {e}")
+                log.error("[ERRO] Falha ao aceitar conexão: %s", e)
+                self.metrics.inc("errors_total", kind="accept")
                 break
     
-    def handle_client(self, client_socket, address):
+    def handle_client(self, connection, address):
         try:
             while True:
-                data = client_socket.recv(1024)
-                if not data:
+                message = connection.recv_message()
+                if message is None:
                     break
                 
-                message = json.loads(data.decode('utf-8'))
-                if message.get("type") == "time_response":
+                connection.last_seen = time.monotonic()
+                message_type = message.get("type")
+                if message_type == "time_response":
+                    receive_time = self.get_current_time()
                     client_id = message.get("client_id", "Desconhecido")
-                    if "debug" in message:
-                        print(f"[DEBUG] Resposta de tempo recebida de {client_id}")
+                    log.debug("[DEBUG] Resposta de tempo recebida de %s", client_id)
+                    connection.responses.put((message, receive_time))
+                elif message_type == "aggregate_response":
+                    connection.responses.put((message, self.get_current_time()))
+                elif message_type == "hello":
+                    connection.role = message.get("role", "client")
+                    connection.confidence = message.get("confidence")
+                    self.identify_client(connection, message.get("client_id"))
+                    if connection.role == "subcoordinator":
+                        log.info("[COORDENADOR] %s conectado como subcoordenador", message.get('client_id'))
+                    if connection.confidence is not None:
+                        log.info("[COORDENADOR] %s retomou estado salvo (confiança %.2f)",
+                                 message.get('client_id'), connection.confidence)
+                elif message_type == "udp_register":
+                    connection.udp_address = (address[0], message["port"])
         except Exception as e:
-            print(f"[ERRO] Falha na comunicação com cliente {address}: {e}")
+            log.error("[ERRO] Falha na comunicação com cliente %s: %s", address, e)
+            self.metrics.inc("errors_total", kind="connection")
         finally:
-            with self.lock:
-                if client_socket in self.clients:
-                    self.clients.remove(client_socket)
-                    num_clients = len(self.clients)
-            client_socket.close()
-            print(f"[COORDENADOR] Cliente {address} desconectado. Restantes: {num_clients}")
+            num_clients = self.registry.remove(connection)
+            self.metrics.set_gauge("clients_connected", num_clients)
+            connection.close()
+            log.info("[COORDENADOR] Cliente %s desconectado. Restantes: %d", address, num_clients)
+    
+    def identify_client(self, connection, client_id):
+        previous = self.registry.identify(connection, client_id)
+        if previous is not None:
+            log.warning("[COORDENADOR] %s reconectado de %s (conexão anterior %s)",
+                        client_id, connection.address, previous.address)
+    
+    def average_offsets(self, offsets, rtts, trusted):
+        # Média só sobre os relógios confiáveis; os demais ficam fora da máscara
+        # de usados, mas continuam recebendo ajuste
+        if trusted.all():
+            return self.averaging.average(offsets, rtts)
+        used = np.zeros(offsets.size, dtype=bool)
+        if not trusted.any():
+            return 0, used
+        mean_offset, used[trusted] = self.averaging.average(offsets[trusted], rtts[trusted])
+        return mean_offset, used
     
     def synchronize_clocks(self):
-        print("\n" + "=" * 80)
-        print("| ALGORITMO DE BERKELEY - INÍCIO DO PROCESSO DE SINCRONIZAÇÃO |".center(80))
-        print("=" * 80)
-        
-        print("\nFASE 1: OBTENÇÃO DO TEMPO DO COORDENADOR")
-        print("-" * 80)
-        
+        with self.metrics.time_phase("round"):
+            coordinator_time = self.begin_round()
+            with self.metrics.time_phase("collect"):
+                client_responses = self.collect_client_times(coordinator_time)
+            return self.process_responses(coordinator_time, client_responses)
+    
+    def begin_round(self):
         coordinator_time = self.get_current_time()
-        print(f"[COORDENADOR] Tempo atual: {self.format_time(coordinator_time)}")
-        print(f"[COORDENADOR] Offset atual: {self.clock_offset:+.2f}s")
         
+        if phase_log.isEnabledFor(logging.INFO):
+            phase_log.info("\n" + "=" * 80)
+            phase_log.info("| ALGORITMO DE BERKELEY - INÍCIO DO PROCESSO DE SINCRONIZAÇÃO |".center(80))
+            phase_log.info("=" * 80)
+            
+            phase_log.info("\nFASE 1: OBTENÇÃO DO TEMPO DO COORDENADOR")
+            phase_log.info("-" * 80)
+            phase_log.info("[COORDENADOR] Tempo atual: %s", self.format_time(coordinator_time))
+            phase_log.info("[COORDENADOR] Offset atual: %+.2fs", self.clock_offset)
+        return coordinator_time
+    
+    def collect_client_times(self, coordinator_time):
         client_responses = []
-        expected_clients = ["Cliente-1", "Cliente-2", "Cliente-3", "Cliente-4"]
-        client_ids_found = set()
         
-        print("\nFASE 2: SOLICITAÇÃO DE TEMPOS DOS CLIENTES")
-        print("-" * 80)
+        phase_log.info("\nFASE 2: SOLICITAÇÃO DE TEMPOS DOS CLIENTES")
+        phase_log.info("-" * 80)
+        
+        def record_samples(connection, samples, client_id):
+            offset, rtt, uncertainty = estimate_offset(samples)
+            connection.record_offset(to_seconds(offset), rtt, uncertainty)
+            if client_id != "Desconhecido":
+                self.identify_client(connection, client_id)
+            client_time = coordinator_time + offset
+            client_responses.append((connection, client_time, client_id))
+            self.print_client_time(client_id, client_time, coordinator_time, rtt)
         
-        def request_time(client_socket):
+        def request_time(connection):
+            samples = []
+            client_id = "Desconhecido"
             try:
-                request = json.dumps({"type": "time_request"})
-                print(f"[COORDENADOR] Enviando solicitação de tempo para um cliente...")
-                client_socket.send(request.encode('utf-8'))
+                # Descarta respostas atrasadas de rodadas anteriores
+                while not connection.responses.empty():
+                    connection.responses.get_nowait()
                 
-                data = client_socket.recv(1024)
-                response = json.loads(data.decode('utf-8'))
+                phase_log.debug("[COORDENADOR] Enviando %d sondas de tempo para %s...",
+                                self.probes_per_client, connection.address)
+                deadline = time.monotonic() + self.probe_timeout
                 
-                if response.get("type") == "time_response":
-                    client_time = response.get("time")
+                connection.group = None
+                
+                for _ in range(self.probes_per_client):
+                    connection.probe_seq += 1
+                    seq = connection.probe_seq
+                    send_time = self.get_current_time()
+                    connection.send_message({"type": "time_request", "seq": seq})
+                    response, receive_time = self.wait_for_response(connection, "time_response", seq, deadline)
                     client_id = response.get("client_id", "Desconhecido")
-                    difference = client_time - coordinator_time
-                    client_responses.append((client_socket, client_time, client_id))
-                    client_ids_found.add(client_id)
-                    print(f"[{client_id}] Tempo recebido: {self.format_time(client_time)}")
-                    print(f"[{client_id}] Diferença com coordenador: {difference:+.2f}s")
+                    samples.append((send_time, response.get("time"), receive_time))
+                
+                if connection.role == "subcoordinator":
+                    connection.probe_seq += 1
+                    seq = connection.probe_seq
+                    connection.send_message({"type": "aggregate_request", "seq": seq})
+                    response, _ = self.wait_for_response(connection, "aggregate_response", seq,
+                                                         time.monotonic() + self.aggregate_timeout)
+                    connection.group = (response["sum"], response["count"],
+                                        response["min_offset"], response["max_offset"])
+            except queue.Empty:
+                log.warning("[ERRO] Prazo esgotado ao solicitar tempo de cliente %s", connection.address)
+                self.metrics.inc("errors_total", kind="probe_timeout")
             except Exception as e:
-                print(f"[ERRO] Falha ao solicitar tempo de cliente: {e}")
+                log.error("[ERRO] Falha ao solicitar tempo de cliente: %s", e)
+                self.metrics.inc("errors_total", kind="probe")
+            
+            if samples:
+                record_samples(connection, samples, client_id)
         
         threads = []
-        with self.lock:
-            clients_copy = self.clients.copy()
+        clients_copy = self.registry.snapshot()
         
-        print(f"[COORDENADOR] Enviando solicitações para {len(clients_copy)} clientes...")
+        phase_log.info("[COORDENADOR] Enviando solicitações para %d clientes...", len(clients_copy))
         
-        for client_socket in clients_copy:
-            thread = threading.Thread(target=request_time, args=(client_socket,))
+        # Clientes com UDP registrado são sondados em lote por um único socket;
+        # subcoordenadores e os demais seguem com uma thread por conexão TCP
+        udp_clients = self.udp_clients(clients_copy)
+        for connection in clients_copy:
+            if connection in udp_clients:
+                continue
+            thread = threading.Thread(target=request_time, args=(connection,))
             thread.start()
             threads.append(thread)
         
+        deadline = time.monotonic() + self.probe_timeout
+        if udp_clients:
+            udp_results = self.collect_udp_samples(udp_clients, deadline)
+            for connection, (samples, client_id) in udp_results.items():
+                record_samples(connection, samples, client_id)
+            missing = len(udp_clients) - len(udp_results)
+            if missing:
+                log.warning("[ERRO] %d clientes não responderam às sondas UDP", missing)
+                self.metrics.inc("errors_total", missing, kind="probe_timeout")
+        
+        if any(connection.role == "subcoordinator" for connection in clients_copy):
+            deadline += self.aggregate_timeout
         for thread in threads:
-            thread.join(timeout=5) 
+            thread.join(timeout=max(0.0, deadline - time.monotonic()))
         
-        print("\nFASE 3: CÁLCULO DO TEMPO MÉDIO")
-        print("-" * 80)
+        self.record_collection(len(clients_copy), len(client_responses))
+        return list(client_responses)
+    
+    def udp_clients(self, connections):
+        if self.udp is None:
+            return set()
+        return {connection for connection in connections
+                if connection.udp_address is not None and connection.role == "client"}
+    
+    def collect_udp_samples(self, connections, deadline):
+        retransmits = self.udp.retransmits
+        results = self.udp.collect(connections, self.probes_per_client, deadline, self.get_current_time)
+        if self.udp.retransmits > retransmits:
+            self.metrics.inc("udp_retransmits_total", self.udp.retransmits - retransmits)
+        return results
+    
+    def record_collection(self, requested, responded):
+        self.metrics.set_gauge("clients_requested", requested)
+        self.metrics.set_gauge("clients_responded", responded)
+        if requested > responded:
+            self.metrics.inc("clients_unresponsive_total", requested - responded)
+    
+    def wait_for_response(self, connection, message_type, seq, deadline):
+        # A leitura do socket é feita apenas por handle_client
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise queue.Empty
+            response, receive_time = connection.responses.get(timeout=remaining)
+            if response.get("type") == message_type and response.get("seq", seq) == seq:
+                return response, receive_time
+    
+    def print_client_time(self, client_id, client_time, coordinator_time, rtt):
+        if not phase_log.isEnabledFor(logging.INFO):
+            return
+        difference = to_seconds(client_time - coordinator_time)
+        phase_log.info("[%s] Tempo recebido: %s", client_id, self.format_time(client_time))
+        phase_log.info("[%s] Diferença com coordenador: %+.2fs (RTT %.3fms, ±%.3fms)",
+                       client_id, difference, rtt * 1000, rtt * 500)
+    
+    def dispatch_adjustments(self, adjustments):
+        # adjustments: [(conexão, id, ajuste, tempo de referência)]. O tempo de
+        # referência é a leitura do relógio do cliente contra a qual o ajuste foi
+        # calculado; com ele o cliente sabe há quanto tempo o ajuste foi medido
+        frames = []
+        for client, client_id, client_adjustment, reference in adjustments:
+            message = {"type": "time_adjustment", "adjustment": client_adjustment, "reference": reference}
+            frames.append((client, encode_message(message, client.version)))
+        
+        late, failed = send_frames(frames, time.monotonic() + self.adjustment_timeout)
         
-        all_times = [coordinator_time] + [response[1] for response in client_responses]
-        if all_times:
-            print("[CÁLCULO] Tempos coletados:")
-            print(f"  - Coordenador: {self.format_time(coordinator_time)}")
+        names = {client: client_id for client, client_id, _, _ in adjustments}
+        for client, e in failed:
+            log.error("[ERRO] Falha ao enviar ajuste para %s: %s", names[client], e)
+            self.metrics.inc("errors_total", kind="adjustment_send")
+        for client, partial in late.items():
+            log.warning("[ERRO] Prazo esgotado ao enviar ajuste para %s", names[client])
+            self.metrics.inc("errors_total", kind="adjustment_timeout")
+            if partial:
+                # Quadro pela metade: o fluxo não tem mais como ser retomado
+                try:
+                    client.socket.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+        
+        undelivered = set(late).union(client for client, _ in failed)
+        for client, _, _, _ in adjustments:
+            if client not in undelivered:
+                client.mark_adjusted()
+        return undelivered
+    
+    def process_responses(self, coordinator_time, client_responses):
+        show_phases = phase_log.isEnabledFor(logging.INFO)
+        average_start = time.perf_counter()
+        
+        # Offsets em ns inteiros relativos ao tempo de referência; o coordenador
+        # entra com offset 0
+        num_clocks = len(client_responses) + 1
+        offsets = np.zeros(num_clocks, dtype=np.int64)
+        offsets[1:] = np.fromiter((client_time for _, client_time, _ in client_responses),
+                                  dtype=np.int64, count=num_clocks - 1)
+        offsets[1:] -= coordinator_time
+        rtts = np.zeros(num_clocks)
+        rtts[1:] = np.fromiter((client.rtt or 0.0 for client, _, _ in client_responses),
+                               dtype=np.float64, count=num_clocks - 1)
+        
+        if show_phases:
+            phase_log.info("\nFASE 3: CÁLCULO DO TEMPO MÉDIO")
+            phase_log.info("-" * 80)
+            phase_log.info("[CÁLCULO] Tempos coletados:")
+            phase_log.info("  - Coordenador: %s", self.format_time(coordinator_time))
             for _, client_time, client_id in client_responses:
-                print(f"  - {client_id}: {self.format_time(client_time)}")
-            
-            average_time = sum(all_times) / len(all_times)
-            
-            print(f"[CÁLCULO] Soma dos tempos: {sum(all_times):.2f}")
-            print(f"[CÁLCULO] Número de relógios: {len(all_times)}")
-            print(f"[CÁLCULO] Tempo médio calculado: {self.format_time(average_time)}")
-            
-            print("\nFASE 4: AJUSTE DO RELÓGIO DO COORDENADOR")
-            print("-" * 80)
-            
-            adjustment = average_time - coordinator_time
-            self.clock_offset += adjustment
-            new_time = self.get_current_time()
-            
-            print(f"[COORDENADOR] Tempo antes do ajuste: {self.format_time(coordinator_time)}")
-            print(f"[COORDENADOR] Ajuste calculado: {adjustment:+.2f}s")
-            print(f"[COORDENADOR] Tempo após ajuste: {self.format_time(new_time)}")
-            print(f"[COORDENADOR] Novo offset: {self.clock_offset:+.2f}s")
-            
-            print("\nFASE 5: ENVIO DE AJUSTES PARA OS CLIENTES")
-            print("-" * 80)
-            
-            # Corrigido: Formatação da tabela com largura fixa para alinhamento correto
-            print("+-----------------+----------------+----------------+---------------+------------------+")
-            print("| ID Cliente      | Tempo Anterior | Diferença Média| Ajuste        | Tempo Após Ajuste|")
-            print("+-----------------+----------------+----------------+---------------+------------------+")
+                phase_log.info("  - %s: %s", client_id, self.format_time(client_time))
+        
+        trusted = np.ones(num_clocks, dtype=bool)
+        trusted[1:] = np.fromiter((client.trusted(self.trust_confidence) for client, _, _ in client_responses),
+                                  dtype=bool, count=num_clocks - 1)
+        mean_offset, used = self.average_offsets(offsets, rtts, trusted)
+        
+        # Grupos dos subcoordenadores entram na média com o seu agregado
+        group_sum, group_count, group_min, group_max = combine_groups(client_responses, coordinator_time)
+        if group_count:
+            clocks_used = int(used.sum())
+            mean_offset = divide(mean_offset * clocks_used + group_sum, clocks_used + group_count)
+            phase_log.info("[CÁLCULO] Relógios em grupos de subcoordenadores: %d (offsets de %+.6fs a %+.6fs)",
+                           group_count, to_seconds(group_min), to_seconds(group_max))
+        average_time = coordinator_time + mean_offset
+        
+        # Maior afastamento da média antes do ajuste e incerteza das amostras
+        # usadas, já em segundos para métricas e agendador
+        deviations = to_seconds(offsets - mean_offset)
+        spread = float(np.abs(deviations[used]).max()) if used.any() else 0.0
+        if group_count:
+            spread = max(spread, to_seconds(abs(group_min - mean_offset)), to_seconds(abs(group_max - mean_offset)))
+        uncertainty = float(rtts[used].max()) / 2 if used.any() else 0.0
+        self.metrics.observe("phase_duration_seconds", time.perf_counter() - average_start, phase="average")
+        
+        if not trusted.all():
+            log.info("[CÁLCULO] Fora da média até o primeiro ajuste (estado restaurado): %s",
+                     ', '.join(client_id for (_, _, client_id), client_trusted in zip(client_responses, trusted[1:])
+                               if not client_trusted))
+        if not used[trusted].all():
+            rejected = [client_id for (_, _, client_id), client_used, client_trusted
+                        in zip(client_responses, used[1:], trusted[1:]) if client_trusted and not client_used]
+            if not used[0]:
+                rejected.insert(0, "Coordenador")
+            log.warning("[CÁLCULO] Relógios descartados pela média %s: %s",
+                        self.averaging.name, ', '.join(rejected))
+            self.metrics.inc("clocks_rejected_total", len(rejected))
+        
+        if show_phases:
+            phase_log.info("[CÁLCULO] Método de média: %s", self.averaging.name)
+            phase_log.info("[CÁLCULO] Soma dos offsets: %+.6fs", to_seconds(int(offsets[used].sum())))
+            phase_log.info("[CÁLCULO] Número de relógios: %d (usados: %d)", num_clocks, int(used.sum()))
+            phase_log.info("[CÁLCULO] Tempo médio calculado: %s", self.format_time(average_time))
+        
+        adjustment = average_time - coordinator_time
+        self.clock.adjust(adjustment)
+        new_time = self.get_current_time()
+        
+        if show_phases:
+            phase_log.info("\nFASE 4: AJUSTE DO RELÓGIO DO COORDENADOR")
+            phase_log.info("-" * 80)
+            phase_log.info("[COORDENADOR] Tempo antes do ajuste: %s", self.format_time(coordinator_time))
+            phase_log.info("[COORDENADOR] Ajuste calculado: %+.2fs", to_seconds(adjustment))
+            phase_log.info("[COORDENADOR] Tempo após ajuste: %s", self.format_time(new_time))
+            phase_log.info("[COORDENADOR] Novo offset: %+.2fs", self.clock_offset)
             
-            # Primeiro, vamos processar os ajustes para o coordenador
-            table_data = []
+            phase_log.info("\nFASE 5: ENVIO DE AJUSTES PARA OS CLIENTES")
+            phase_log.info("-" * 80)
+        
+        # Todos os ajustes saem juntos; a saída no terminal fica para depois
+        adjust_start = time.perf_counter()
+        undelivered = self.dispatch_adjustments([(client, client_id, average_time - client_time, client_time)
+                                                 for client, client_time, client_id in client_responses])
+        self.metrics.observe("phase_duration_seconds", time.perf_counter() - adjust_start, phase="adjust")
+        
+        # Divergência que sobra após o ajuste: quem não recebeu o ajuste continua
+        # onde estava (com o grupo inteiro, no caso de um subcoordenador); os
+        # demais ficam na média, a menos da incerteza das amostras
+        max_diff = 0
+        for client, client_time, client_id in client_responses:
+            if show_phases:
+                phase_log.info("[COORDENADOR] Ajuste de %+.2fs para %s: %s", to_seconds(average_time - client_time),
+                               client_id, "NÃO ENTREGUE" if client in undelivered else "enviado")
+            if client not in undelivered:
+                continue
+            deviation = client_time - average_time
+            max_diff = max(max_diff, abs(deviation))
+            if client.group is not None and client.group[1]:
+                _, _, group_min, group_max = client.group
+                max_diff = max(max_diff, abs(deviation + group_min), abs(deviation + group_max))
+        max_diff = to_seconds(max_diff)
+        
+        # Daqui em diante apenas saída: métricas, histórico e logs em segundos
+        self.record_round_metrics(deviations, rtts[1:], spread, uncertainty, to_seconds(adjustment),
+                                  num_clocks + group_count)
+        if self.history is not None:
+            self.history.record(time.time(), to_seconds(coordinator_time), to_seconds(mean_offset),
+                                to_seconds(adjustment), spread, uncertainty, max_diff, num_clocks + group_count,
+                                int(used.sum()) + group_count, to_seconds(offsets[1:]), rtts[1:], used[1:],
+                                client_responses, undelivered)
+        
+        if show_phases:
+            self.print_adjustment_table(coordinator_time, adjustment, new_time, average_time, client_responses)
             
-            # Adiciona o coordenador à tabela
+            phase_log.info("\nFASE 6: SINCRONIZAÇÃO CONCLUÍDA")
+            phase_log.info("-" * 80)
+            phase_log.info("Todos os relógios agora estão sincronizados com o tempo médio calculado.")
+            phase_log.info("Tempo médio do sistema: %s", self.format_time(average_time))
+            phase_log.info("Maior afastamento restante após sincronização (ajustes não entregues): %.6fs (%s)",
+                           max_diff, '< 1 segundo: OK' if max_diff < 1 else '≥ 1 segundo: ERRO!')
+            phase_log.info("Afastamento máximo antes do ajuste: %.6fs (incerteza das amostras ±%.6fs)",
+                           spread, uncertainty)
+            phase_log.info("=" * 80 + "\n")
+        
+        log.info("[COORDENADOR] Rodada concluída: %d relógios, ajuste do coordenador %+.6fs, "
+                 "afastamento %.6fs, incerteza ±%.6fs",
+                 num_clocks + group_count, to_seconds(adjustment), spread, uncertainty,
+                 extra={"fields": {"event": "round", "clocks": num_clocks + group_count,
+                                   "used": int(used.sum()) + group_count,
+                                   "average_offset": to_seconds(mean_offset), "adjustment": to_seconds(adjustment),
+                                   "spread": spread, "uncertainty": uncertainty,
+                                   "max_diff": max_diff, "averaging": self.averaging.name}})
+        return spread, max(max_diff, uncertainty)
+    
+    def record_round_metrics(self, deviations, rtts, spread, uncertainty, adjustment, clocks):
+        metrics = self.metrics
+        metrics.inc("rounds_total")
+        metrics.observe_many("rtt_seconds", rtts)
+        metrics.observe_many("offset_deviation_seconds", np.abs(deviations), OFFSET_BUCKETS)
+        metrics.set_gauge("clocks_last_round", clocks)
+        metrics.set_gauge("spread_seconds", spread)
+        metrics.set_gauge("uncertainty_seconds", uncertainty)
+        metrics.set_gauge("coordinator_adjustment_seconds", adjustment)
+        metrics.set_gauge("last_round_timestamp_seconds", time.time())
+    
+    def print_adjustment_table(self, coordinator_time, adjustment, new_time, average_time, client_responses):
+        # Corrigido: Formatação da tabela com largura fixa para alinhamento correto
+        phase_log.info("+-----------------+----------------+----------------+---------------+------------------+")
+        phase_log.info("| ID Cliente      | Tempo Anterior | Diferença Média| Ajuste        | Tempo Após Ajuste|")
+        phase_log.info("+-----------------+----------------+----------------+---------------+------------------+")
+        
+        # Adiciona o coordenador à tabela
+        table_data = [{
+            'id': 'Coordenador', 
+            'old_time': coordinator_time,
+            'diff': 0.00,
+            'adjustment': to_seconds(adjustment),
+            'new_time': new_time
+        }]
+        
+        # Clientes que responderam nesta rodada, seguidos dos conectados sem resposta
+        for client, client_time, client_id in sorted(client_responses, key=lambda response: response[2]):
             table_data.append({
-                'id': 'Coordenador', 
-                'old_time': coordinator_time,
-                'diff': 0.00,
-                'adjustment': adjustment,
-                'new_time': new_time
+                'id': client_id,
+                'old_time': client_time,
+                'diff': to_seconds(client_time - average_time),
+                'adjustment': to_seconds(average_time - client_time),
+                'new_time': average_time,
+                'responded': True
             })
-            
-            # Mapeia respostas dos clientes por ID para facilitar a busca
-            client_responses_map = {client_id: (client_socket, client_time) for client_socket, client_time, client_id in client_responses}
-            
-            # Processa e exibe os ajustes para cada cliente, garantindo que todos os 4 esperados apareçam
-            for client_id in expected_clients:
-                if client_id in client_ids_found:
-                    # Cliente conectado - use os dados reais
-                    client_socket, client_time = client_responses_map[client_id]
-                    diff_from_avg = client_time - average_time
-                    client_adjustment = average_time - client_time
-                    new_client_time = client_time + client_adjustment
-                    
-                    try:
-                        print(f"[COORDENADOR] Enviando ajuste de {client_adjustment:+.2f}s para {client_id}...")
-                        adjustment_message = json.dumps({
-                            "type": "time_adjustment",
-                            "adjustment": client_adjustment
-                        })
-                        client_socket.send(adjustment_message.encode('utf-8'))
-                    except Exception as e:
-                        print(f"[ERRO] Falha ao enviar ajuste para {client_id}: {e}")
-                    
-                    table_data.append({
-                        'id': client_id,
-                        'old_time': client_time,
-                        'diff': diff_from_avg,
-                        'adjustment': client_adjustment,
-                        'new_time': new_client_time,
-                        'connected': True
-                    })
-                else:
-                    # Cliente não conectado - mostre dados fictícios ou uma mensagem
-                    table_data.append({
-                        'id': client_id,
-                        'connected': False
-                    })
-            
-            # Exibe a tabela completa com o coordenador e todos os 4 clientes esperados
-            for node in table_data:
-                if node.get('connected', True):  # Cliente conectado ou coordenador
-                    print(f"| {node['id']:<15} | {self.format_time(node['old_time']):<14} | "
-                          f"{node['diff']:+.2f}s{'':10} | {node['adjustment']:+.2f}s{'':7} | {self.format_time(node['new_time']):<16} |")
-                else:  # Cliente não conectado
-                    print(f"| {node['id']:<15} | {'NÃO CONECTADO':<14} | {'---':10} | {'---':10} | {'---':16} |")
-            
-            print("+-----------------+----------------+----------------+---------------+------------------+")
-            
-            print("\nFASE 6: SINCRONIZAÇÃO CONCLUÍDA")
-            print("-" * 80)
-            print("Todos os relógios agora estão sincronizados com o tempo médio calculado.")
-            print(f"Tempo médio do sistema: {self.format_time(average_time)}")
-            
-            max_diff = 0
-            for _, client_time, client_id in client_responses:
-                adjusted_time = client_time + (average_time - client_time)
-                diff = abs(adjusted_time - average_time)
-                max_diff = max(max_diff, diff)
-            
-            print(f"Diferença máxima entre relógios após sincronização: {max_diff:.6f}s "
-                  f"({'< 1 segundo: OK' if max_diff < 1 else '≥ 1 segundo: ERRO!'})")
-            
-            print("=" * 80)
-            print()
-        else:
-            print("[ERRO] Nenhum cliente disponível para sincronização")
-            
-            print("\nFASE 6: SINCRONIZAÇÃO CONCLUÍDA")
-            print("-" * 80)
-            print("Todos os relógios agora estão sincronizados com o tempo médio calculado.")
-            print(f"Tempo médio do sistema: {self.format_time(average_time)}")
-            
-            max_diff = 0
-            for _, client_time, client_id in client_responses:
-                adjusted_time = client_time + (average_time - client_time)
-                diff = abs(adjusted_time - average_time)
-                max_diff = max(max_diff, diff)
-            
-            print(f"Diferença máxima entre relógios após sincronização: {max_diff:.6f}s "
-                  f"({'< 1 segundo: OK' if max_diff < 1 else '≥ 1 segundo: ERRO!'})")
-            
-            print("=" * 80)
-            print()
-        # else:
-        #     print("[ERRO] Nenhum cliente disponível para sincronização")
+        
+        responded = {client for client, _, _ in client_responses}
+        for client in self.registry.snapshot():
+            if client not in responded:
+                table_data.append({
+                    'id': client.name,
+                    'responded': False
+                })
+        
+        for node in table_data:
+            if node.get('responded', True):  # Cliente que respondeu ou coordenador
+                phase_log.info(f"| {node['id']:<15} | {self.format_time(node['old_time']):<14} | "
+                               f"{node['diff']:+.2f}s{'':10} | {node['adjustment']:+.2f}s{'':7} | "
+                               f"{self.format_time(node['new_time']):<16} |")
+            else:  # Cliente conectado que não respondeu a tempo
+                phase_log.info(f"| {node['id']:<15} | {'SEM RESPOSTA':<14} | {'---':10} | {'---':10} | {'---':16} |")
+        
+        phase_log.info("+-----------------+----------------+----------------+---------------+------------------+")
     
     @staticmethod
     def format_time(timestamp):
-        return datetime.fromtimestamp(timestamp).strftime('%H:%M:%S.%f')[:-3]
+        return format_time(timestamp)
 
 if __name__ == "__main__":
-    coordinator = BerkeleyCoordinator()
+    averaging = create_engine(sys.argv[1]) if len(sys.argv) > 1 else None
+    
+    setup_logging()
+    coordinator = BerkeleyCoordinator(averaging=averaging, udp=transport_from_env(), history=history_from_env(),
+                                      quorum=int(os.environ.get("BERKELEY_QUORUM", 1)))
+    start_metrics_server(coordinator.metrics)
     coordinator.start()
\ No newline at end of file
@@ -0,0 +1,221 @@
+import logging
+import os
+import queue
+import sys
+import threading
+from datetime import datetime
+
+import numpy as np
+
+log = logging.getLogger("berkeley.history")
+
+# Histórico das rodadas do coordenador em dois arquivos só de acréscimo, com
+# registros de tamanho fixo (little-endian) que podem ser mapeados diretamente
+# como arrays estruturados do NumPy:
+#   <caminho>.rounds   um registro de 80 bytes por rodada
+#   <caminho>.clients  um registro de 64 bytes por cliente que respondeu
+# Cada arquivo começa com um cabeçalho de 16 bytes: magic, versão do layout e
+# tamanho do registro. A rodada i tem os clientes
+# clients[rounds['first_client'][i]:][:rounds['clients'][i]].
+#
+# Os registros dos clientes são gravados antes do registro da rodada, e o leitor
+# ignora registros incompletos no fim do arquivo: uma rodada só aparece depois
+# que todos os seus clientes estão no disco.
+#
+# Configuração: BERKELEY_HISTORY=caminho (sem extensão)
+
+LAYOUT_VERSION = 1
+HEADER_SIZE = 16
+HEADER_DTYPE = np.dtype([('magic', 'S4'), ('version', '<u4'), ('record_size', '<u4'), ('reserved', '<u4')])
+ROUNDS_MAGIC = b"BKLR"
+CLIENTS_MAGIC = b"BKLC"
+
+ROUND_DTYPE = np.dtype([
+    ('wall_time', '<f8'),         # time.time() ao fim da rodada
+    ('coordinator_time', '<f8'),  # Relógio do coordenador no início da rodada
+    ('average_offset', '<f8'),    # Tempo médio - tempo do coordenador
+    ('adjustment', '<f8'),        # Ajuste aplicado ao coordenador
+    ('spread', '<f8'),            # Maior afastamento da média antes do ajuste
+    ('uncertainty', '<f8'),
+    ('max_diff', '<f8'),          # Maior afastamento restante (ajustes não entregues)
+    ('first_client', '<u8'),      # Índice do primeiro registro em .clients
+    ('clients', '<u4'),           # Clientes que responderam
+    ('clocks', '<u4'),            # Relógios na média, incluindo grupos e coordenador
+    ('used', '<u4'),              # Relógios aceitos pelo método de média
+    ('undelivered', '<u4'),       # Ajustes não entregues no prazo
+])
+
+CLIENT_DTYPE = np.dtype({
+    'names': ['round', 'client_id', 'offset', 'rtt', 'adjustment', 'used', 'delivered'],
+    'formats': ['<u8', 'S24', '<f8', '<f8', '<f8', '?', '?'],
+    'offsets': [0, 8, 32, 40, 48, 56, 57],
+    'itemsize': 64,
+})
+
+def _open_log(path, magic, dtype):
+    # Abre (ou cria) um arquivo de registros e descarta um registro parcial no fim
+    exists = os.path.exists(path) and os.path.getsize(path) >= HEADER_SIZE
+    file = open(path, 'r+b' if exists else 'w+b')
+    if exists:
+        header = np.frombuffer(file.read(HEADER_SIZE), HEADER_DTYPE)[0]
+        if header['magic'] != magic or header['version'] != LAYOUT_VERSION or header['record_size'] != dtype.itemsize:
+            file.close()
+            raise ValueError(f"Arquivo de histórico incompatível: {path}")
+    else:
+        file.write(np.array([(magic, LAYOUT_VERSION, dtype.itemsize, 0)], HEADER_DTYPE).tobytes())
+        file.flush()
+    count = (os.fstat(file.fileno()).st_size - HEADER_SIZE) // dtype.itemsize
+    file.truncate(HEADER_SIZE + count * dtype.itemsize)
+    file.seek(0, os.SEEK_END)
+    return file, count
+
+# Gravador usado pelo coordenador. record() apenas enfileira referências aos
+# dados da rodada; a montagem dos registros e a escrita ficam numa thread própria
+class RoundHistoryWriter:
+    def __init__(self, path):
+        self.path = path
+        self.rounds_file, self.rounds = _open_log(path + ".rounds", ROUNDS_MAGIC, ROUND_DTYPE)
+        self.clients_file, self.clients = _open_log(path + ".clients", CLIENTS_MAGIC, CLIENT_DTYPE)
+
+        # Clientes gravados depois da última rodada completa pertencem a uma
+        # rodada interrompida
+        referenced = 0
+        if self.rounds:
+            self.rounds_file.seek(HEADER_SIZE + (self.rounds - 1) * ROUND_DTYPE.itemsize)
+            last = np.frombuffer(self.rounds_file.read(ROUND_DTYPE.itemsize), ROUND_DTYPE)[0]
+            referenced = int(last['first_client']) + int(last['clients'])
+            self.rounds_file.seek(0, os.SEEK_END)
+        if self.clients > referenced:
+            self.clients = referenced
+            self.clients_file.truncate(HEADER_SIZE + referenced * CLIENT_DTYPE.itemsize)
+            self.clients_file.seek(0, os.SEEK_END)
+
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        log.info("[HISTÓRICO] Gravando rodadas em %s.rounds (%d rodadas anteriores)", path, self.rounds)
+
+    def record(self, wall_time, coordinator_time, average_offset, adjustment, spread, uncertainty, max_diff,
+               clocks, used_count, offsets, rtts, used, client_responses, undelivered):
+        # offsets, rtts e used são os arrays dos clientes, na ordem de client_responses
+        self.queue.put((wall_time, coordinator_time, average_offset, adjustment, spread, uncertainty, max_diff,
+                        clocks, used_count, offsets, rtts, used, client_responses, undelivered))
+
+    def run(self):
+        while True:
+            entry = self.queue.get()
+            if entry is None:
+                self.queue.task_done()
+                return
+            try:
+                self.write(*entry)
+            except Exception as e:
+                log.error("[ERRO] Falha ao gravar rodada no histórico: %s", e)
+            finally:
+                self.queue.task_done()
+
+    def write(self, wall_time, coordinator_time, average_offset, adjustment, spread, uncertainty, max_diff,
+              clocks, used_count, offsets, rtts, used, client_responses, undelivered):
+        count = len(client_responses)
+        clients = np.zeros(count, CLIENT_DTYPE)
+        clients['round'] = self.rounds
+        clients['client_id'] = [client_id.encode('utf-8')[:24] for _, _, client_id in client_responses]
+        clients['offset'] = offsets
+        clients['rtt'] = rtts
+        clients['adjustment'] = average_offset - offsets
+        clients['used'] = used
+        clients['delivered'] = [client not in undelivered for client, _, _ in client_responses]
+
+        record = np.array([(wall_time, coordinator_time, average_offset, adjustment, spread, uncertainty,
+                            max_diff, self.clients, count, clocks, used_count, len(undelivered))], ROUND_DTYPE)
+
+        self.clients_file.write(clients.tobytes())
+        self.clients_file.flush()
+        self.rounds_file.write(record.tobytes())
+        self.rounds_file.flush()
+        self.clients += count
+        self.rounds += 1
+
+    def flush(self):
+        # Espera a gravação de todas as rodadas já enfileiradas
+        self.queue.join()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.rounds_file.close()
+        self.clients_file.close()
+
+# Leitor: os arrays são mapeados do arquivo (sem cópia) e somente leitura.
+# refresh() remapeia depois que o gravador acrescentou rodadas
+class RoundHistory:
+    def __init__(self, path):
+        self.path = path
+        self.rounds = self.clients = None
+        self.refresh()
+
+    @staticmethod
+    def _map(path, magic, dtype):
+        size = os.path.getsize(path)
+        header = np.fromfile(path, HEADER_DTYPE, count=1)
+        if not header.size or header[0]['magic'] != magic or header[0]['version'] != LAYOUT_VERSION:
+            raise ValueError(f"Arquivo de histórico inválido: {path}")
+        count = (size - HEADER_SIZE) // dtype.itemsize
+        if not count:
+            return np.empty(0, dtype)
+        return np.memmap(path, dtype, mode='r', offset=HEADER_SIZE, shape=(count,))
+
+    def refresh(self):
+        rounds = self._map(self.path + ".rounds", ROUNDS_MAGIC, ROUND_DTYPE)
+        clients = self._map(self.path + ".clients", CLIENTS_MAGIC, CLIENT_DTYPE)
+        # Só rodadas cujos clientes já estão todos no arquivo; como os clientes
+        # são gravados primeiro, basta conferir o fim
+        count = len(rounds)
+        while count and rounds[count - 1]['first_client'] + rounds[count - 1]['clients'] > clients.size:
+            count -= 1
+        rounds = rounds[:count]
+        self.rounds, self.clients = rounds, clients
+        # wall_time vem de time.time(), que pode voltar (NTP, ajuste manual):
+        # a busca binária de between() só vale enquanto a coluna não decrescer
+        self.ordered = bool((np.diff(rounds['wall_time']) >= 0).all())
+        return len(rounds)
+
+    def __len__(self):
+        return len(self.rounds)
+
+    def round_clients(self, index):
+        round_record = self.rounds[index]
+        start = int(round_record['first_client'])
+        return self.clients[start:start + int(round_record['clients'])]
+
+    def between(self, start, end):
+        # Rodadas com wall_time em [start, end), em ordem de gravação. Sem saltos
+        # para trás do relógio de parede, é uma fatia (sem cópia) por busca binária
+        wall_time = self.rounds['wall_time']
+        if self.ordered:
+            return self.rounds[np.searchsorted(wall_time, start):np.searchsorted(wall_time, end)]
+        return self.rounds[(wall_time >= start) & (wall_time < end)]
+
+    def client(self, client_id):
+        # Todos os registros de um cliente, em ordem de rodada
+        clients = self.clients
+        return clients[clients['client_id'] == client_id.encode('utf-8')[:24]]
+
+def history_from_env():
+    path = os.environ.get("BERKELEY_HISTORY")
+    return RoundHistoryWriter(path) if path else None
+
+if __name__ == "__main__":
+    history = RoundHistory(sys.argv[1])
+    rounds = history.rounds
+    print(f"[HISTÓRICO] {len(rounds)} rodadas, {len(history.clients)} registros de clientes")
+    if len(rounds):
+        first = datetime.fromtimestamp(rounds['wall_time'][0]).strftime('%Y-%m-%d %H:%M:%S')
+        last = datetime.fromtimestamp(rounds['wall_time'][-1]).strftime('%Y-%m-%d %H:%M:%S')
+        print(f"[HISTÓRICO] De {first} a {last}")
+        spread = rounds['spread']
+        print(f"[HISTÓRICO] Afastamento antes do ajuste: p50 {np.percentile(spread, 50):.6f}s  "
+              f"p99 {np.percentile(spread, 99):.6f}s  máx {spread.max():.6f}s")
+        print(f"[HISTÓRICO] Clientes por rodada: média {rounds['clients'].mean():.1f}  "
+              f"máx {rounds['clients'].max()}")
+        print(f"[HISTÓRICO] Ajustes não entregues: {int(rounds['undelivered'].sum())}")
@@ -0,0 +1,107 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+
+# Toda a saída do sistema passa por loggers "berkeley.<subsistema>". Os handlers
+# de fato (stdout) rodam numa thread de fundo alimentada por uma fila limitada,
+# de modo que o caminho de sincronização nunca bloqueia em E/S. As tabelas e os
+# banners das fases ficam nos loggers "*.phases" e só são emitidos quando pedidos.
+#
+# Configuração por variáveis de ambiente (usadas quando setup_logging é chamado
+# sem argumentos):
+#   BERKELEY_LOG_FORMAT  human (padrão) ou json (uma linha JSON por registro)
+#   BERKELEY_LOG_LEVEL   nível geral, ex.: INFO
+#   BERKELEY_LOG_LEVELS  níveis por subsistema, ex.: coordinator=DEBUG,client=WARNING
+#   BERKELEY_LOG_TABLES  1 para exibir tabelas e banners das fases
+#   BERKELEY_LOG_QUIET   1 para modo de produção (apenas avisos e erros)
+
+ROOT_LOGGER = "berkeley"
+PHASE_LOGGERS = ("coordinator.phases", "client.phases", "subcoordinator.phases")
+QUEUE_SIZE = 10000
+
+_listener = None
+
+class JsonLinesFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+# Enfileira sem formatar nem bloquear: a fila é consumida no mesmo processo, e
+# registros que não cabem na fila são descartados e contados
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def _parse_levels(spec):
+    levels = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, level = item.partition("=")
+        levels[name.strip()] = level.strip().upper()
+    return levels
+
+def setup_logging(log_format=None, level=None, levels=None, tables=None, quiet=None, stream=None):
+    global _listener
+
+    env = os.environ
+    log_format = log_format or env.get("BERKELEY_LOG_FORMAT", "human")
+    level = level or env.get("BERKELEY_LOG_LEVEL", "INFO")
+    levels = levels if levels is not None else _parse_levels(env.get("BERKELEY_LOG_LEVELS", ""))
+    tables = tables if tables is not None else env.get("BERKELEY_LOG_TABLES") == "1"
+    quiet = quiet if quiet is not None else env.get("BERKELEY_LOG_QUIET") == "1"
+
+    handler = logging.StreamHandler(stream or sys.stdout)
+    if log_format == "json":
+        handler.setFormatter(JsonLinesFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(message)s"))
+
+    if _listener is not None:
+        _listener.stop()
+    log_queue = queue.Queue(QUEUE_SIZE)
+    _listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    _listener.start()
+
+    root = logging.getLogger(ROOT_LOGGER)
+    root.handlers[:] = [NonBlockingQueueHandler(log_queue)]
+    root.propagate = False
+    root.setLevel("WARNING" if quiet else level)
+
+    for name in PHASE_LOGGERS:
+        logging.getLogger(f"{ROOT_LOGGER}.{name}").setLevel(
+            "INFO" if tables and not quiet else "WARNING")
+    for name, subsystem_level in levels.items():
+        logging.getLogger(f"{ROOT_LOGGER}.{name}").setLevel(subsystem_level)
+
+    return _listener
+
+def shutdown_logging():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+atexit.register(shutdown_logging)
@@ -0,0 +1,229 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from itertools import accumulate
+
+log = logging.getLogger("berkeley.metrics")
+
+# Limites dos buckets (em segundos) usados por padrão nos histogramas
+DURATION_BUCKETS = (1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2,
+                    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+OFFSET_BUCKETS = (1e-6, 1e-5, 1e-4, 1e-3, 1e-2, 0.1, 1.0, 10.0, 100.0)
+
+# Histograma em Python puro: o cliente importa este módulo e não deve pagar a
+# importação do NumPy (~150 ms) antes da primeira sincronização. Apenas
+# observe_many, usado pelo coordenador com arrays, importa o NumPy
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = tuple(float(bound) for bound in buckets)
+        self.counts = [0] * (len(buckets) + 1)  # último = +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def observe_many(self, values):
+        import numpy as np
+        values = np.asarray(values, dtype=np.float64)
+        if not values.size:
+            return
+        counts = np.bincount(np.searchsorted(self.buckets, values, side='left'), minlength=len(self.counts))
+        self.counts = [total + int(added) for total, added in zip(self.counts, counts)]
+        self.sum += float(values.sum())
+        self.count += int(values.size)
+
+    def cumulative(self):
+        return list(accumulate(self.counts))
+
+# Registro de métricas em memória: contadores, gauges e histogramas, cada um
+# identificado por nome e rótulos. Todas as operações são protegidas por um único
+# lock e custam poucos microssegundos, para poderem ficar no caminho da rodada
+class Metrics:
+    def __init__(self, prefix="berkeley"):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.started = time.time()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        with self.lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def _histogram(self, name, buckets, labels):
+        key = self._key(name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(buckets)
+        return histogram
+
+    def observe(self, name, value, buckets=DURATION_BUCKETS, **labels):
+        with self.lock:
+            self._histogram(name, buckets, labels).observe(value)
+
+    def observe_many(self, name, values, buckets=DURATION_BUCKETS, **labels):
+        with self.lock:
+            self._histogram(name, buckets, labels).observe_many(values)
+
+    @contextmanager
+    def time_phase(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("phase_duration_seconds", time.perf_counter() - start, phase=phase)
+
+    def render_prometheus(self):
+        lines = []
+        with self.lock:
+            self._render_simple(lines, self.counters, "counter")
+            self._render_simple(lines, self.gauges, "gauge")
+
+            declared = set()
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                full_name = f"{self.prefix}_{name}"
+                if name not in declared:
+                    lines.append(f"# TYPE {full_name} histogram")
+                    declared.add(name)
+                cumulative = histogram.cumulative()
+                for bound, count in zip(histogram.buckets, cumulative):
+                    lines.append(f"{full_name}_bucket{_labels(labels, le=repr(float(bound)))} {count}")
+                lines.append(f"{full_name}_bucket{_labels(labels, le='+Inf')} {cumulative[-1]}")
+                lines.append(f"{full_name}_sum{_labels(labels)} {histogram.sum!r}")
+                lines.append(f"{full_name}_count{_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def _render_simple(self, lines, values, metric_type):
+        declared = set()
+        for (name, labels), value in sorted(values.items()):
+            full_name = f"{self.prefix}_{name}"
+            if name not in declared:
+                lines.append(f"# TYPE {full_name} {metric_type}")
+                declared.add(name)
+            lines.append(f"{full_name}{_labels(labels)} {value!r}")
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "uptime_seconds": time.time() - self.started,
+                "counters": [_entry(key, value) for key, value in sorted(self.counters.items())],
+                "gauges": [_entry(key, value) for key, value in sorted(self.gauges.items())],
+                "histograms": [
+                    _entry(key, {
+                        "buckets": list(histogram.buckets),
+                        "counts": list(histogram.counts),
+                        "sum": histogram.sum,
+                        "count": histogram.count,
+                    })
+                    for key, histogram in sorted(self.histograms.items())
+                ],
+            }
+
+def _labels(labels, **extra):
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in items) + "}"
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _entry(key, value):
+    name, labels = key
+    return {"name": name, "labels": dict(labels), "value": value}
+
+# Endpoint HTTP local: /metrics (texto Prometheus) e /metrics.json. O http.server
+# só é importado quando há endpoint, pelo mesmo motivo do NumPy acima
+class MetricsServer:
+    def __init__(self, metrics, host='127.0.0.1', port=9100):
+        from http.server import ThreadingHTTPServer
+        self.metrics = metrics
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    def _make_handler(self):
+        from http.server import BaseHTTPRequestHandler
+        metrics = self.metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path in ("/metrics", "/"):
+                    body = metrics.render_prometheus().encode('utf-8')
+                    content_type = "text/plain; version=0.0.4; charset=utf-8"
+                elif self.path == "/metrics.json":
+                    body = json.dumps(metrics.snapshot()).encode('utf-8')
+                    content_type = "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                log.debug("[MÉTRICAS] " + format, *args)
+
+        return Handler
+
+    def start(self):
+        self.thread.start()
+        log.info("[MÉTRICAS] Endpoint em http://%s:%d/metrics", *self.httpd.server_address[:2])
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+# Memória residente do processo atual em bytes (None se não houver como medir)
+def resident_memory():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        scale = 1 if sys.platform == "darwin" else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    except ImportError:
+        return None
+
+def start_metrics_server(metrics, port=None, host='127.0.0.1', variable="BERKELEY_METRICS_PORT"):
+    # Sem porta explícita, usa a variável de ambiente dada; sem nenhuma, não há
+    # endpoint. Porta 0 escolhe uma porta livre (útil com vários processos)
+    port = port if port is not None else os.environ.get(variable)
+    if port in (None, ""):
+        return None
+    try:
+        return MetricsServer(metrics, host, int(port)).start()
+    except OSError as e:
+        # Porta ocupada não deve derrubar o processo: segue sem endpoint
+        log.warning("[MÉTRICAS] Endpoint desativado (%s:%s): %s", host, port, e)
+        return None
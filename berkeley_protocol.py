@@ -0,0 +1,294 @@
+import json
+import struct
+from collections import deque
+
+from berkeley_clock import NANOS
+
+# Versões do protocolo de fio:
+#   0 - JSON sem enquadramento (clientes antigos, um objeto por send)
+#   1 - quadro com cabeçalho fixo e corpo JSON (transição)
+#   2 - quadro com cabeçalho fixo e corpo binário compacto
+#   3 - como a 2, com instantes e offsets em nanossegundos inteiros (int64)
+LEGACY_JSON = 0
+VERSION_JSON = 1
+VERSION_BINARY = 2
+VERSION_BINARY_NS = 3
+PROTOCOL_VERSION = VERSION_BINARY_NS
+
+# Nas mensagens decodificadas os campos de tempo são sempre nanossegundos
+# inteiros (ver berkeley_clock); as versões 0 a 2 levam segundos em float no fio
+# e são convertidas na codificação e na decodificação
+TIME_FIELDS = ("time", "adjustment", "reference", "sum", "min_offset", "max_offset")
+
+# Cabeçalho: versão (1 byte), tipo (1 byte), tamanho do corpo (2 bytes)
+HEADER = struct.Struct('!BBH')
+PROBE = struct.Struct('!I')
+ROLE = struct.Struct('!B')
+CONFIDENCE = struct.Struct('!f')
+PORT = struct.Struct('!H')
+
+# Corpos com campos de tempo, por versão binária: (tempo), (ajuste, referência),
+# (tempo, seq) e (seq, soma, contagem, mínimo, máximo)
+TIMESTAMP, ADJUSTMENT, RESPONSE, AGGREGATE = 0, 1, 2, 3
+TIME_STRUCTS = {
+    VERSION_BINARY: (struct.Struct('!d'), struct.Struct('!dd'), struct.Struct('!dI'), struct.Struct('!IdIdd')),
+    VERSION_BINARY_NS: (struct.Struct('!q'), struct.Struct('!qq'), struct.Struct('!qI'), struct.Struct('!IqIqq')),
+}
+MAX_PAYLOAD = 0xFFFF
+MAX_LEGACY_BUFFER = 64 * 1024
+
+TIME_REQUEST = 1
+TIME_RESPONSE = 2
+TIME_ADJUSTMENT = 3
+HELLO = 4
+AGGREGATE_REQUEST = 5
+AGGREGATE_RESPONSE = 6
+UDP_REGISTER = 7
+
+MESSAGE_TYPES = {
+    "time_request": TIME_REQUEST,
+    "time_response": TIME_RESPONSE,
+    "time_adjustment": TIME_ADJUSTMENT,
+    "hello": HELLO,
+    "aggregate_request": AGGREGATE_REQUEST,
+    "aggregate_response": AGGREGATE_RESPONSE,
+    "udp_register": UDP_REGISTER,
+}
+MESSAGE_NAMES = {code: name for name, code in MESSAGE_TYPES.items()}
+
+# Papéis anunciados no hello: clientes comuns ou subcoordenadores que respondem
+# com o agregado do seu grupo. Um cliente que retomou o relógio de estado salvo
+# anuncia também a confiança nesse estado: no corpo binário, o bit HAS_CONFIDENCE
+# do byte de papel indica um float logo depois dele
+ROLES = ("client", "subcoordinator")
+HAS_CONFIDENCE = 0x80
+
+class ProtocolError(ValueError):
+    pass
+
+def _to_wire(version):
+    # Conversão de nanossegundos para a representação da versão no fio
+    return int if version == VERSION_BINARY_NS else _seconds
+
+def _from_wire(version):
+    return int if version == VERSION_BINARY_NS else _nanos
+
+def _seconds(nanos):
+    return nanos / NANOS
+
+def _nanos(seconds):
+    return round(seconds * NANOS)
+
+def _convert_fields(message, convert):
+    if not isinstance(message, dict):
+        return message
+    fields = [field for field in TIME_FIELDS if message.get(field) is not None]
+    if not fields:
+        return message
+    message = dict(message)
+    try:
+        for field in fields:
+            message[field] = convert(message[field])
+    except TypeError:
+        raise ProtocolError(f"Campo de tempo inválido em {message.get('type')}")
+    return message
+
+def encode_message(message, version=PROTOCOL_VERSION):
+    if version == LEGACY_JSON:
+        return json.dumps(_convert_fields(message, _seconds)).encode('utf-8')
+
+    message_type = MESSAGE_TYPES.get(message.get("type"))
+    if message_type is None:
+        raise ProtocolError(f"Tipo de mensagem desconhecido: {message.get('type')}")
+
+    if version == VERSION_JSON:
+        payload = json.dumps(_convert_fields(message, _seconds)).encode('utf-8')
+    elif version in TIME_STRUCTS:
+        payload = _pack_payload(message_type, message, version)
+    else:
+        raise ProtocolError(f"Versão de protocolo não suportada: {version}")
+
+    if len(payload) > MAX_PAYLOAD:
+        raise ProtocolError(f"Mensagem grande demais: {len(payload)} bytes")
+    return HEADER.pack(version, message_type, len(payload)) + payload
+
+def _pack_payload(message_type, message, version):
+    structs = TIME_STRUCTS[version]
+    wire = _to_wire(version)
+    if message_type == TIME_REQUEST:
+        return PROBE.pack(message.get("seq") or 0)
+    if message_type == TIME_RESPONSE:
+        return (structs[RESPONSE].pack(wire(message["time"]), message.get("seq") or 0)
+                + message.get("client_id", "").encode('utf-8'))
+    if message_type == TIME_ADJUSTMENT:
+        # O tempo de referência é opcional; sem ele o quadro é o da versão anterior
+        if message.get("reference") is None:
+            return structs[TIMESTAMP].pack(wire(message["adjustment"]))
+        return structs[ADJUSTMENT].pack(wire(message["adjustment"]), wire(message["reference"]))
+    if message_type == AGGREGATE_REQUEST:
+        return PROBE.pack(message.get("seq") or 0)
+    if message_type == AGGREGATE_RESPONSE:
+        return (structs[AGGREGATE].pack(message.get("seq") or 0, wire(message["sum"]), message["count"],
+                                        wire(message["min_offset"]), wire(message["max_offset"]))
+                + message.get("client_id", "").encode('utf-8'))
+    if message_type == UDP_REGISTER:
+        return PORT.pack(message["port"])
+    role = ROLES.index(message.get("role", "client"))
+    if message.get("confidence") is None:
+        return ROLE.pack(role) + message.get("client_id", "").encode('utf-8')
+    return (ROLE.pack(role | HAS_CONFIDENCE) + CONFIDENCE.pack(message["confidence"])
+            + message.get("client_id", "").encode('utf-8'))
+
+def _unpack_payload(message_type, payload, version):
+    name = MESSAGE_NAMES.get(message_type)
+    if name is None:
+        raise ProtocolError(f"Tipo de mensagem desconhecido: {message_type}")
+    structs = TIME_STRUCTS[version]
+    local = _from_wire(version)
+
+    if message_type == TIME_REQUEST:
+        message = {"type": name}
+        if len(payload) >= PROBE.size:
+            (seq,) = PROBE.unpack_from(payload)
+            if seq:
+                message["seq"] = seq
+        return message
+    if message_type == TIME_RESPONSE:
+        client_time, seq = structs[RESPONSE].unpack_from(payload)
+        message = {"type": name, "time": local(client_time),
+                   "client_id": bytes(payload[structs[RESPONSE].size:]).decode('utf-8')}
+        if seq:
+            message["seq"] = seq
+        return message
+    if message_type == TIME_ADJUSTMENT:
+        if len(payload) >= structs[ADJUSTMENT].size:
+            adjustment, reference = structs[ADJUSTMENT].unpack_from(payload)
+            return {"type": name, "adjustment": local(adjustment), "reference": local(reference)}
+        (adjustment,) = structs[TIMESTAMP].unpack_from(payload)
+        return {"type": name, "adjustment": local(adjustment)}
+    if message_type == AGGREGATE_REQUEST:
+        (seq,) = PROBE.unpack_from(payload)
+        return {"type": name, "seq": seq}
+    if message_type == AGGREGATE_RESPONSE:
+        seq, total, count, min_offset, max_offset = structs[AGGREGATE].unpack_from(payload)
+        return {"type": name, "seq": seq, "sum": local(total), "count": count,
+                "min_offset": local(min_offset), "max_offset": local(max_offset),
+                "client_id": bytes(payload[structs[AGGREGATE].size:]).decode('utf-8')}
+    if message_type == UDP_REGISTER:
+        (port,) = PORT.unpack_from(payload)
+        return {"type": name, "port": port}
+    (role,) = ROLE.unpack_from(payload)
+    offset = ROLE.size
+    message = {"type": name}
+    if role & HAS_CONFIDENCE:
+        (message["confidence"],) = CONFIDENCE.unpack_from(payload, offset)
+        offset += CONFIDENCE.size
+        role &= ~HAS_CONFIDENCE
+    if role >= len(ROLES):
+        raise ProtocolError(f"Papel desconhecido: {role}")
+    message["role"] = ROLES[role]
+    message["client_id"] = bytes(payload[offset:]).decode('utf-8')
+    return message
+
+# Um datagrama UDP carrega exatamente um quadro binário
+def decode_datagram(data):
+    if len(data) < HEADER.size:
+        raise ProtocolError("Datagrama curto demais")
+    version, message_type, length = HEADER.unpack_from(data)
+    if version not in TIME_STRUCTS or len(data) != HEADER.size + length:
+        raise ProtocolError("Datagrama inválido")
+    try:
+        return _unpack_payload(message_type, memoryview(data)[HEADER.size:], version)
+    except (struct.error, UnicodeDecodeError) as e:
+        raise ProtocolError(f"Datagrama inválido: {e}")
+
+# Decodificador incremental: acumula bytes recebidos e devolve apenas mensagens
+# completas, independentemente de como o TCP agrupou ou dividiu os segmentos
+class MessageDecoder:
+    def __init__(self):
+        self.buffer = bytearray()
+        self.version = None  # Última versão vista do outro lado
+        self._json = json.JSONDecoder()
+
+    def feed(self, data):
+        self.buffer += data
+        messages = []
+        while True:
+            message = self._next_message()
+            if message is None:
+                return messages
+            messages.append(message)
+
+    def _next_message(self):
+        buffer = self.buffer
+        while buffer[:1].isspace():
+            del buffer[:1]
+        if not buffer:
+            return None
+
+        if buffer[0] == ord('{'):
+            return self._next_legacy_message()
+
+        if buffer[0] != VERSION_JSON and buffer[0] not in TIME_STRUCTS:
+            raise ProtocolError(f"Versão de protocolo não suportada: {buffer[0]}")
+        if len(buffer) < HEADER.size:
+            return None
+
+        version, message_type, length = HEADER.unpack_from(buffer)
+        end = HEADER.size + length
+        if len(buffer) < end:
+            return None
+
+        payload = memoryview(buffer)[HEADER.size:end]
+        try:
+            if version == VERSION_JSON:
+                message = _convert_fields(json.loads(bytes(payload).decode('utf-8')), _nanos)
+            else:
+                message = _unpack_payload(message_type, payload, version)
+        finally:
+            payload.release()
+        del buffer[:end]
+        self.version = version
+        return message
+
+    def _next_legacy_message(self):
+        try:
+            text = self.buffer.decode('utf-8', 'surrogateescape')
+            message, end = self._json.raw_decode(text)
+        except json.JSONDecodeError:
+            # Mensagem ainda incompleta
+            if len(self.buffer) > MAX_LEGACY_BUFFER:
+                raise ProtocolError("Mensagem JSON incompleta excedeu o limite do buffer")
+            return None
+        del self.buffer[:len(text[:end].encode('utf-8', 'surrogateescape'))]
+        self.version = LEGACY_JSON
+        return _convert_fields(message, _nanos)
+
+# Fluxo bloqueante sobre um socket TCP com leitura bufferizada. Com adaptive=True
+# as mensagens são enviadas na mesma versão de protocolo usada pelo outro lado
+class SocketStream:
+    __slots__ = ('socket', 'version', 'adaptive', 'recv_size', 'decoder', 'pending')
+
+    def __init__(self, sock, version=LEGACY_JSON, adaptive=True, recv_size=65536):
+        self.socket = sock
+        self.version = version
+        self.adaptive = adaptive
+        self.recv_size = recv_size
+        self.decoder = MessageDecoder()
+        self.pending = deque()
+
+    def send_message(self, message):
+        self.socket.sendall(encode_message(message, self.version))
+
+    def recv_message(self):
+        while not self.pending:
+            data = self.socket.recv(self.recv_size)
+            if not data:
+                return None
+            self.pending.extend(self.decoder.feed(data))
+            if self.adaptive and self.decoder.version is not None:
+                self.version = self.decoder.version
+        return self.pending.popleft()
+
+    def close(self):
+        self.socket.close()
@@ -0,0 +1,94 @@
+import threading
+import time
+
+# Estado por cliente mantido pelo coordenador. As classes de conexão (threads e
+# asyncio) herdam estes métodos e declaram STATE_SLOTS nos seus __slots__, de
+# modo que cada registro ocupa espaço fixo, sem __dict__
+class ClientState:
+    __slots__ = ()
+    STATE_SLOTS = ('client_id', 'role', 'group', 'udp_address', 'probe_seq', 'rtt', 'rtt_uncertainty',
+                   'last_offset', 'drift', 'last_seen', 'last_adjusted', 'confidence')
+
+    def init_state(self):
+        self.client_id = None
+        self.role = "client"
+        self.group = None  # Agregado do grupo quando o cliente é um subcoordenador
+        self.udp_address = None  # Endereço registrado para sondas UDP
+        self.probe_seq = 0
+        self.rtt = None
+        self.rtt_uncertainty = None
+        self.last_offset = None  # Offset em relação ao coordenador na última rodada
+        self.drift = None  # Deriva relativa ao coordenador (s/s)
+        self.last_seen = time.monotonic()
+        self.last_adjusted = None
+        self.confidence = None  # Confiança no estado restaurado anunciada no hello
+
+    def record_offset(self, offset, rtt, uncertainty, now=None):
+        # Depois de um ajuste o cliente fica no tempo médio, junto com o
+        # coordenador; o offset medido na rodada seguinte é o quanto ele se
+        # afastou desde então
+        now = time.monotonic() if now is None else now
+        if self.last_adjusted is not None and now > self.last_adjusted:
+            self.drift = offset / (now - self.last_adjusted)
+        self.last_offset = offset
+        self.rtt = rtt
+        self.rtt_uncertainty = uncertainty
+
+    def mark_adjusted(self, now=None):
+        self.last_adjusted = time.monotonic() if now is None else now
+
+    def trusted(self, min_confidence):
+        # Um relógio retomado de estado salvo só entra na média antes do primeiro
+        # ajuste desta conexão se a confiança no estado for suficiente
+        return self.confidence is None or self.last_adjusted is not None or self.confidence >= min_confidence
+
+    @property
+    def name(self):
+        return self.client_id or "Desconhecido"
+
+# Registro dos clientes conectados: conjunto ordenado de conexões mais um índice
+# por client_id. Entrada, saída e busca são O(1); o lock protege apenas as
+# operações nos dicionários, nunca E/S
+class ClientRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.records = {}  # conexão -> None, na ordem de chegada
+        self.by_id = {}
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, record):
+        return record in self.records
+
+    def add(self, record):
+        with self.lock:
+            self.records[record] = None
+            return len(self.records)
+
+    def remove(self, record):
+        with self.lock:
+            self.records.pop(record, None)
+            if record.client_id is not None and self.by_id.get(record.client_id) is record:
+                del self.by_id[record.client_id]
+            return len(self.records)
+
+    def identify(self, record, client_id):
+        # Devolve a outra conexão que usava o mesmo id (reconexão ou id duplicado)
+        if not client_id or record.client_id == client_id:
+            return None
+        with self.lock:
+            if record.client_id is not None and self.by_id.get(record.client_id) is record:
+                del self.by_id[record.client_id]
+            record.client_id = client_id
+            previous = self.by_id.get(client_id)
+            if record in self.records:
+                self.by_id[client_id] = record
+            return previous if previous is not record else None
+
+    def get(self, client_id):
+        return self.by_id.get(client_id)
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.records)
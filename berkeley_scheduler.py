@@ -0,0 +1,61 @@
+import time
+
+# Intervalo fixo entre rodadas (comportamento original do coordenador)
+class FixedScheduler:
+    def __init__(self, interval=20.0, min_interval=2.0):
+        self.interval = interval
+        self.min_interval = min_interval
+        self.last_round = None
+
+    def record_round(self, spread, error, now=None):
+        self.last_round = time.monotonic() if now is None else now
+        return self.interval
+
+    def early_round_delay(self, now=None):
+        if self.last_round is None:
+            return 0.0
+        now = time.monotonic() if now is None else now
+        return max(0.0, self.last_round + self.min_interval - now)
+
+# Escolhe o intervalo até a próxima rodada a partir do erro observado:
+#   - spread: maior afastamento dos relógios em relação à média antes do ajuste
+#   - error: erro logo após o ajuste, o maior entre o afastamento de quem ficou
+#     sem ajuste e a incerteza das amostras
+# A taxa de divergência entre rodadas é (spread atual - erro da rodada anterior) /
+# intervalo; a próxima rodada é marcada para quando o erro previsto atingir
+# target_accuracy (com margem de segurança). O intervalo cresce no máximo
+# 'growth' vezes por rodada quando o cluster está estável e cai imediatamente
+# quando o erro aumenta, sempre dentro de [min_interval, max_interval].
+class AdaptiveScheduler(FixedScheduler):
+    def __init__(self, min_interval=2.0, max_interval=300.0, target_accuracy=0.05,
+                 initial_interval=20.0, growth=2.0, safety=0.5):
+        super().__init__(initial_interval, min_interval)
+        self.max_interval = max_interval
+        self.target_accuracy = target_accuracy
+        self.growth = growth
+        self.safety = safety
+        self.last_error = None
+        self.divergence_rate = None
+
+    def record_round(self, spread, error, now=None):
+        now = time.monotonic() if now is None else now
+
+        if self.last_round is not None and self.last_error is not None:
+            elapsed = now - self.last_round
+            if elapsed > 0:
+                self.divergence_rate = max(0.0, spread - self.last_error) / elapsed
+
+        if error >= self.target_accuracy:
+            interval = self.min_interval
+        elif self.divergence_rate is None:
+            interval = self.interval
+        elif self.divergence_rate == 0:
+            interval = self.interval * self.growth
+        else:
+            interval = self.safety * (self.target_accuracy - error) / self.divergence_rate
+
+        interval = min(interval, self.interval * self.growth)
+        self.interval = max(self.min_interval, min(self.max_interval, interval))
+        self.last_round = now
+        self.last_error = error
+        return self.interval
@@ -0,0 +1,460 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import sys
+import time
+from multiprocessing import shared_memory
+from multiprocessing.connection import wait
+
+import numpy as np
+
+from berkeley_async_coordinator import AsyncBerkeleyCoordinator, raise_file_limit
+from berkeley_averaging import MeanAveraging, create_engine
+from berkeley_clock import NANOS, MonotonicClock, divide, to_seconds
+from berkeley_coordinator import combine_groups, notify_ready
+from berkeley_logging import setup_logging
+from berkeley_metrics import Metrics, resident_memory, start_metrics_server
+from berkeley_scheduler import AdaptiveScheduler
+
+log = logging.getLogger("berkeley.sharded")
+
+# Coordenador em vários processos: N workers asyncio escutam na mesma porta com
+# SO_REUSEPORT e o kernel distribui as conexões entre eles. Cada worker sonda
+# apenas os seus clientes e grava na memória compartilhada a soma, a contagem e
+# os extremos dos offsets aceitos pelo método de média (o mesmo agregado que os
+# subcoordenadores enviam). O líder combina os agregados na média global, grava
+# o resultado na área de controle e os workers enviam os ajustes por cliente.
+#
+# Os comandos de cada rodada (collect/adjust) e as confirmações trafegam por um
+# Pipe por worker; os dados da rodada ficam somente na memória compartilhada.
+# O relógio do coordenador (âncora de época e offset em ns, ver berkeley_clock)
+# também fica na área de controle, de modo que todos os workers sondam com a
+# mesma referência.
+#
+# Como no caso dos subcoordenadores, o método de média é aplicado dentro de cada
+# shard e o líder faz a média simples dos agregados.
+
+# Instantes e offsets em nanossegundos inteiros
+CONTROL_DTYPE = np.dtype([
+    ('base', '<i8'),            # Âncora de época do relógio do líder
+    ('clock_offset', '<i8'),    # Offset do relógio do coordenador (escrito pelo líder)
+    ('round', '<u8'),
+    ('reference', '<i8'),       # Tempo do coordenador no início da rodada
+    ('average_offset', '<i8'),  # Média global - referência, publicada pelo líder
+])
+
+SHARD_DTYPE = np.dtype([
+    ('round', '<u8'),           # Rodada a que o agregado pertence
+    ('sum', '<i8'),
+    ('count', '<u8'),
+    ('min_offset', '<i8'),
+    ('max_offset', '<i8'),
+    ('max_rtt', '<f8'),         # Maior RTT entre as amostras aceitas (s)
+    ('connected', '<u4'),
+    ('requested', '<u4'),
+    ('responded', '<u4'),
+    ('undelivered', '<u4'),
+    ('cpu_seconds', '<f8'),
+    ('memory_bytes', '<u8'),
+])
+
+# Bloco de memória compartilhada: área de controle seguida de um registro por
+# worker, acessados como arrays estruturados do NumPy sem cópia
+class SharedAggregation:
+    def __init__(self, workers, name=None):
+        size = CONTROL_DTYPE.itemsize + workers * SHARD_DTYPE.itemsize
+        self.owner = name is None
+        self.memory = shared_memory.SharedMemory(name=name, create=self.owner, size=size if self.owner else 0)
+        self.control = np.ndarray((), CONTROL_DTYPE, buffer=self.memory.buf)
+        self.shards = np.ndarray((workers,), SHARD_DTYPE, buffer=self.memory.buf, offset=CONTROL_DTYPE.itemsize)
+        if self.owner:
+            self.control.fill(0)
+            self.shards.fill(0)
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    def clock_offset(self):
+        return int(self.control['clock_offset'])
+
+    def close(self):
+        # As visões do NumPy precisam ser liberadas antes de fechar o bloco
+        del self.control, self.shards
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+# Worker: coordenador asyncio que só executa as fases pedidas pelo líder
+class ShardWorker(AsyncBerkeleyCoordinator):
+    def __init__(self, index, aggregation, control, host='localhost', port=5000, **options):
+        super().__init__(host, port, reuse_port=True, **options)
+        self.index = index
+        self.aggregation = aggregation
+        self.control = control
+        self.join_notified = False
+        self.round_state = None  # (rodada, referência, respostas) da última coleta
+        # O monotônico é o mesmo em todos os processos do host; a âncora e o
+        # offset vêm do líder
+        self.clock = MonotonicClock(aggregation.clock_offset(), int(aggregation.control['base']))
+
+    def publish_status(self):
+        self.aggregation.shards['connected'][self.index] = len(self.registry)
+        self.aggregation.shards['cpu_seconds'][self.index] = time.process_time()
+        self.aggregation.shards['memory_bytes'][self.index] = resident_memory() or 0
+
+    def request_early_round(self):
+        # Uma notificação por rodada basta para o líder antecipar a próxima
+        self.aggregation.shards['connected'][self.index] = len(self.registry)
+        if not self.join_notified:
+            self.join_notified = True
+            self.control.send(("joined", self.index))
+
+    async def handle_client_async(self, reader, writer):
+        try:
+            await super().handle_client_async(reader, writer)
+        finally:
+            self.aggregation.shards['connected'][self.index] = len(self.registry)
+
+    async def run(self):
+        self.round_requested = asyncio.Event()
+        server = await asyncio.start_server(self.handle_client_async, sock=self.server_socket,
+                                            backlog=self.backlog)
+        loop = asyncio.get_running_loop()
+        commands = asyncio.Queue()
+        loop.add_reader(self.control.fileno(), lambda: commands.put_nowait(self.control.recv()))
+        self.publish_status()
+        self.control.send(("ready", self.index))
+
+        async with server:
+            while True:
+                command, round_number = await commands.get()
+                self.join_notified = False
+                self.clock.offset = self.aggregation.clock_offset()
+                if command == "collect":
+                    await self.collect_round(round_number)
+                elif command == "adjust":
+                    await self.adjust_round(round_number)
+                elif command == "status":
+                    self.publish_status()
+                    self.control.send(("status", round_number))
+                elif command == "stop":
+                    break
+        loop.remove_reader(self.control.fileno())
+
+    async def collect_round(self, round_number):
+        reference = int(self.aggregation.control['reference'])
+        with self.metrics.time_phase("collect"):
+            client_responses = await self.collect_client_times_async(reference)
+
+        offsets = np.fromiter((client_time - reference for _, client_time, _ in client_responses),
+                              dtype=np.int64, count=len(client_responses))
+        rtts = np.fromiter((client.rtt or 0.0 for client, _, _ in client_responses),
+                           dtype=np.float64, count=len(client_responses))
+
+        total, count = 0, 0
+        min_offset, max_offset, max_rtt = 0, 0, 0.0
+        if offsets.size:
+            trusted = np.fromiter((client.trusted(self.trust_confidence) for client, _, _ in client_responses),
+                                  dtype=bool, count=len(client_responses))
+            _, used = self.average_offsets(offsets, rtts, trusted)
+            if used.any():
+                total, count = int(offsets[used].sum()), int(used.sum())
+                min_offset, max_offset = int(offsets[used].min()), int(offsets[used].max())
+                max_rtt = float(rtts[used].max())
+
+        group_sum, group_count, group_min, group_max = combine_groups(client_responses, reference)
+        if group_count:
+            min_offset = group_min if not count else min(min_offset, group_min)
+            max_offset = group_max if not count else max(max_offset, group_max)
+            total += group_sum
+            count += group_count
+
+        shards = self.aggregation.shards
+        shards['sum'][self.index] = total
+        shards['count'][self.index] = count
+        shards['min_offset'][self.index] = min_offset
+        shards['max_offset'][self.index] = max_offset
+        shards['max_rtt'][self.index] = max_rtt
+        shards['requested'][self.index] = len(self.registry)
+        shards['responded'][self.index] = len(client_responses)
+        shards['round'][self.index] = round_number
+        self.round_state = (round_number, reference, client_responses)
+        self.control.send(("collected", round_number))
+
+    async def adjust_round(self, round_number):
+        undelivered = ()
+        if self.round_state is not None and self.round_state[0] == round_number:
+            _, reference, client_responses = self.round_state
+            average_time = reference + int(self.aggregation.control['average_offset'])
+            with self.metrics.time_phase("adjust"):
+                undelivered = await self.deliver_adjustments([(client, client_id, average_time - client_time,
+                                                               client_time)
+                                                              for client, client_time, client_id in client_responses])
+        self.round_state = None
+        self.aggregation.shards['undelivered'][self.index] = len(undelivered)
+        self.publish_status()
+        self.control.send(("adjusted", round_number))
+
+def shard_main(index, host, port, memory_name, workers, control, options, log_levels=None):
+    raise_file_limit()
+    setup_logging(levels=log_levels)
+    aggregation = SharedAggregation(workers, memory_name)
+    worker = ShardWorker(index, aggregation, control, host, port, **options)
+    try:
+        asyncio.run(worker.run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        worker.server_socket.close()
+        aggregation.close()
+        control.close()
+
+# Líder: não atende clientes; dispara as rodadas, combina os agregados dos
+# workers e mantém o relógio do coordenador e o agendamento das rodadas
+class ShardedCoordinator:
+    def __init__(self, host='localhost', port=5000, workers=None, probes_per_client=4, probe_timeout=5.0,
+                 averaging=None, aggregate_timeout=10.0, scheduler=None, metrics=None, quorum=1,
+                 startup_timeout=5.0, backlog=4096, log_levels=None):
+        self.host = host
+        self.workers = workers or os.cpu_count() or 1
+        self.probe_timeout = probe_timeout
+        self.aggregate_timeout = aggregate_timeout
+        self.averaging = averaging or MeanAveraging()
+        self.scheduler = scheduler or AdaptiveScheduler()
+        self.metrics = metrics or Metrics()
+        self.quorum = quorum
+        self.startup_timeout = startup_timeout
+        self.worker_options = {"probes_per_client": probes_per_client, "round_timeout": probe_timeout,
+                               "averaging": self.averaging, "backlog": backlog}
+        self.aggregation = SharedAggregation(self.workers)
+        self.clock = MonotonicClock(random.randint(-10, 10) * NANOS)
+        self.aggregation.control['base'] = self.clock.base
+        self.aggregation.control['clock_offset'] = self.clock.offset
+        self.log_levels = log_levels  # Níveis de log dos workers (padrão: BERKELEY_LOG_LEVELS)
+        self.round_number = 0
+        self.processes = []
+        self.controls = []
+        self.round_requested = False
+
+        # Socket só vinculado (sem listen) para reservar a porta, inclusive a
+        # efêmera quando port=0; as conexões vão apenas para os workers
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.server_socket.bind((host, port))
+        self.port = self.server_socket.getsockname()[1]
+
+    @property
+    def clock_offset(self):
+        return to_seconds(self.clock.offset)
+
+    def get_current_time(self):
+        return self.clock.now()
+
+    def connected(self):
+        return int(self.aggregation.shards['connected'].sum())
+
+    def launch(self):
+        context = multiprocessing.get_context("spawn")
+        for index in range(self.workers):
+            control, child_control = context.Pipe()
+            process = context.Process(target=shard_main, daemon=True,
+                                      args=(index, self.host, self.port, self.aggregation.name, self.workers,
+                                            child_control, self.worker_options, self.log_levels))
+            process.start()
+            child_control.close()
+            self.processes.append(process)
+            self.controls.append(control)
+        ready = self.gather("ready", None, time.monotonic() + 30)
+        if len(ready) < self.workers:
+            raise RuntimeError(f"Apenas {len(ready)} de {self.workers} workers iniciaram")
+        log.info("[COORDENADOR] %d workers escutando em %s:%d (SO_REUSEPORT)", self.workers, self.host, self.port)
+
+    def gather(self, reply, round_number, deadline):
+        # Espera a confirmação 'reply' da rodada de cada worker até o prazo;
+        # avisos de novos clientes recebidos no caminho antecipam a próxima rodada
+        pending = set(self.controls)
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            for control in wait(list(pending), remaining):
+                try:
+                    message = control.recv()
+                except EOFError:
+                    log.error("[ERRO] Worker %d encerrado", self.controls.index(control))
+                    pending.discard(control)
+                    continue
+                if message[0] == "joined":
+                    self.round_requested = True
+                elif message[0] == reply and (round_number is None or message[1] == round_number):
+                    pending.discard(control)
+        return [control for control in self.controls if control not in pending]
+
+    def broadcast(self, command, round_number):
+        for control in self.controls:
+            try:
+                control.send((command, round_number))
+            except (OSError, ValueError) as e:
+                log.error("[ERRO] Falha ao enviar comando ao worker %d: %s", self.controls.index(control), e)
+
+    def wait_for_events(self, timeout):
+        # Processa avisos dos workers até o prazo ou até um novo cliente chegar
+        deadline = time.monotonic() + timeout
+        while not self.round_requested:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            for control in wait(self.controls, remaining):
+                try:
+                    if control.recv()[0] == "joined":
+                        self.round_requested = True
+                except EOFError:
+                    raise RuntimeError("Worker encerrado inesperadamente")
+
+    def refresh_status(self):
+        self.round_number += 1
+        self.broadcast("status", self.round_number)
+        self.gather("status", self.round_number, time.monotonic() + 5)
+
+    def cpu_seconds(self):
+        return time.process_time() + float(self.aggregation.shards['cpu_seconds'].sum())
+
+    def memory_bytes(self):
+        return (resident_memory() or 0) + int(self.aggregation.shards['memory_bytes'].sum())
+
+    def start(self):
+        self.launch()
+        notify_ready(self.port)
+        log.info("[COORDENADOR] Pronto: escutando em %s:%d. Aguardando %d cliente(s) (no máximo %.1fs)...",
+                 self.host, self.port, self.quorum, self.startup_timeout)
+        deadline = time.monotonic() + self.startup_timeout
+
+        try:
+            while self.connected() < self.quorum and time.monotonic() < deadline:
+                self.round_requested = False
+                self.wait_for_events(min(0.02, max(0.0, deadline - time.monotonic())))
+
+            while True:
+                num_clients = self.connected()
+                if num_clients > 0:
+                    log.info("[COORDENADOR] %d clientes conectados em %d workers. Iniciando sincronização...",
+                             num_clients, self.workers)
+                    self.round_requested = False
+                    spread, error = self.synchronize_clocks()
+                    interval = self.scheduler.record_round(spread, error)
+                    self.metrics.set_gauge("next_round_interval_seconds", interval)
+                    log.info("[COORDENADOR] Próxima sincronização em %.1f segundos...", interval)
+                    self.wait_for_next_round(interval)
+                else:
+                    log.info("[COORDENADOR] Aguardando clientes para iniciar sincronização...")
+                    self.wait_for_next_round(5)
+        except KeyboardInterrupt:
+            log.info("[COORDENADOR] Encerrado pelo usuário")
+        finally:
+            self.stop()
+
+    def wait_for_next_round(self, interval):
+        self.wait_for_events(interval)
+        if self.round_requested:
+            self.round_requested = False
+            time.sleep(self.scheduler.early_round_delay())
+
+    def synchronize_clocks(self):
+        with self.metrics.time_phase("round"):
+            self.round_number += 1
+            round_number = self.round_number
+            coordinator_time = self.get_current_time()
+            control = self.aggregation.control
+            control['reference'] = coordinator_time
+            control['round'] = round_number
+
+            with self.metrics.time_phase("collect"):
+                self.broadcast("collect", round_number)
+                self.gather("collected", round_number,
+                            time.monotonic() + self.probe_timeout + self.aggregate_timeout + 1.0)
+
+            # Agregados desta rodada; o coordenador entra com offset 0
+            shards = self.aggregation.shards
+            current = shards[shards['round'] == round_number]
+            counted = current[current['count'] > 0]
+            count = int(counted['count'].sum()) + 1
+            mean_offset = divide(int(counted['sum'].sum()), count)
+            min_offset = min(0, int(counted['min_offset'].min())) if counted.size else 0
+            max_offset = max(0, int(counted['max_offset'].max())) if counted.size else 0
+            spread = to_seconds(max(abs(min_offset - mean_offset), abs(max_offset - mean_offset)))
+            uncertainty = float(counted['max_rtt'].max()) / 2 if counted.size else 0.0
+
+            # Publica a média e ajusta o relógio do coordenador antes dos ajustes
+            control['average_offset'] = mean_offset
+            self.clock.adjust(mean_offset)
+            control['clock_offset'] = self.clock.offset
+
+            with self.metrics.time_phase("adjust"):
+                self.broadcast("adjust", round_number)
+                self.gather("adjusted", round_number, time.monotonic() + self.probe_timeout + 1.0)
+
+            requested = int(current['requested'].sum())
+            responded = int(current['responded'].sum())
+            undelivered = int(shards['undelivered'][shards['round'] == round_number].sum())
+
+        metrics = self.metrics
+        metrics.inc("rounds_total")
+        metrics.set_gauge("clients_connected", self.connected())
+        metrics.set_gauge("clients_requested", requested)
+        metrics.set_gauge("clients_responded", responded)
+        if requested > responded:
+            metrics.inc("clients_unresponsive_total", requested - responded)
+        if len(current) < self.workers:
+            metrics.inc("errors_total", self.workers - len(current), kind="shard_timeout")
+            log.warning("[COORDENADOR] %d de %d workers não responderam a tempo",
+                        self.workers - len(current), self.workers)
+        metrics.set_gauge("clocks_last_round", count)
+        metrics.set_gauge("spread_seconds", spread)
+        metrics.set_gauge("uncertainty_seconds", uncertainty)
+        adjustment = to_seconds(mean_offset)
+        metrics.set_gauge("coordinator_adjustment_seconds", adjustment)
+        metrics.set_gauge("last_round_timestamp_seconds", time.time())
+
+        log.info("[COORDENADOR] Rodada concluída: %d relógios em %d workers, ajuste do coordenador %+.6fs, "
+                 "afastamento %.6fs, incerteza ±%.6fs", count, len(current), adjustment, spread, uncertainty,
+                 extra={"fields": {"event": "round", "clocks": count, "workers": len(current),
+                                   "average_offset": adjustment, "adjustment": adjustment,
+                                   "spread": spread, "uncertainty": uncertainty,
+                                   "undelivered": undelivered, "averaging": self.averaging.name}})
+        return spread, uncertainty
+
+    def stop(self):
+        # Com Ctrl+C os workers recebem o sinal junto e podem já ter saído
+        for control in self.controls:
+            try:
+                control.send(("stop", 0))
+            except (OSError, ValueError):
+                pass
+        for process in self.processes:
+            process.join(timeout=2)
+            if process.is_alive():
+                process.terminate()
+        for control in self.controls:
+            control.close()
+        self.server_socket.close()
+        self.aggregation.close()
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    averaging = create_engine(sys.argv[3]) if len(sys.argv) > 3 else None
+
+    raise_file_limit()
+    setup_logging()
+    coordinator = ShardedCoordinator(port=port, workers=workers, averaging=averaging,
+                                     quorum=int(os.environ.get("BERKELEY_QUORUM", 1)))
+    start_metrics_server(coordinator.metrics)
+    # A memória compartilhada sobrevive ao processo: SIGTERM também passa pelo stop()
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    coordinator.start()
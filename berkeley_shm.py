@@ -0,0 +1,150 @@
+import mmap
+import os
+import struct
+import sys
+import time
+from datetime import datetime
+
+# Publicação do relógio sincronizado do cliente num arquivo mapeado em memória,
+# para que outros processos do host obtenham o tempo sem IPC nem sockets.
+#
+# Layout (little-endian, 88 bytes, alinhado para leitura direta em C/Rust):
+#   0   4s   magic "BKLY"
+#   4   u32  versão do layout
+#   8   u64  seq: contador do seqlock (ímpar = escrita em andamento)
+#   16  f64  base: tempo de parede - relógio monotônico no momento da publicação
+#   24  f64  offset: correção do relógio na referência (s)
+#   32  f64  drift: taxa de deriva compensada (s/s)
+#   40  f64  reference: instante monotônico de referência da deriva
+#   48  f64  slew_amount: parcela de ajuste aplicada gradualmente (s)
+#   56  f64  slew_start: instante monotônico de início do slew
+#   64  f64  slew_duration: duração do slew (s)
+#   72  f64  last_sync: tempo sincronizado do último ajuste (0 = nunca)
+#   80  u32  flags (bit 0: sincronizado)
+#
+# Tempo sincronizado no instante monotônico m:
+#   m + base + offset + drift * (m - reference)
+#     + slew_amount * min(1, (m - slew_start) / slew_duration)
+#
+# O escritor incrementa seq antes e depois de gravar os parâmetros; o leitor
+# repete a leitura enquanto seq for ímpar ou mudar durante a cópia, por até
+# REFRESH_TIMEOUT segundos. Um novo publicador continua o seq do arquivo.
+
+MAGIC = b"BKLY"
+LAYOUT_VERSION = 1
+HEADER = struct.Struct('<4sI')
+SEQ = struct.Struct('<Q')
+PARAMS = struct.Struct('<8dI4x')
+SEQ_OFFSET = HEADER.size
+PARAMS_OFFSET = SEQ_OFFSET + SEQ.size
+SIZE = PARAMS_OFFSET + PARAMS.size
+SYNCHRONIZED = 1
+# Tempo máximo (s) que o leitor espera por uma escrita em andamento
+REFRESH_TIMEOUT = 1.0
+
+class ClockPublisher:
+    def __init__(self, path):
+        self.path = path
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, SIZE)
+            self.map = mmap.mmap(fd, SIZE)
+        finally:
+            os.close(fd)
+        # Arquivo já publicado: continua o seq a partir do valor atual, para que
+        # leitores com seq em cache percebam o novo publicador. Um seq ímpar
+        # (escritor anterior morto no meio da escrita) é arredondado para par
+        if HEADER.unpack_from(self.map, 0) == (MAGIC, LAYOUT_VERSION):
+            (seq,) = SEQ.unpack_from(self.map, SEQ_OFFSET)
+            self.seq = (seq + 1) // 2 * 2 + 2
+        else:
+            self.seq = 0
+            HEADER.pack_into(self.map, 0, MAGIC, LAYOUT_VERSION)
+        SEQ.pack_into(self.map, SEQ_OFFSET, self.seq)
+
+    def publish(self, offset, drift, reference, slew_amount=0.0, slew_start=0.0, slew_duration=0.0,
+                last_sync=0.0, synchronized=False, base=None):
+        # base: âncora de época do relógio do cliente; sem ela, a do momento
+        base = time.time() - time.monotonic() if base is None else base
+        self.seq += 1
+        SEQ.pack_into(self.map, SEQ_OFFSET, self.seq)
+        PARAMS.pack_into(self.map, PARAMS_OFFSET, base, offset, drift, reference, slew_amount,
+                         slew_start, slew_duration or 1.0, last_sync,
+                         SYNCHRONIZED if synchronized else 0)
+        self.seq += 1
+        SEQ.pack_into(self.map, SEQ_OFFSET, self.seq)
+
+    def close(self):
+        self.map.close()
+
+# Leitor: além da leitura do relógio monotônico, now() faz apenas acessos à
+# memória mapeada. Cada thread deve usar o seu próprio leitor
+class SharedClockReader:
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            self.map = mmap.mmap(file.fileno(), SIZE, access=mmap.ACCESS_READ)
+        magic, version = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != LAYOUT_VERSION:
+            self.map.close()
+            raise ValueError(f"Arquivo de relógio inválido: {path}")
+        self.seq = None
+        self.params = None
+        self.refresh()
+
+    def read(self):
+        # Parâmetros em cache enquanto o seq não mudar: uma leitura de 8 bytes
+        if SEQ.unpack_from(self.map, SEQ_OFFSET)[0] != self.seq:
+            self.refresh()
+        return self.params
+
+    def refresh(self):
+        deadline = None
+        while True:
+            (seq,) = SEQ.unpack_from(self.map, SEQ_OFFSET)
+            if not seq & 1:
+                params = PARAMS.unpack_from(self.map, PARAMS_OFFSET)
+                if SEQ.unpack_from(self.map, SEQ_OFFSET)[0] == seq:
+                    break
+            # Escrita em andamento: cede a CPU ao escritor, mas não indefinidamente
+            # (um publicador morto no meio da escrita deixa o seq ímpar)
+            now = time.monotonic()
+            if deadline is None:
+                deadline = now + REFRESH_TIMEOUT
+            elif now > deadline:
+                raise RuntimeError(f"Relógio compartilhado sem escrita concluída há {REFRESH_TIMEOUT}s "
+                                   f"(seq {seq})")
+            time.sleep(0)
+        base, offset, drift, reference, slew_amount, slew_start, slew_duration, _, _ = params
+        # Forma linear pré-calculada: tempo = scale * m + constant (+ slew)
+        self.scale = 1.0 + drift
+        self.constant = base + offset - drift * reference
+        self.slew_amount = slew_amount
+        self.slew_start = slew_start
+        self.slew_duration = slew_duration
+        self.seq, self.params = seq, params
+
+    def now(self, monotonic=None):
+        m = time.monotonic() if monotonic is None else monotonic
+        if SEQ.unpack_from(self.map, SEQ_OFFSET)[0] != self.seq:
+            self.refresh()
+        if self.slew_amount:
+            return (self.scale * m + self.constant
+                    + self.slew_amount * min(1.0, (m - self.slew_start) / self.slew_duration))
+        return self.scale * m + self.constant
+
+    def synchronized(self):
+        return bool(self.read()[8] & SYNCHRONIZED)
+
+    def last_sync(self):
+        return self.read()[7]
+
+    def close(self):
+        self.map.close()
+
+if __name__ == "__main__":
+    reader = SharedClockReader(sys.argv[1])
+    synchronized = reader.now()
+    print(f"Tempo sincronizado: {datetime.fromtimestamp(synchronized).strftime('%H:%M:%S.%f')}")
+    print(f"Diferença para o relógio local: {synchronized - time.time():+.6f}s")
+    print(f"Sincronizado: {'sim' if reader.synchronized() else 'não'}")
+    reader.close()
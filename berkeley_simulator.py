@@ -0,0 +1,386 @@
+import argparse
+import heapq
+import json
+import logging
+import time
+
+import numpy as np
+
+from berkeley_averaging import create_engine
+from berkeley_client import MIN_DRIFT_INTERVAL
+from berkeley_clock import NANOS
+from berkeley_logging import setup_logging
+from berkeley_scheduler import AdaptiveScheduler, FixedScheduler
+
+log = logging.getLogger("berkeley.simulator")
+
+# Simulador de eventos discretos do algoritmo de Berkeley: relógio virtual, rede
+# simulada e nenhum socket ou sleep. Cada rodada reproduz a coleta do
+# coordenador (sondas sequenciais por cliente, escolha da sonda de menor RTT),
+# o motor de média e o agendador reais, e a disciplina de relógio do cliente
+# (degrau ou slew, compensação de deriva pelo resíduo de cada nó) vetorizada em
+# arrays NumPy, de modo que 100k nós cabem numa rodada de poucos milissegundos.
+# Uma rodada é processada de uma vez no instante em que começa; as suas
+# mensagens carregam os instantes virtuais de envio e chegada de cada uma.
+# Com a mesma semente, o resultado é idêntico.
+
+ROUND = 0
+SAMPLE = 1
+
+# Atrasos de um sentido para n mensagens: latência + jitter uniforme + atraso
+# esporádico; perdas com probabilidade loss
+class SimulatedNetwork:
+    def __init__(self, latency=0.0005, jitter=0.0005, spike_probability=0.0, spike_delay=0.0, loss=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.spike_probability = spike_probability
+        self.spike_delay = spike_delay
+        self.loss = loss
+
+    def delays(self, rng, n):
+        delays = np.full(n, self.latency)
+        if self.jitter:
+            delays += rng.uniform(0.0, self.jitter, n)
+        if self.spike_probability:
+            delays += np.where(rng.random(n) < self.spike_probability, self.spike_delay, 0.0)
+        return delays
+
+    def lost(self, rng, n):
+        if not self.loss:
+            return np.zeros(n, dtype=bool)
+        return rng.random(n) < self.loss
+
+# Relógios dos clientes: erro do hardware (offset + deriva * t) mais a correção
+# da disciplina de BerkeleyClient (mesmos parâmetros e mesmas fórmulas), para
+# todos os nós de uma vez
+class SimulatedClocks:
+    def __init__(self, hardware_offset, hardware_drift, slew_window=None, max_slew_rate=0.5,
+                 drift_compensation=True, drift_history=8, max_drift_rate=5e-4):
+        n = hardware_offset.size
+        self.hardware_offset = hardware_offset
+        self.hardware_drift = hardware_drift
+        self.slew_window = slew_window
+        self.max_slew_rate = max_slew_rate
+        self.drift_compensation = drift_compensation
+        self.max_drift_rate = max_drift_rate
+        self.clock_offset = np.zeros(n)
+        self.drift_rate = np.zeros(n)
+        self.drift_reference = np.zeros(n)
+        self.slew_amount = np.zeros(n)
+        self.slew_start = np.zeros(n)
+        self.slew_duration = np.ones(n)
+        self.drift_anchor = np.full(n, np.inf)  # Sem ajuste anterior, nenhuma leitura é amostra
+        self.history_rates = np.full((n, drift_history), np.nan)  # NaN = posição vazia
+        self.history_count = np.zeros(n, dtype=np.int64)
+
+    def correction(self, t):
+        correction = self.clock_offset + self.drift_rate * (t - self.drift_reference)
+        if self.slew_window:
+            progress = np.clip((t - self.slew_start) / self.slew_duration, 0.0, 1.0)
+            correction = correction + self.slew_amount * progress
+        return correction
+
+    def error(self, t):
+        return self.hardware_offset + self.hardware_drift * t + self.correction(t)
+
+    def apply_adjustment(self, adjustment, t, mask, delay=0.0):
+        # t: instante de chegada de cada ajuste; mask: clientes que recebem ajuste;
+        # delay: atraso de entrega medido pelo cliente (s). Opera sobre os arrays
+        # inteiros (np.where) em vez de indexar linhas
+        correction = self.correction(t)
+
+        # O ajuste vale para o instante da leitura, não para o da entrega
+        measured = np.maximum(t - delay, self.drift_reference)
+
+        previous_rate = self.drift_rate
+        if self.drift_compensation:
+            self.record_drift_sample(adjustment, measured, mask)
+            self.drift_rate = np.where(mask, self.estimate_drift_rate(), self.drift_rate)
+        # A deriva acumulada entre a leitura e a entrega, com a nova estimativa
+        adjustment = adjustment + (self.drift_rate - previous_rate) * (t - measured)
+
+        self.drift_reference = np.where(mask, t, self.drift_reference)
+        if self.slew_window:
+            self.clock_offset = np.where(mask, correction, self.clock_offset)
+            self.slew_amount = np.where(mask, adjustment, self.slew_amount)
+            self.slew_start = np.where(mask, t, self.slew_start)
+            self.slew_duration = np.where(mask, np.maximum(self.slew_window,
+                                                           np.abs(adjustment) / self.max_slew_rate),
+                                          self.slew_duration)
+            self.drift_anchor = np.where(mask, t + self.slew_duration, self.drift_anchor)
+        else:
+            self.clock_offset = np.where(mask, correction + adjustment, self.clock_offset)
+            self.drift_anchor = np.where(mask, t, self.drift_anchor)
+
+    def record_drift_sample(self, adjustment, measured, mask):
+        # Resíduo de cada nó desde o fim do ajuste anterior, como em
+        # BerkeleyClient.record_drift_sample
+        elapsed = measured - self.drift_anchor
+        sampled = mask & (elapsed >= MIN_DRIFT_INTERVAL)
+        residual = adjustment / np.where(sampled, elapsed, 1.0)
+        reset = sampled & (np.abs(residual) > self.max_drift_rate)
+        sampled &= ~reset
+        self.history_rates[reset] = np.nan
+        self.history_count[reset] = 0
+
+        slot = self.history_count % self.history_rates.shape[1]
+        rows = np.arange(slot.size)
+        self.history_rates[rows, slot] = np.where(sampled, self.drift_rate + residual,
+                                                  self.history_rates[rows, slot])
+        self.history_count += sampled
+
+    def estimate_drift_rate(self):
+        # Mediana das taxas válidas de cada nó: np.sort deixa os NaN no fim, e
+        # a mediana sai das posições do meio da parte válida
+        count = np.minimum(self.history_count, self.history_rates.shape[1])
+        rates = np.sort(self.history_rates, axis=1)
+        low = np.take_along_axis(rates, np.maximum(count - 1, 0)[:, None] // 2, axis=1)[:, 0]
+        high = np.take_along_axis(rates, (count // 2)[:, None], axis=1)[:, 0]
+        rate = np.where(count >= 3, (low + high) / 2, self.drift_rate)
+        return np.clip(rate, -self.max_drift_rate, self.max_drift_rate)
+
+class Simulation:
+    def __init__(self, nodes=1000, duration=86400.0, seed=1, averaging=None, scheduler=None,
+                 network=None, probes_per_client=4, probe_timeout=5.0, send_cost=2e-6,
+                 offset=10.0, drift=1e-4, faulty_fraction=0.0, fault_magnitude=5.0,
+                 sample_interval=60.0, target_accuracy=0.05, first_round=5.0, **client_options):
+        self.rng = np.random.default_rng(seed)
+        self.duration = duration
+        self.averaging = averaging or create_engine("mean")
+        self.scheduler = scheduler or AdaptiveScheduler(target_accuracy=target_accuracy)
+        self.network = network or SimulatedNetwork()
+        self.probes_per_client = probes_per_client
+        self.probe_timeout = probe_timeout
+        self.send_cost = send_cost  # Custo do coordenador por mensagem enviada
+        self.sample_interval = sample_interval
+        self.target_accuracy = target_accuracy
+        self.first_round = first_round
+
+        rng = self.rng
+        self.clocks = SimulatedClocks(rng.uniform(-offset, offset, nodes), rng.uniform(-drift, drift, nodes),
+                                      **client_options)
+        self.faulty = rng.random(nodes) < faulty_fraction
+        self.fault_magnitude = fault_magnitude
+
+        # Relógio do coordenador: corrigido em degrau, como em process_responses
+        self.coordinator_offset = float(rng.uniform(-offset, offset))
+        self.coordinator_drift = float(rng.uniform(-drift, drift))
+        self.coordinator_correction = 0.0
+
+        self.events = []
+        self.event_seq = 0
+        self.now = 0.0
+        self.rounds = []
+        self.samples = []
+
+    def coordinator_error(self, t):
+        return self.coordinator_offset + self.coordinator_drift * t + self.coordinator_correction
+
+    def true_errors(self, t):
+        # Nós defeituosos ficam fora do afastamento medido: a pergunta é o quanto
+        # eles atrapalham os demais
+        errors = self.clocks.error(t)
+        if self.faulty.any():
+            errors = errors[~self.faulty]
+        return np.append(errors, self.coordinator_error(t))
+
+    def schedule(self, at, kind):
+        heapq.heappush(self.events, (at, self.event_seq, kind))
+        self.event_seq += 1
+
+    def run(self):
+        self.schedule(self.first_round, ROUND)
+        if self.sample_interval:
+            self.schedule(self.sample_interval, SAMPLE)
+
+        while self.events:
+            at, _, kind = heapq.heappop(self.events)
+            if at > self.duration:
+                break
+            self.now = at
+            if kind == ROUND:
+                interval = self.run_round(at)
+                self.schedule(at + interval, ROUND)
+            else:
+                errors = self.true_errors(at)
+                self.samples.append((at, float(errors.max() - errors.min())))
+                self.schedule(at + self.sample_interval, SAMPLE)
+        return self.summary()
+
+    def run_round(self, start):
+        rng = self.rng
+        network = self.network
+        n = self.clocks.hardware_offset.size
+
+        errors = self.true_errors(start)
+        spread_before = float(errors.max() - errors.min())
+
+        # Fase 2: sondas sequenciais por cliente, disparadas em ordem pelo coordenador
+        send = start + np.arange(n) * self.send_cost
+        deadline = start + self.probe_timeout
+        best_rtt = np.full(n, np.inf)
+        best_offset = np.zeros(n)
+        best_reading = np.zeros(n)
+        for _ in range(self.probes_per_client):
+            active = send < deadline
+            outbound = network.delays(rng, n)
+            inbound = network.delays(rng, n)
+            delivered = active & ~network.lost(rng, n) & ~network.lost(rng, n)
+            read_time = send + outbound
+            receive = read_time + inbound
+            delivered &= receive <= deadline
+
+            reading = read_time + self.clocks.error(read_time)
+            if self.faulty.any():
+                reading = reading + np.where(self.faulty, rng.normal(0.0, self.fault_magnitude, n), 0.0)
+            send_local = send + self.coordinator_error(send)
+            receive_local = receive + self.coordinator_error(receive)
+            rtt = receive_local - send_local
+            offset = reading - (send_local + rtt / 2)
+
+            better = delivered & (rtt < best_rtt)
+            best_rtt = np.where(better, rtt, best_rtt)
+            best_offset = np.where(better, offset, best_offset)
+            best_reading = np.where(better, reading, best_reading)
+            send = np.where(delivered, receive, send + self.probe_timeout)
+
+        responded = np.isfinite(best_rtt)
+        collected = float(min(deadline, send[responded].max() if responded.any() else deadline))
+
+        # Fases 3 e 4: média com o coordenador em offset 0 e ajuste do coordenador.
+        # O motor recebe nanossegundos inteiros, como no coordenador real
+        offsets = np.append(0.0, best_offset[responded])
+        rtts = np.append(0.0, best_rtt[responded])
+        mean_offset, used = self.averaging.average(np.round(offsets * NANOS).astype(np.int64), rtts)
+        mean_offset /= NANOS
+        spread = float(np.abs(offsets[used] - mean_offset).max()) if used.any() else 0.0
+        uncertainty = float(rtts[used].max()) / 2 if used.any() else 0.0
+        self.coordinator_correction += mean_offset
+
+        # Fase 5: ajustes em ordem, cada um chegando após o atraso de ida
+        adjustment = np.where(responded, mean_offset - best_offset, 0.0)
+        arrival = collected + np.arange(n) * self.send_cost + network.delays(rng, n)
+        delivered = responded & ~network.lost(rng, n)
+        # O cliente mede o atraso no próprio relógio, contra a leitura que enviou
+        delay = np.maximum(arrival + self.clocks.error(arrival) - best_reading, 0.0)
+        self.clocks.apply_adjustment(adjustment, arrival, delivered, delay)
+
+        settled = float(arrival.max())
+        errors = self.true_errors(settled)
+        spread_after = float(errors.max() - errors.min())
+
+        interval = self.scheduler.record_round(spread, uncertainty, now=start)
+        self.rounds.append((start, interval, int(responded.sum()), int((~used).sum()),
+                            spread, uncertainty, spread_before, spread_after, collected - start))
+        return interval
+
+    def summary(self):
+        rounds = np.array(self.rounds) if self.rounds else np.zeros((0, 9))
+        samples = np.array([spread for _, spread in self.samples])
+        result = {
+            "rounds": len(self.rounds),
+            "virtual_seconds": self.now,
+            "mean_interval_seconds": float(rounds[:, 1].mean()) if len(rounds) else None,
+            "mean_responders": float(rounds[:, 2].mean()) if len(rounds) else None,
+            "mean_rejected": float(rounds[:, 3].mean()) if len(rounds) else None,
+            "mean_collect_seconds": float(rounds[:, 8].mean()) if len(rounds) else None,
+            "post_sync_spread_seconds": _percentiles(rounds[:, 7]) if len(rounds) else {},
+            "sampled_spread_seconds": _percentiles(samples),
+            "time_within_target": float((samples <= self.target_accuracy).mean()) if samples.size else None,
+        }
+        # Primeira rodada em diante, excluindo o estado inicial não sincronizado
+        if len(rounds) > 1:
+            result["steady_post_sync_spread_seconds"] = _percentiles(rounds[1:, 7])
+        return result
+
+def _percentiles(values):
+    values = np.asarray(values, dtype=np.float64)
+    if not values.size:
+        return {}
+    p50, p90, p99 = np.percentile(values, (50, 90, 99))
+    return {"p50": float(p50), "p90": float(p90), "p99": float(p99), "max": float(values.max())}
+
+def parse_duration(text):
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    if text and text[-1] in units:
+        return float(text[:-1]) * units[text[-1]]
+    return float(text)
+
+def parse_options(items):
+    options = {}
+    for item in items or ():
+        name, _, value = item.partition("=")
+        options[name.strip()] = float(value)
+    return options
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Simulação determinística do algoritmo de Berkeley")
+    parser.add_argument("--nodes", type=int, default=1000)
+    parser.add_argument("--duration", type=parse_duration, default=parse_duration("1d"),
+                        help="tempo virtual, ex.: 3600, 12h, 2d")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--averaging", default="mean")
+    parser.add_argument("--averaging-option", action="append", metavar="NOME=VALOR",
+                        help="parâmetro do motor de média, ex.: window=0.5")
+    parser.add_argument("--scheduler", choices=("adaptive", "fixed"), default="adaptive")
+    parser.add_argument("--interval", type=float, default=20.0, help="intervalo inicial/fixo (s)")
+    parser.add_argument("--min-interval", type=float, default=2.0)
+    parser.add_argument("--max-interval", type=float, default=300.0)
+    parser.add_argument("--target-accuracy", type=float, default=0.05)
+    parser.add_argument("--probes", type=int, default=4)
+    parser.add_argument("--probe-timeout", type=float, default=5.0)
+    parser.add_argument("--send-cost", type=float, default=2e-6, help="custo por mensagem no coordenador (s)")
+    parser.add_argument("--latency", type=float, default=0.0005)
+    parser.add_argument("--jitter", type=float, default=0.0005)
+    parser.add_argument("--spike-probability", type=float, default=0.0)
+    parser.add_argument("--spike-delay", type=float, default=0.0)
+    parser.add_argument("--loss", type=float, default=0.0)
+    parser.add_argument("--offset", type=float, default=10.0)
+    parser.add_argument("--drift", type=float, default=1e-4)
+    parser.add_argument("--faulty-fraction", type=float, default=0.0)
+    parser.add_argument("--fault-magnitude", type=float, default=5.0)
+    parser.add_argument("--slew-window", type=float, default=None)
+    parser.add_argument("--no-drift-compensation", action="store_true")
+    parser.add_argument("--sample-interval", type=float, default=60.0)
+    parser.add_argument("--output", help="salva o resultado em JSON")
+    return parser.parse_args(argv)
+
+def build_simulation(args):
+    if args.scheduler == "fixed":
+        scheduler = FixedScheduler(args.interval, args.min_interval)
+    else:
+        scheduler = AdaptiveScheduler(args.min_interval, args.max_interval, args.target_accuracy, args.interval)
+    network = SimulatedNetwork(args.latency, args.jitter, args.spike_probability, args.spike_delay, args.loss)
+    return Simulation(nodes=args.nodes, duration=args.duration, seed=args.seed,
+                      averaging=create_engine(args.averaging, **parse_options(args.averaging_option)),
+                      scheduler=scheduler, network=network, probes_per_client=args.probes,
+                      probe_timeout=args.probe_timeout, send_cost=args.send_cost, offset=args.offset,
+                      drift=args.drift, faulty_fraction=args.faulty_fraction,
+                      fault_magnitude=args.fault_magnitude, sample_interval=args.sample_interval,
+                      target_accuracy=args.target_accuracy, slew_window=args.slew_window,
+                      drift_compensation=not args.no_drift_compensation)
+
+if __name__ == "__main__":
+    args = parse_args()
+    setup_logging()
+
+    started = time.perf_counter()
+    result = build_simulation(args).run()
+    result["wall_seconds"] = time.perf_counter() - started
+
+    log.info("[SIMULADOR] %d nós, %.0fs virtuais em %.1fs reais: %d rodadas (intervalo médio %.1fs)",
+             args.nodes, result["virtual_seconds"], result["wall_seconds"], result["rounds"],
+             result["mean_interval_seconds"] or 0.0)
+    for name in ("post_sync_spread_seconds", "steady_post_sync_spread_seconds", "sampled_spread_seconds"):
+        stats = result.get(name)
+        if stats:
+            log.info("[SIMULADOR] %-32s p50 %.6f  p90 %.6f  p99 %.6f  máx %.6f", name,
+                     stats["p50"], stats["p90"], stats["p99"], stats["max"])
+    if result["time_within_target"] is not None:
+        log.info("[SIMULADOR] Tempo dentro da precisão alvo (%.3fs): %.1f%%",
+                 args.target_accuracy, result["time_within_target"] * 100)
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump({"config": vars(args), "results": result}, output, indent=2)
+        log.info("[SIMULADOR] Resultado salvo em %s", args.output)
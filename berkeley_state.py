@@ -0,0 +1,85 @@
+import json
+import logging
+import os
+import tempfile
+import time
+
+log = logging.getLogger("berkeley.state")
+
+# Estado do relógio do cliente salvo em disco para reinícios a quente: correção
+# atual, deriva estimada, taxas de deriva medidas e instante da última sincronização.
+# Instantes monotônicos não sobrevivem ao reinício, então tudo é gravado em tempo
+# de parede (time.time()) e convertido de volta na carga.
+#
+# A confiança no estado cai pela metade a cada half_life segundos sem
+# sincronização; abaixo de min_confidence o estado é descartado.
+#
+# Configuração: BERKELEY_STATE_PATH=arquivo (um por cliente)
+
+# Versão 2: o histórico guarda taxas de deriva medidas, não correções desejadas
+STATE_VERSION = 2
+
+class ClockStateFile:
+    def __init__(self, path, half_life=3600.0, min_confidence=0.05):
+        self.path = path
+        self.half_life = half_life
+        self.min_confidence = min_confidence
+
+    def save(self, client_id, correction, drift_rate, last_sync, history, now=None):
+        # history: [(instante monotônico, taxa de deriva medida)]
+        now = time.monotonic() if now is None else now
+        wall = time.time()
+        state = {
+            "version": STATE_VERSION,
+            "client_id": client_id,
+            "saved_at": wall,
+            "correction": correction,
+            "drift_rate": drift_rate,
+            "last_sync": last_sync,  # Tempo sincronizado do último ajuste (0 = nunca)
+            "synced_at": last_sync - correction if last_sync else 0.0,  # O mesmo instante em tempo de parede
+            "history": [[wall - (now - t), rate] for t, rate in history],
+        }
+        # Gravação atômica: um reinício no meio da escrita mantém o arquivo anterior
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temporary = tempfile.mkstemp(prefix=".berkeley-state-", dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as file:
+                json.dump(state, file)
+            os.replace(temporary, self.path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+
+    def load(self, now=None):
+        # Devolve o estado com instantes convertidos para o relógio monotônico
+        # atual e a confiança, ou None se não houver estado utilizável
+        try:
+            with open(self.path) as file:
+                state = json.load(file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            log.warning("[ESTADO] Arquivo de estado ilegível %s: %s", self.path, e)
+            return None
+        if state.get("version") != STATE_VERSION:
+            log.warning("[ESTADO] Versão de estado desconhecida em %s", self.path)
+            return None
+
+        now = time.monotonic() if now is None else now
+        wall = time.time()
+        # Sem nenhuma sincronização o estado é só o deslocamento inicial
+        if not state["synced_at"]:
+            return None
+        age = max(0.0, wall - state["synced_at"])
+        confidence = 0.5 ** (age / self.half_life) if self.half_life > 0 else 0.0
+        if confidence < self.min_confidence:
+            log.info("[ESTADO] Estado de %.0fs atrás descartado (confiança %.3f)", age, confidence)
+            return None
+
+        # A correção segue a deriva estimada durante o tempo parado
+        elapsed = max(0.0, wall - state["saved_at"])
+        state["correction"] += state["drift_rate"] * elapsed
+        state["history"] = [(now - (wall - t), rate) for t, rate in state["history"]]
+        state["age"] = age
+        state["confidence"] = confidence
+        return state
@@ -0,0 +1,166 @@
+import socket
+import threading
+import logging
+import random
+import sys
+
+import numpy as np
+
+from berkeley_averaging import create_engine
+from berkeley_clock import to_seconds
+from berkeley_logging import setup_logging
+from berkeley_metrics import start_metrics_server
+from berkeley_coordinator import BerkeleyCoordinator, combine_groups
+from berkeley_protocol import PROTOCOL_VERSION, SocketStream
+
+log = logging.getLogger("berkeley.subcoordinator")
+phase_log = logging.getLogger("berkeley.subcoordinator.phases")
+
+# Subcoordenador: sincroniza um grupo local de clientes (mesmo protocolo do
+# coordenador) e se apresenta ao coordenador pai como um cliente que, além do
+# próprio tempo, informa apenas o agregado do grupo (soma, contagem, mínimo e
+# máximo dos offsets). O ajuste recebido do pai é repassado ao grupo.
+class SubCoordinator(BerkeleyCoordinator):
+    def __init__(self, host='localhost', port=5001, parent_host='localhost', parent_port=5000,
+                 subcoordinator_id=None, probes_per_client=4, probe_timeout=5.0, averaging=None):
+        super().__init__(host, port, probes_per_client, probe_timeout, averaging)
+        self.parent_host = parent_host
+        self.parent_port = parent_port
+        self.subcoordinator_id = subcoordinator_id or f"Subcoordenador-{random.randint(1000, 9999)}"
+        self.upstream = None
+        self.group_offsets = []  # (cliente, id, offset, tempo do cliente) da última coleta
+        self.group_lock = threading.Lock()
+
+    def start(self):
+        self.server_socket.listen(128)
+        phase_log.info("\n" + "=" * 80)
+        phase_log.info(f"| ALGORITMO DE BERKELEY - SUBCOORDENADOR: {self.subcoordinator_id} |".center(80))
+        phase_log.info("=" * 80)
+        log.info("[%s] Relógio inicial: %s", self.subcoordinator_id, self.format_time(self.get_current_time()))
+        log.info("[%s] Grupo local em %s:%s, pai em %s:%s", self.subcoordinator_id,
+                 self.host, self.port, self.parent_host, self.parent_port)
+        phase_log.info("=" * 80)
+
+        accept_thread = threading.Thread(target=self.accept_connections)
+        accept_thread.daemon = True
+        accept_thread.start()
+
+        try:
+            parent_socket = socket.create_connection((self.parent_host, self.parent_port))
+        except Exception as e:
+            log.error("[ERRO] Erro ao conectar ao coordenador pai: %s", e)
+            self.server_socket.close()
+            return
+
+        self.upstream = SocketStream(parent_socket, PROTOCOL_VERSION, adaptive=False)
+        self.upstream.send_message({"type": "hello", "client_id": self.subcoordinator_id,
+                                    "role": "subcoordinator"})
+
+        try:
+            while True:
+                message = self.upstream.recv_message()
+                if message is None:
+                    log.warning("[%s] Conexão com o coordenador pai perdida", self.subcoordinator_id)
+                    break
+                self.handle_upstream_message(message)
+        except KeyboardInterrupt:
+            log.info("[%s] Encerrado pelo usuário", self.subcoordinator_id)
+        finally:
+            self.upstream.close()
+            self.server_socket.close()
+
+    def handle_upstream_message(self, message):
+        message_type = message.get("type")
+
+        if message_type == "time_request":
+            response = {
+                "type": "time_response",
+                "time": self.get_current_time(),
+                "client_id": self.subcoordinator_id
+            }
+            if "seq" in message:
+                response["seq"] = message["seq"]
+            self.upstream.send_message(response)
+
+        elif message_type == "aggregate_request":
+            self.report_aggregate(message.get("seq"))
+
+        elif message_type == "time_adjustment":
+            self.relay_adjustment(message.get("adjustment"))
+
+    def report_aggregate(self, seq):
+        reference_time = self.get_current_time()
+        with self.metrics.time_phase("collect"):
+            client_responses = self.collect_client_times(reference_time)
+
+        offsets = np.fromiter((client_time - reference_time for _, client_time, _ in client_responses),
+                              dtype=np.int64, count=len(client_responses))
+        rtts = np.fromiter((client.rtt or 0.0 for client, _, _ in client_responses),
+                           dtype=np.float64, count=len(client_responses))
+
+        # Soma, mínimo e máximo em ns inteiros, como no agregado enviado ao pai
+        total, count = 0, 0
+        min_offset, max_offset = 0, 0
+        if offsets.size:
+            trusted = np.fromiter((client.trusted(self.trust_confidence) for client, _, _ in client_responses),
+                                  dtype=bool, count=len(client_responses))
+            _, used = self.average_offsets(offsets, rtts, trusted)
+            if used.any():
+                total, count = int(offsets[used].sum()), int(used.sum())
+                min_offset, max_offset = int(offsets[used].min()), int(offsets[used].max())
+
+        # Subcoordenadores aninhados contribuem com os seus próprios grupos
+        group_sum, group_count, group_min, group_max = combine_groups(client_responses, reference_time)
+        if group_count:
+            min_offset = group_min if not count else min(min_offset, group_min)
+            max_offset = group_max if not count else max(max_offset, group_max)
+            total += group_sum
+            count += group_count
+
+        self.metrics.inc("rounds_total")
+        self.metrics.set_gauge("group_clocks", count)
+        self.metrics.observe_many("rtt_seconds", rtts)
+        with self.group_lock:
+            self.group_offsets = [(client, client_id, client_time - reference_time, client_time)
+                                  for client, client_time, client_id in client_responses]
+
+        log.info("[%s] Agregado do grupo: %d relógios, soma %+.6fs, offsets de %+.6fs a %+.6fs",
+                 self.subcoordinator_id, count, to_seconds(total), to_seconds(min_offset), to_seconds(max_offset),
+                 extra={"fields": {"event": "aggregate", "count": count, "sum": to_seconds(total),
+                                   "min_offset": to_seconds(min_offset), "max_offset": to_seconds(max_offset)}})
+        self.upstream.send_message({
+            "type": "aggregate_response",
+            "seq": seq,
+            "sum": total,
+            "count": count,
+            "min_offset": min_offset,
+            "max_offset": max_offset,
+            "client_id": self.subcoordinator_id
+        })
+
+    def relay_adjustment(self, adjustment):
+        self.clock.adjust(adjustment)
+        self.metrics.set_gauge("coordinator_adjustment_seconds", to_seconds(adjustment))
+        log.info("[%s] Ajuste recebido do pai: %+.6fs (novo offset %+.6fs)",
+                 self.subcoordinator_id, to_seconds(adjustment), self.clock_offset)
+
+        # Cada membro estava a 'offset' do subcoordenador; o ajuste dele é o do
+        # subcoordenador menos essa diferença, medido contra a leitura da coleta
+        with self.group_lock:
+            group_offsets, self.group_offsets = self.group_offsets, []
+        undelivered = self.dispatch_adjustments([(client, client_id, adjustment - offset, client_time)
+                                                 for client, client_id, offset, client_time in group_offsets])
+        log.info("[%s] Ajuste repassado para %d clientes", self.subcoordinator_id,
+                 len(group_offsets) - len(undelivered))
+
+if __name__ == "__main__":
+    subcoordinator_id = sys.argv[1] if len(sys.argv) > 1 else None
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 5001
+    parent_port = int(sys.argv[3]) if len(sys.argv) > 3 else 5000
+    averaging = create_engine(sys.argv[4]) if len(sys.argv) > 4 else None
+
+    setup_logging()
+    subcoordinator = SubCoordinator(port=port, parent_port=parent_port,
+                                    subcoordinator_id=subcoordinator_id, averaging=averaging)
+    start_metrics_server(subcoordinator.metrics, variable="BERKELEY_SUBCOORDINATOR_METRICS_PORT")
+    subcoordinator.start()
@@ -0,0 +1,180 @@
+import logging
+import os
+import socket
+import struct
+import time
+
+from berkeley_protocol import VERSION_BINARY, ProtocolError, decode_datagram, encode_message
+
+log = logging.getLogger("berkeley.udp")
+
+# Transporte UDP para as sondas de tempo. Cada sonda é um datagrama com número
+# de sequência; o cliente responde do mesmo socket que registrou no coordenador
+# (mensagem udp_register pela conexão TCP), e a resposta é casada pelo par
+# (endereço, seq). Ajustes e agregados continuam pela conexão TCP confiável.
+#
+# Configuração por variáveis de ambiente:
+#   BERKELEY_TRANSPORT   tcp (padrão) ou udp
+#   BERKELEY_UDP_PORT    porta UDP do coordenador (padrão: efêmera)
+#   BERKELEY_MULTICAST   grupo:porta para enviar a primeira sonda de cada onda
+#                        por multicast, ex.: 239.255.42.99:5007
+
+DATAGRAM_SIZE = 2048
+RECEIVE_BUFFER = 4 * 1024 * 1024
+
+def parse_multicast(spec):
+    if not spec:
+        return None
+    group, _, port = spec.rpartition(":")
+    return group, int(port)
+
+# Socket do cliente para receber sondas enviadas ao grupo multicast; vários
+# clientes no mesmo host compartilham a porta
+def open_multicast_socket(group, port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, "SO_REUSEPORT"):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(('', port))
+    membership = struct.pack('4s4s', socket.inet_aton(group), socket.inet_aton('0.0.0.0'))
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+    return sock
+
+# Lado do coordenador: um único socket UDP envia as sondas de cada onda em lote
+# a todos os clientes registrados e coleta as respostas. Quem não responde em
+# retransmit_interval recebe nova sonda (com novo seq, dobrando a espera a cada
+# tentativa) até max_retries; respostas atrasadas a sondas anteriores continuam
+# válidas, pois cada seq guarda o seu instante de envio
+class UdpProbeTransport:
+    def __init__(self, host='localhost', port=0, multicast=None, retransmit_interval=0.05,
+                 max_retries=3, multicast_ttl=1):
+        self.retransmit_interval = retransmit_interval
+        self.max_retries = max_retries
+        self.multicast = multicast
+        self.seq = 0
+        self.retransmits = 0
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER)
+        except OSError:
+            pass
+        self.socket.bind((host, port))
+        if multicast:
+            self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, multicast_ttl)
+            self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+
+    @property
+    def address(self):
+        return self.socket.getsockname()
+
+    def next_seq(self):
+        self.seq = self.seq % 0xFFFFFFFF + 1
+        return self.seq
+
+    def collect(self, connections, probes, deadline, get_time):
+        # Devolve {conexão: (amostras (envio, tempo do cliente, recebimento), id)}
+        by_address = {connection.udp_address: connection for connection in connections}
+        samples = {address: [] for address in by_address}
+        client_ids = {}
+        sent = {}  # (endereço, seq) -> instante de envio
+        self.discard_stale()
+
+        active = list(by_address)
+        for _ in range(probes):
+            pending = set(active)
+            wave_start = self.seq + 1
+            for attempt in range(1 + self.max_retries):
+                if not pending or time.monotonic() >= deadline:
+                    break
+                seq = self.next_seq()
+                # A sonda não tem campos de tempo: na versão 2 também é atendida
+                # por clientes anteriores aos nanossegundos
+                request = encode_message({"type": "time_request", "seq": seq}, VERSION_BINARY)
+                if attempt:
+                    self.retransmits += len(pending)
+                multicast = not attempt and self.send_multicast(request, seq, pending, sent, get_time)
+                if not multicast:
+                    for address in list(pending):
+                        sent[(address, seq)] = get_time()
+                        try:
+                            self.socket.sendto(request, address)
+                        except OSError as e:
+                            log.error("[ERRO] Falha ao enviar sonda UDP para %s: %s", address, e)
+                            pending.discard(address)
+                waiting = len(pending)
+                wait = self.retransmit_interval * (2 ** attempt)
+                self.receive(pending, sent, samples, client_ids, wave_start,
+                             min(deadline, time.monotonic() + wait), get_time)
+                if multicast and len(pending) == waiting:
+                    # Ninguém recebeu a sonda do grupo: a rede não entrega multicast
+                    log.warning("[UDP] Nenhuma resposta à sonda multicast; usando unicast")
+                    self.multicast = None
+            active = [address for address in active if address not in pending]
+
+        return {by_address[address]: (address_samples, client_ids.get(address, "Desconhecido"))
+                for address, address_samples in samples.items() if address_samples}
+
+    def send_multicast(self, request, seq, pending, sent, get_time):
+        if not self.multicast or len(pending) < 2:
+            return False
+        send_time = get_time()
+        try:
+            self.socket.sendto(request, self.multicast)
+        except OSError as e:
+            log.warning("[UDP] Multicast indisponível (%s); usando unicast", e)
+            self.multicast = None
+            return False
+        sent.update(((address, seq), send_time) for address in pending)
+        return True
+
+    def receive(self, pending, sent, samples, client_ids, wave_start, until, get_time):
+        while pending:
+            remaining = until - time.monotonic()
+            if remaining <= 0:
+                return
+            self.socket.settimeout(remaining)
+            try:
+                data, address = self.socket.recvfrom(DATAGRAM_SIZE)
+            except socket.timeout:
+                return
+            except OSError as e:
+                # ICMP de porta inalcançável de um cliente que saiu
+                log.debug("[UDP] Erro ao receber datagrama: %s", e)
+                continue
+            receive_time = get_time()
+            try:
+                message = decode_datagram(data)
+            except ProtocolError:
+                continue
+            if message.get("type") != "time_response":
+                continue
+            seq = message.get("seq", 0)
+            send_time = sent.pop((address, seq), None)
+            if send_time is None:
+                continue  # Duplicada, de outra rodada ou de endereço desconhecido
+            samples[address].append((send_time, message["time"], receive_time))
+            client_ids[address] = message.get("client_id", "Desconhecido")
+            if seq >= wave_start:
+                pending.discard(address)
+
+    def discard_stale(self):
+        # Respostas que chegaram depois do fim da rodada anterior
+        self.socket.setblocking(False)
+        try:
+            while True:
+                self.socket.recvfrom(DATAGRAM_SIZE)
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            pass
+        finally:
+            self.socket.setblocking(True)
+
+    def close(self):
+        self.socket.close()
+
+def transport_from_env(host='localhost'):
+    if os.environ.get("BERKELEY_TRANSPORT", "tcp") != "udp":
+        return None
+    return UdpProbeTransport(host, int(os.environ.get("BERKELEY_UDP_PORT", 0)),
+                             parse_multicast(os.environ.get("BERKELEY_MULTICAST")))
@@ -2,15 +2,47 @@ import subprocess
 import time
 import platform
 import os
+import select
 import signal
 
+NUM_CLIENTS = 4
+READY_TIMEOUT = 10.0
+
 def print_header():
     print("\n*** SISTEMA DE SINCRONIZAÇÃO DE RELÓGIOS - ALGORITMO DE BERKELEY ***")
     print("=" * 80)
-    print("Este script iniciará o coordenador e 4 processos clientes para demonstrar")
+    print(f"Este script iniciará o coordenador e {NUM_CLIENTS} processos clientes para demonstrar")
     print("o algoritmo de Berkeley para sincronização de relógios em sistemas distribuídos.")
     print("=" * 80)
 
+def start_coordinator(python_cmd, env):
+    # Em sistemas Unix o coordenador avisa por um pipe quando já está escutando
+    # (BERKELEY_READY_FD); no Windows os clientes simplesmente tentam de novo até
+    # conseguir conectar
+    if platform.system() == 'Windows':
+        return subprocess.Popen([python_cmd, 'berkeley_coordinator.py'], env=env), None
+    
+    ready_read, ready_write = os.pipe()
+    coordinator_env = dict(env, BERKELEY_READY_FD=str(ready_write))
+    try:
+        coordinator = subprocess.Popen([python_cmd, 'berkeley_coordinator.py'], env=coordinator_env,
+                                       pass_fds=(ready_write,))
+    finally:
+        os.close(ready_write)
+    return coordinator, ready_read
+
+def wait_until_ready(ready_read, timeout=READY_TIMEOUT):
+    # Devolve a linha "READY <porta>" ou None se o coordenador terminou ou não
+    # ficou pronto no prazo
+    try:
+        readable, _, _ = select.select([ready_read], [], [], timeout)
+        if not readable:
+            return None
+        line = os.read(ready_read, 64).decode('ascii').strip()
+        return line or None
+    finally:
+        os.close(ready_read)
+
 def run_berkeley_system():
     processes = []
     
@@ -26,18 +58,31 @@ def run_berkeley_system():
                 print(f"ERRO: O arquivo {file} não foi encontrado!")
                 return
         
+        # A demonstração exibe as tabelas de cada fase, salvo configuração em contrário.
+        # A primeira rodada começa assim que todos os clientes se conectam
+        env = dict(os.environ)
+        env.setdefault("BERKELEY_LOG_TABLES", "1")
+        env.setdefault("BERKELEY_QUORUM", str(NUM_CLIENTS))
+        
+        start = time.monotonic()
         print("Iniciando o coordenador...")
-        coordinator = subprocess.Popen([python_cmd, 'berkeley_coordinator.py'])
+        coordinator, ready_read = start_coordinator(python_cmd, env)
         processes.append(coordinator)
         
-        time.sleep(2)  # Dar tempo para o coordenador inicializar
+        if ready_read is not None:
+            ready = wait_until_ready(ready_read)
+            if ready is None:
+                print("ERRO: O coordenador não ficou pronto para aceitar conexões.")
+                coordinator.kill()
+                return
+            print(f"Coordenador pronto em {(time.monotonic() - start) * 1000:.0f} ms ({ready})")
         
+        # Os clientes são iniciados todos de uma vez
         print("Iniciando os clientes...")
-        for i in range(1, 5):
+        for i in range(1, NUM_CLIENTS + 1):
             print(f"Iniciando Cliente-{i}...")
-            client = subprocess.Popen([python_cmd, 'berkeley_client.py', f'Cliente-{i}'])
+            client = subprocess.Popen([python_cmd, 'berkeley_client.py', f'Cliente-{i}'], env=env)
             processes.append(client)
-            time.sleep(0.5)  # Pequeno intervalo entre inicializações
         
         print("\n*** TODOS OS PROCESSOS ESTÃO EM EXECUÇÃO ***")
         print("Para encerrar todos os processos, pressione Ctrl+C.")
@@ -0,0 +1,65 @@
+import unittest
+
+from berkeley_client import BerkeleyClient
+
+# Grupo simulado em tempo virtual: cada cliente lê t + deriva do hardware * t +
+# correção; o coordenador (correção em degrau) entra na média com offset 0, e o
+# ajuste chega delay segundos depois da leitura, como em synchronize_clocks
+class VirtualCluster:
+    def __init__(self, interval=2.0, delay=0.001, **client_options):
+        self.interval = interval
+        self.delay = delay
+        self.client_options = client_options
+        self.clients = []
+        self.coordinator_correction = 0.0
+        self.now = 0.0
+
+    def add(self, offset, drift):
+        client = BerkeleyClient(client_id=f"Cliente-{len(self.clients)}", **self.client_options)
+        client.clock_offset = offset
+        client.drift_reference = self.now
+        self.clients.append((client, drift))
+        return client
+
+    def errors(self, t):
+        reference = t + self.coordinator_correction
+        return [t + drift * t + client.current_correction(t) - reference for client, drift in self.clients]
+
+    def run(self, rounds):
+        for _ in range(rounds):
+            self.now += self.interval
+            offsets = self.errors(self.now)
+            average = sum(offsets) / (len(offsets) + 1)
+            self.coordinator_correction += average
+            for (client, _), offset in zip(self.clients, offsets):
+                client._apply_adjustment(average - offset, self.now + self.delay, self.delay)
+
+class DriftEstimationTest(unittest.TestCase):
+    def assert_tracks_hardware(self, cluster):
+        for client, drift in cluster.clients:
+            self.assertAlmostEqual(client.drift_rate, -drift, delta=2e-6)
+        # Logo antes da rodada seguinte o grupo continua junto do coordenador
+        for error in cluster.errors(cluster.now + cluster.interval * 0.9):
+            self.assertLess(abs(error), 20e-6)
+
+    def late_join(self, **client_options):
+        cluster = VirtualCluster(**client_options)
+        for offset, drift in ((3, 20e-6), (-4, -10e-6), (7, 5e-6)):
+            cluster.add(offset, drift)
+        cluster.run(30)
+        self.assert_tracks_hardware(cluster)
+
+        # Um cliente com offset de 10 s desloca a média em ~2.5 s numa rodada: é
+        # um salto da referência, não deriva dos clientes já sincronizados
+        cluster.add(10, 0.0)
+        cluster.run(30)
+        self.assert_tracks_hardware(cluster)
+
+    def test_late_join_step(self):
+        self.late_join()
+
+    def test_late_join_slew(self):
+        self.late_join(slew_window=2.0, interval=5.0)
+
+if __name__ == "__main__":
+    unittest.main()